@@ -0,0 +1,76 @@
+#Micro-benchmark of dombusgateway_codec, compared with the per-byte implementation used before (bytearray.append and checksum loop)
+#Run: python3 benchmarks/bench_codec.py
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dombusgateway_codec as codec
+import dombusgateway_const as DB
+
+CMDS = [(DB.CMD_SET, 0, 2, 1, [1]), (DB.CMD_SET, 0, 3, 2, [0x03, 0xe8]), (DB.CMD_CONFIG, 0, 4, 3, [DB.SUBCMD_SET, 0x01, 0xf4])]
+FRAME = codec.encodeFrame(0xff31, 0, CMDS)
+STREAM = FRAME * 100
+
+def oldChecksum(buffer, frameLen):
+    checksumValue = 0
+    for i in range(0, frameLen-1):
+        checksumValue += buffer[i]
+    return checksumValue & 0xff
+
+def oldEncode(dst, cmds):
+    txbuffer = bytearray()
+    txbuffer.append(DB.PREAMBLE)
+    txbuffer.append((dst >> 8) & 0xff)
+    txbuffer.append(dst & 0xff)
+    txbuffer.append(0)
+    txbuffer.append(0)
+    txbuffer.append(0)
+    for cmd, cmdAck, cmdLen, port, args in cmds:
+        txbuffer.append((cmd | cmdAck | int((cmdLen+1) / 2)))
+        txbuffer.append(port & 0xff)
+        for i in range(0, cmdLen-1):
+            txbuffer.append((args[i]&0xff))
+        if cmdLen & 1:
+            txbuffer.append(0)
+    txbuffer[DB.FRAME_LEN] = len(txbuffer) - DB.FRAME_HEADER
+    txbuffer.append(0)
+    txbuffer[-1] = oldChecksum(txbuffer, len(txbuffer))
+    return txbuffer
+
+builder = codec.FrameBuilder()
+
+def newEncode(dst, cmds):
+    builder.begin(dst)
+    for cmd, cmdAck, cmdLen, port, args in cmds:
+        builder.add(cmd, cmdAck, cmdLen, port, args)
+    return builder.finish()
+
+def decodeStream():
+    start, end = 0, len(STREAM)
+    while start < end:
+        start, frameLen, dst, src = codec.nextFrame(STREAM, start, end)
+        if frameLen == 0:
+            break
+        if codec.checksum(memoryview(STREAM)[start:], frameLen) == STREAM[start+frameLen-1]:
+            for c in codec.iterCmds(memoryview(STREAM)[start:start+frameLen], frameLen):
+                pass
+        start += frameLen
+
+def bench(name, stmt, number):
+    t = min(timeit.repeat(stmt, number=number, repeat=5)) / number
+    print(f"{name:<40} {t*1e6:8.2f} us")
+    return t
+
+if __name__ == '__main__':
+    assert bytes(oldEncode(0xff31, CMDS)) == bytes(newEncode(0xff31, CMDS)) == FRAME
+    print(f"Frame: {len(FRAME)} bytes, {len(CMDS)} commands")
+    old = bench("checksum: per-byte loop", lambda: oldChecksum(FRAME, len(FRAME)), 100000)
+    new = bench("checksum: sum(memoryview)", lambda: codec.checksum(FRAME, len(FRAME)), 100000)
+    print(f"{'':<40} {old/new:8.1f} x")
+    old = bench("encode: bytearray.append", lambda: oldEncode(0xff31, CMDS), 50000)
+    new = bench("encode: FrameBuilder (reused buffer)", lambda: newEncode(0xff31, CMDS), 50000)
+    print(f"{'':<40} {old/new:8.1f} x")
+    t = bench("decode: 100 frames (nextFrame+iterCmds)", decodeStream, 500)
+    print(f"{'':<40} {t*1e6/100:8.2f} us/frame")
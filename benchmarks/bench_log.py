@@ -0,0 +1,107 @@
+#Benchmark of the per-frame cost of log messages with debugLevel = DB.LOG_ERR: deferred formatting (log() with %-style args)
+#compared with messages formatted before calling log(), as f-strings did before
+#Run: python3 benchmarks/bench_log.py [capture_file]     (capture file recorded by dombusgateway.py --capture: RX frames of bus 1 are used)
+import asyncio
+import logging
+import os
+import struct
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dombusgateway as gw
+import dombusgateway_capture as dbcap
+import dombusgateway_codec as codec
+import dombusgateway_const as DB
+
+class Transport:
+    """Serial transport that discards TX frames"""
+    def write(self, data):
+        pass
+
+def moduleFrames(addr: int):
+    """Frames from a DomBus module with a relay, a digital input and a counter: configuration first, then 100 state changes and ACKs"""
+    ver = b'02j1DomBus31\0'
+    ports = b''.join(struct.pack('>IH', portType, 0) + name + b'\0' for portType, name in ((DB.PORTTYPE_OUT_DIGITAL, b'RL1'), (DB.PORTTYPE_IN_DIGITAL, b'IN1'), (DB.PORTTYPE_IN_COUNTER, b'CNT')))
+    config = [codec.encodeFrame(0, addr, [(DB.CMD_CONFIG, DB.CMD_ACK, len(ver) + 1, 0xfe, list(ver))]),
+        codec.encodeFrame(0, addr, [(DB.CMD_CONFIG, DB.CMD_ACK, len(ports) + 2, 0xff, [2] + list(ports))])]
+    frames = []
+    for i in range(100):
+        frames.append(codec.encodeFrame(0, addr, [(DB.CMD_SET, 0, 2, 2, [i & 1])]))
+        frames.append(codec.encodeFrame(0, addr, [(DB.CMD_SET, 0, 3, 3, [i >> 8, i & 0xff])]))
+        frames.append(codec.encodeFrame(0, addr, [(DB.CMD_SET, DB.CMD_ACK, 2, 1, [i & 1])]))
+    return config, frames
+
+def captureFrames(path):
+    """RX frames of bus 1 in a capture file"""
+    frames = []
+    buffer = b''.join(data for _, busID, direction, data in dbcap.readCapture(path) if direction == dbcap.DIR_RX and busID == 1)
+    start, end = 0, len(buffer)
+    while start < end:
+        start, frameLen, _, _ = codec.nextFrame(buffer, start, end)
+        if frameLen == 0:
+            break
+        frames.append(buffer[start:start+frameLen])
+        start += frameLen
+    return [], frames
+
+deferredLog = gw.log
+logCalls = 0
+
+def eagerLog(level, msg, *args):
+    """log() as it was before: the message is built by the caller even if level is disabled"""
+    global logCalls
+    logCalls += 1
+    if args:
+        msg = msg % args
+    elif callable(msg):
+        msg = msg()
+    if level == 0 or (gw.debugLevel & level) != level:
+        return
+    logging.info(f"{DB.LOGNAME.get(level, DB.LOGNAME[DB.LOG_NONE])}{msg}")
+
+async def main():
+    tmp = Path(tempfile.mkdtemp())
+    gw.modulesPath = tmp / 'Modules.json'
+    gw.devicesPath = tmp / 'Devices.json'
+    gw.mqtt['enabled'] = 0
+    gw.debugLevel = DB.LOG_ERR
+    gw.manager = gw.DomBusManager()
+    gw.buses = {1: {'serialPort': 'bench'}}
+    protocol = gw.DomBusProtocol(1, None)
+    protocol.connection_made(Transport())
+    gw.buses[1]['protocol'] = protocol
+    config, frames = captureFrames(sys.argv[1]) if len(sys.argv) > 1 else moduleFrames(0xff31)
+    frames = [(frame, len(frame), *codec.HEADER.unpack_from(frame)[1:3]) for frame in config + frames]
+
+    def rx():
+        for frame, frameLen, dst, src in frames:
+            protocol.on_frame_received_callback(1, dst, src, frameLen, frame)
+
+    global logCalls
+    rx()    # create modules and devices
+    print(f"{len(frames)} frames, {len(gw.Devices)} devices, debugLevel = DB.LOG_ERR")
+    gw.log = eagerLog
+    logCalls = 0
+    rx()
+    print(f"log() calls: {logCalls / len(frames):.1f} per frame")
+    results = {}
+    for _ in range(10):
+        # alternate the two log functions, to not be affected by CPU frequency changes: the min time is kept
+        for name, logFunction in (("messages built before log()", eagerLog), ("deferred formatting", deferredLog)):
+            gw.log = logFunction
+            t = timeit.timeit(rx, number=20) / 20 / len(frames)
+            results[name] = min(t, results.get(name, t))
+    gw.log = deferredLog
+    for name, t in results.items():
+        print(f"{name:<30} {t*1e6:8.2f} us/frame")
+    saving = results["messages built before log()"] - results["deferred formatting"]
+    print(f"{'saving':<30} {saving*1e6:8.2f} us/frame ({saving*100/results['messages built before log()']:.0f}%)")
+    if protocol.statusHandle:
+        protocol.statusHandle.cancel()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -7,9 +7,12 @@
 VERSION = "0.4"
 
 from dombusgateway_conf import *
+import dombusgateway_codec as codec
+import dombusgateway_capture as dbcap
+from dombusgateway_registry import DomBusRegistry, DomBusModules
 
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 import asyncio
 import serial_asyncio
@@ -21,7 +24,6 @@ if mqtt['enabled'] != 0:
         from aiomqtt import Client as MQTTClient
         mqttversion='new'
     import paho.mqtt.client as MQTTpaho
-    from paho.mqtt.subscribeoptions import SubscribeOptions
 
 import os
 import signal
@@ -31,29 +33,61 @@ import json
 import time
 import re
 import bisect
+import heapq
+import hashlib
 import struct
 import math
 from typing import Any
 import datetime
-from queue import Queue
+from queue import Queue, Full
+from collections import deque, OrderedDict
+import atexit
 
 import argparse
 import ipaddress
 
 import statistics
 
-Devices = dict()    # list of all devices (one device for each module port)
-Modules = dict()    # list of modules
+Devices = DomBusRegistry()    # list of all devices (one device for each module port), indexed by module, bus, topic and portType
+Modules = DomBusModules()    # list of modules, with the routing table of module addresses among buses
 delmodules = []     # list of frameAddr that must be removed from Modules{}
 portsDisabled = dict()   # for each module, list of ports that should be disabled (not shown) # TODO: read configuration from file
+captureWriter = None    # dbcap.CaptureWriter used to record bus and MQTT traffic (--capture option)
 saveDataTimeout = 0 # Used to determine if device configuration changes, in that case call saveData() to save Modules and Devices structures in filesystem
 
-def log(level, msg):
-    if debugLevel & level:
-        logName = DB.LOGNAME[DB.LOG_NONE]
-        if level in DB.LOGNAME:
-            logName = DB.LOGNAME[level]
-        logging.info(f"{logName}{msg}")
+def logEnabled(level):
+    """Return True if messages with the specified level (DB.LOG_*) are enabled by debugLevel"""
+    return level != 0 and (debugLevel & level) == level
+
+def log(level, msg, *args):
+    """
+        Log msg if level is enabled by debugLevel. 
+        The message is built only if level is enabled: msg may be a %-style format string with args, 
+        or a callable returning the message, e.g. log(DB.LOG_DEBUG, "value=%s", value)
+    """
+    if level == 0 or (debugLevel & level) != level:
+        return
+    if args:
+        msg = msg % args
+    elif callable(msg):
+        msg = msg()
+    logging.info(f"{DB.LOGNAME.get(level, DB.LOGNAME[DB.LOG_NONE])}{msg}")
+
+class LogQueueHandler(QueueHandler):
+    """Send log records to a bounded queue, written to file by a QueueListener thread: records are dropped (and counted) if the writer falls behind"""
+    def __init__(self, maxSize: int):
+        super().__init__(Queue(maxSize))
+        self.dropped = 0            # number of records dropped because the queue was full
+        self.droppedReported = 0    # number of dropped records already reported in the log
+
+    def enqueue(self, record):
+        try:
+            if self.dropped != self.droppedReported:
+                self.queue.put_nowait(logging.makeLogRecord({'msg': f"{DB.LOGNAME[DB.LOG_WARN]}{self.dropped - self.droppedReported} log messages dropped (total {self.dropped}): log file is too slow", 'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+                self.droppedReported = self.dropped
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
 
 def getFloat(s):
     """Extract the float value from string. Return None in case of error"""
@@ -112,7 +146,7 @@ class Smoother:
 class DomBusDevice():
     """Device class"""
     def __init__(self, devID : int, portType: int, portOpt: int, portName: str, options: dict, haOptions: dict, dcmd: list = [],  status: dict = {}, dcmdConf: str = ""):
-        log(DB.LOG_DEBUG, f"DomBusDevice(devID={devID:08x} portType={portType} portOpt={portOpt} portName={portName} options={options} haOptions={haOptions} dcmd={dcmd} dcmdConf={dcmdConf} status={status})")
+        log(DB.LOG_DEBUG, "DomBusDevice(devID=%08x portType=%s portOpt=%s portName=%s options=%s haOptions=%s dcmd=%s dcmdConf=%s status=%s)", devID, portType, portOpt, portName, options, haOptions, dcmd, dcmdConf, status)
         self.devID = int(devID) # devID=0xBBAAAAPPPP
         self.busID = devID >> 32
         self.frameAddr = self.devID >> 16     #0xBBAAAA for example 0x01ff38
@@ -171,6 +205,10 @@ class DomBusDevice():
         self.lastValueUpdate = 0    # last time that value has been published
         self.lastEnergyUpdate = 0   # last time that energy has been published
         self.lastPortType = self.portType
+        self.configCache = None     # list of (topic, payload) returned by configPayloads(), None if configuration changed
+        self.configCacheHash = ''   # hash of configCache
+        self.configHash = ''        # hash of the configuration published to the MQTT broker (retained messages)
+        self.configCmps = {}        # components published by device discovery (mqtt['deviceDiscovery']=1): configCmps[component id] = platform
 
         self.setTopics(self.ha['p'], "")  # Set self.topic and self.topic2
 
@@ -183,6 +221,8 @@ class DomBusDevice():
             self.energy = status['energy']
             self.topic2 = status['topic2']
             self.topic2Config = status['topic2Config']
+            self.configHash = status.get('configHash', '')
+            self.configCmps = status.get('configCmps', {})
 
         self.lastTopicConfig = self.topicConfig
         self.lastTopic2Config = self.topic2Config
@@ -233,7 +273,7 @@ class DomBusDevice():
                 self.portConf += f',{opt}={self.options[opt]}'
         if len(self.dcmdConf)>0:
             self.portConf += ',' + self.dcmdConf    # Add DCMD description as written by the user                
-        log(DB.LOG_DEBUG, f"setPortConf(): self.portConf={self.portConf}")
+        log(DB.LOG_DEBUG, "setPortConf(): self.portConf=%s", self.portConf)
 
     def setTopics(self, platform1, platform2):
         """ Set self.topic, self,topicConfig, self.topic2, self.topic2COnfig """
@@ -246,12 +286,13 @@ class DomBusDevice():
             if not hasattr(self, 'topic2'):
                 self.topic2 = ""
                 self.topic2Config = ""
+        Devices.reindex(self)   # update topic index, if this device is already in Devices
 
     def to_dict(self) -> dict[str, Any]:
         """Transform DomBusDevice classes into a dictionary, to be saved in a json file"""
-        status = dict(devIDname2 = self.devIDname2, value = self.value, valueHA = self.valueHA, counterValue = self.counterValue, counterTime = self.counterTime, energy = self.energy, topic2 = self.topic2, topic2Config = self.topic2Config)
+        status = dict(devIDname2 = self.devIDname2, value = self.value, valueHA = self.valueHA, counterValue = self.counterValue, counterTime = self.counterTime, energy = self.energy, topic2 = self.topic2, topic2Config = self.topic2Config, configHash = self.configHash, configCmps = self.configCmps)
         if self.devID == 0x0100010008:
-            log(DB.LOG_DEBUG, f"to_dict: devID={self.devID:08x} devIDname={self.devIDname} portType={self.portType} portOpt={self.portOpt} ...)")
+            log(DB.LOG_DEBUG, "to_dict: devID=%08x devIDname=%s portType=%s portOpt=%s ...)", self.devID, self.devIDname, self.portType, self.portOpt)
         return { 
             'devID': self.devID, 'devIDname': self.devIDname, 'portType': self.portType, 'portOpt': self.portOpt, 'portName': self.portName, 'options': self.options, 
             'ha': self.ha, 'dcmd': self.dcmd, 'status': status, 'dcmdConf': self.dcmdConf
@@ -300,6 +341,9 @@ class DomBusDevice():
         elif self.portType == DB.PORTTYPE_OUT_DIMMER:
             # Dimmer: DomBus uses value from 0 to 20 where 20=100%
             self.valueHA = self.value * 5
+        elif self.portType == DB.PORTTYPE_OUT_ANALOG:
+            # 0-10.0V output: DomBus uses value from 0 to 100
+            self.valueHA = self.value / 10
         elif self.ha['p'] == 'number': 
             self.valueHA = self.value
         elif self.ha['p'] == 'sensor':  # valueHA = value (sensor data)
@@ -315,7 +359,7 @@ class DomBusDevice():
     def updateFromBus(self, what, value:int = None, counterValue:int = None, configOptions:str = None):
         """ Data received from bus: update device and send command to MQTT, ..."""
         global manager
-        log(DB.LOG_DEBUG,f"updateFromBus({what}, {value}, {counterValue}, {configOptions})")
+        log(DB.LOG_DEBUG, "updateFromBus(%s, %s, %s, %s)", what, value, counterValue, configOptions)
         self.lastUpdate=int(time.time())  # LastUpdate = number of seconds since epoch
 
         if what & DB.UPDATE_VALUE:
@@ -353,8 +397,8 @@ class DomBusDevice():
                 if self.value != 0 and 'OPPOSITE' in self.options:
                     # OPPOSITE = 'd' => dev = BBHHHH000d; OPPOSITE maybe 1234.b => dev = BB1234000b where B = current busID; OPPOSITE maybe 021234.b => dev = 021234000b
                     dev = self.getDevID(self.options['OPPOSITE'])
-                    log(DB.LOG_DEBUG, f"OPPOSITE dev = {dev:x}, Devices[dev].value={Devices[dev].value}")
                     if dev is not None and dev in Devices and (Devices[dev].value != 0 or (self.lastUpdate - Devices[dev].lastValueUpdate) >= mqtt['publishInterval']):
+                        log(DB.LOG_DEBUG, "OPPOSITE dev = %x, Devices[dev].value=%s", dev, Devices[dev].value)
                         # OPPOSITE is used for import / export pulsed meter: if import meter is counting => export meter is set to 0, and vice versa (cannot get both import and export power)
                         log(DB.LOG_DEBUG, "OPPOSITE option is set => reset the OPPOSITE entity value")
                         Devices[dev].updateFromBus(DB.UPDATE_VALUE, 0)
@@ -365,7 +409,8 @@ class DomBusDevice():
                     # send data by MQTT only if it changed, or every publishInterval
                     if self.valueHA != self.lastValueHA or (self.lastUpdate - self.lastValueUpdate) >= mqtt['publishInterval']:
                         payload = self.valueHA    # message = ON: must be lowercase!
-                        manager.mqttPublish(self.topic + '/state', payload, retain=False)
+                        qos, retain = manager.mqttQosRetain('state', self)
+                        manager.mqttPublish(self.topic + '/state', payload, retain, qos, ordered=False)
                         # self.lastValueHA = self.valueHA MUST BE CONFIRMED BY UPDATE_ACK
                         self.lastValueUpdate = self.lastUpdate
 #                        if self.ha['p'] == 'switch':    #DEBUG
@@ -376,14 +421,8 @@ class DomBusDevice():
                         # a second entity is associated to this
                         self.lastEnergy = self.energy
                         self.lastEnergyUpdate = self.lastUpdate
-                        if self.portType == DB.PORTTYPE_SENSOR_ALARM:
-                            self.energy = int(self.energy)
-                            if self.energy > 4: 
-                                self.energy = 0
-                            payload = DB.SENSOR_ALARM_NAME[ self.energy ]
-                        else:
-                            payload = int(self.energy * 1000) / 1000    # energy, with Wh resolution
-                        manager.mqttPublish(self.topic2 + '/state', payload, retain=False)
+                        qos, retain = manager.mqttQosRetain('state', self)
+                        manager.mqttPublish(self.topic2 + '/state', self.energyPayload(), retain, qos, ordered=False)
             self.lastValue = value
                         
 
@@ -394,7 +433,8 @@ class DomBusDevice():
                 if self.portType != DB.PORTTYPE_SENSOR_TEMP_HUM and self.portType != DB.PORTTYPE_OUT_LEDSTATUS:    # do not add TEMP+HUM device
                     if self.valueHA != self.lastValueHA or (self.lastUpdate - self.lastValueUpdate) >= mqtt['publishInterval']:
                         payload = self.valueHA    # message = ON
-                        manager.mqttPublish(self.topic + '/state', payload)
+                        qos, retain = manager.mqttQosRetain('ack', self)
+                        manager.mqttPublish(self.topic + '/state', payload, retain, qos, ordered=False)
                         self.lastValueHA = self.valueHA; self.lastValueUpdate = self.lastUpdate
                         
 
@@ -405,18 +445,20 @@ class DomBusDevice():
                     if configOptions == 'reset' or (self.portType != self.lastPortType and self.lastTopicConfig != ""):
                         # reset request, or portType changed => remove previous entity by sending config topic with empty payload
                         # log(DB.LOG_DEBUG,f'configOptions={configOptions}. self.portType={self.portType}, self.lastPortType={self.lastPortType}, self.lastTopicConfig={self.lastTopicConfig}')
-                        log(DB.LOG_DEBUG,f'Removing old entity, topic={self.lastTopicConfig}, payload=""')
+                        log(DB.LOG_DEBUG, 'Removing old entity, topic=%s, payload=""', self.lastTopicConfig)
                         manager.mqttPublish(self.lastTopicConfig, "", retain=True)
                         self.lastPortType = self.portType
+                        self.configHash = ''    # entity removed: publish the configuration again
                         if self.lastTopic2Config != "":
                             # portType changed => remove previous entity by sending config topic with empty payload
-                            log(DB.LOG_DEBUG,f'Removing old associated entity, topic={self.lastTopic2Config}, payload=""')
+                            log(DB.LOG_DEBUG, 'Removing old associated entity, topic=%s, payload=""', self.lastTopic2Config)
                             manager.mqttPublish(self.lastTopic2Config, "", retain=True)
 
                     if self.portType == DB.PORTTYPE_IN_ANALOG:
                         if 'FUNCTION' in self.options:
                             if self.options['FUNCTION'] == '3950' and (self.ha['p'] != 'sensor' or self.ha['device_class'] != 'temperature'):
                                 self.ha = DB.PORTTYPES_HA[DB.PORTTYPE_SENSOR_TEMP].copy()    # set 'p': 'sensor', 'device_class': 'temperature', 'unit_of_measurement': '°C', 'suggested_display_precision': 1
+                                self.configCache = None
                     else:
                         # not analog port => remove FUNCTION if exists
                         if 'FUNCTION' in self.options:    
@@ -426,70 +468,118 @@ class DomBusDevice():
                         self.portOpt = DB.PORTOPT_NONE   # reset INVERTED flag when port is configured as temperature, analog, ...
 
                     self.setTopics(self.ha['p'], "")    # update current topic
-                    payload = dict(name = f"{self.portName}", friendly_name = f"{self.portName}", unique_id = 'dombus_' + self.devIDname, command_topic = f"{self.topic}/set", \
-                            state_topic = f"{self.topic}/state", payload_on = "on", payload_off = "off", schema = "json")
-                    
-
-                    o = {}  # originator
-                    o['name'] = 'DomBusGateway'
-                    o['sw'] = VERSION
-                    o['url'] = 'https://creasol.it/DomBusGateway'
-                    payload['o'] = o
-
-                    if self.frameAddr in Modules:
-                        dev = {} # device
-                        dev['identifiers'] = [ self.frameAddr ]
-                        if Modules[self.frameAddr][DB.LASTTYPE]:
-                            dev['name'] = Modules[self.frameAddr][DB.LASTTYPE]
-                        else:
-                            dev['name'] = 'DomBus'
-                        dev['name'] += f" {self.devAddr:04x}"
-                        if self.busID > 1:
-                            dev['name'] += f" on bus {self.busID:x}"
-                        dev['mf'] = "Creasol"
-                        dev['mdl'] = Modules[self.frameAddr][DB.LASTTYPE]
-                        dev['sw'] = Modules[self.frameAddr][DB.LASTFW]
-                        payload['dev'] = dev
-                    if self.ha:
-                        payload.update(self.ha)  # Add Home Assistant specific options (platform, device_class, ...
-                    if self.portType == DB.PORTTYPE_SENSOR_DISTANCE:
-                        if self.options['A'] == 0.1:
-                            payload['unit_of_measurement'] = 'cm'
-                        elif self.options['A'] == 0.01:
-                            payload['unit_of_measurement'] = 'dm'
-                        elif self.options['A'] == 0.001:
-                            payload['unit_of_measurement'] = 'm'
-                        else:
-                            payload['unit_of_measurement'] = 'mm'
-                    manager.mqttPublish(self.topicConfig, payload, retain=True)
-
-                    if 'device_class' in self.ha and self.ha['device_class'] == 'power':
-                        # set a second entity with energy value
-                        payload['p'] = 'sensor' # platform
-                        self._initDevice2Config(payload) # init payload, topic2 and topic2 config, send empty payload to remove previous entity
-                        payload['device_class'] = 'energy'
-                        payload['state_class'] = 'total'
-                        payload['unit_of_measurement'] = "kWh"
-                        manager.mqttPublish(self.topic2Config, payload, retain=True)
-                    elif self.portType == DB.PORTTYPE_SENSOR_ALARM:
-                        # set a second entity showing all sensor statuses: Closed, Open, Masked, Tampered, Shorted
-                        payload['p'] = 'select' # platform
-                        self._initDevice2Config(payload) # init payload, topic2 and topic2 config, send empty payload to remove previous entity
-                        payload['options'] = ['Closed', 'Open', 'Masked', 'Tampered', 'Shorted']
-                        manager.mqttPublish(self.topic2Config, payload, retain=True)
-                        self.lastTopic2Config = self.topic2Config
-                    else:
-                        # No associated device
-                        self.devIDname2 = ""
-                        self.topic2 = ""
-                        self.topic2Config = ""
-                        self.lastTopic2Config = ""
+                    self.updateConfigCache()
+                    if mqtt.get('deviceDiscovery', 0):
+                        manager.mqttModuleConfig(self.frameAddr)   # one discovery message for the whole module
+                    elif self.configCacheHash != self.configHash:
+                        # configuration not published yet, or changed: publish it (retained messages)
+                        qos, retain = manager.mqttQosRetain('config', self)
+                        for topic, message in self.configCache:
+                            manager.mqttPublish(topic, message, retain, qos, ordered=True)
+                        self.configHash = self.configCacheHash
+                        self.configCmps = {}
+                        setSaveDataTimeout()    # save configHash, to not publish the same configuration after restart
 
 
         if what & DB.UPDATE_DCMD:
             #TODO: propagate DCMD command
             log(DB.LOG_DEBUG, "*** Send MQTT topic to propagate DCMD ***")
 
+    def energyPayload(self):
+        """Return the state of the associated entity: energy value, or alarm sensor status"""
+        if self.portType == DB.PORTTYPE_SENSOR_ALARM:
+            self.energy = int(self.energy)
+            if self.energy > 4: 
+                self.energy = 0
+            return DB.SENSOR_ALARM_NAME[ self.energy ]
+        return int(self.energy * 1000) / 1000    # energy, with Wh resolution
+
+    def publishState(self) -> int:
+        """Publish the current state of the entity and of the associated entity, if any. Return the number of published messages"""
+        if mqtt['enabled'] == 0 or self.portType == DB.PORTTYPE_SENSOR_TEMP_HUM or self.portType == DB.PORTTYPE_OUT_LEDSTATUS:
+            return 0
+        now = int(time.time())
+        qos, retain = manager.mqttQosRetain('state', self)
+        manager.mqttPublish(self.topic + '/state', self.valueHA, retain, qos, ordered=False)
+        self.lastValueUpdate = now
+        if self.devIDname2 == "":
+            return 1
+        manager.mqttPublish(self.topic2 + '/state', self.energyPayload(), retain, qos, ordered=False)
+        self.lastEnergy = self.energy
+        self.lastEnergyUpdate = now
+        return 2
+
+    def updateConfigCache(self):
+        """Build the discovery payloads and their hash, if configuration changed since the last call"""
+        if self.configCache is None:
+            self.configCache = self.configPayloads()
+            mode = 'device\n' if mqtt.get('deviceDiscovery', 0) else ''  # switching discovery mode => publish again
+            self.configCacheHash = hashlib.sha1((mode + '\n'.join(f"{topic} {message}" for topic, message in self.configCache)).encode()).hexdigest()[:16]
+
+    def configPayloads(self):
+        """Return the list of (topic, payload) with Home Assistant discovery configuration for this device and the associated entity, if any"""
+        configs = []
+        payload = dict(name = f"{self.portName}", friendly_name = f"{self.portName}", unique_id = 'dombus_' + self.devIDname, command_topic = f"{self.topic}/set", \
+                state_topic = f"{self.topic}/state", payload_on = "on", payload_off = "off", schema = "json")
+
+        o = {}  # originator
+        o['name'] = 'DomBusGateway'
+        o['sw'] = VERSION
+        o['url'] = 'https://creasol.it/DomBusGateway'
+        payload['o'] = o
+
+        if self.frameAddr in Modules:
+            dev = {} # device
+            dev['identifiers'] = [ self.frameAddr ]
+            if Modules[self.frameAddr][DB.LASTTYPE]:
+                dev['name'] = Modules[self.frameAddr][DB.LASTTYPE]
+            else:
+                dev['name'] = 'DomBus'
+            dev['name'] += f" {self.devAddr:04x}"
+            if self.busID > 1:
+                dev['name'] += f" on bus {self.busID:x}"
+            dev['mf'] = "Creasol"
+            dev['mdl'] = Modules[self.frameAddr][DB.LASTTYPE]
+            dev['sw'] = Modules[self.frameAddr][DB.LASTFW]
+            payload['dev'] = dev
+        if self.ha:
+            payload.update(self.ha)  # Add Home Assistant specific options (platform, device_class, ...
+        if self.portType == DB.PORTTYPE_SENSOR_DISTANCE:
+            if self.options['A'] == 0.1:
+                payload['unit_of_measurement'] = 'cm'
+            elif self.options['A'] == 0.01:
+                payload['unit_of_measurement'] = 'dm'
+            elif self.options['A'] == 0.001:
+                payload['unit_of_measurement'] = 'm'
+            else:
+                payload['unit_of_measurement'] = 'mm'
+        payload['_sender'] = 'dbp'  # add a tag to identify msg sent by me, to ignore loopback mqtt commands
+        configs.append((self.topicConfig, json.dumps(payload)))
+
+        if 'device_class' in self.ha and self.ha['device_class'] == 'power':
+            # set a second entity with energy value
+            payload['p'] = 'sensor' # platform
+            self._initDevice2Config(payload) # init payload, topic2 and topic2 config, send empty payload to remove previous entity
+            payload['device_class'] = 'energy'
+            payload['state_class'] = 'total'
+            payload['unit_of_measurement'] = "kWh"
+            configs.append((self.topic2Config, json.dumps(payload)))
+        elif self.portType == DB.PORTTYPE_SENSOR_ALARM:
+            # set a second entity showing all sensor statuses: Closed, Open, Masked, Tampered, Shorted
+            payload['p'] = 'select' # platform
+            self._initDevice2Config(payload) # init payload, topic2 and topic2 config, send empty payload to remove previous entity
+            payload['options'] = ['Closed', 'Open', 'Masked', 'Tampered', 'Shorted']
+            configs.append((self.topic2Config, json.dumps(payload)))
+            self.lastTopic2Config = self.topic2Config
+        else:
+            # No associated device
+            self.devIDname2 = ""
+            self.topic2 = ""
+            self.topic2Config = ""
+            self.lastTopic2Config = ""
+        Devices.reindex(self)   # topic2 may be changed
+        return configs
+
     def _initDevice2Config(self, payload):
         """Called from updateFromBus(DB.UPDATE_CONFIG): init payload, topic2 and topic2 config, send empty payload to remove previous entity"""
         self.devIDname2 = f"{self.frameAddr:06x}_{(self.port + 0x80):04x}"
@@ -508,7 +598,7 @@ class DomBusDevice():
     def updateToBus(self, what:int, valueStr:str = None):
         """ Data received from MQTT: update device and send command to bus"""
         global manager
-        log(DB.LOG_DEBUG, f"updateToBus({what}, {valueStr})")
+        log(DB.LOG_DEBUG, "updateToBus(%s, %s)", what, valueStr)
         if what & DB.UPDATE_VALUE:
             error = False
             if valueStr is not None:
@@ -556,7 +646,7 @@ class DomBusDevice():
                             value = float(valueHA)
                         except ValueError:
                             log(DB.LOG_WARN, f"Invalid value from MQTT: {valueStr}, type={type(valueHA)}")
-                            log(DB.LOG_DEBUG, f"ha={self.ha}")
+                            log(DB.LOG_DEBUG, "ha=%s", self.ha)
                             error = True
                         else:
                             # valueHA is a float or int
@@ -586,7 +676,7 @@ class DomBusDevice():
                         value += 65536  # Negative power => convert to int(16)
                 if error == False:
                     if buses[self.busID]['protocol'] != None:
-                        log(DB.LOG_DEBUG, f"TX to DomBus module {self.frameAddr:06x}, on port {self.port:02x}, value={value}")
+                        log(DB.LOG_DEBUG, "TX to DomBus module %06x, on port %02x, value=%s", self.frameAddr, self.port, value)
                         if self.port < 0x80:
                             if self.portType == DB.PORTTYPE_IN_COUNTER or self.portType == DB.PORTTYPE_IN_ANALOG or self.portType == DB.PORTTYPE_OUT_ANALOG or (self.portType == DB.PORTTYPE_CUSTOM and (self.portOpt == DB.PORTOPT_IMPORT_ENERGY or self.portOpt == DB.PORTOPT_EXPORT_ENERGY)):
                                 # 16 bit value
@@ -604,14 +694,15 @@ class DomBusDevice():
                         log(DB.LOG_WARN, f"updateToBus(): serial port for bus {self.busID} is not active: discharge frame for DomBus module {self.frameAddr:06x}")
 
         if buses[self.busID]['protocol']:
-            buses[self.busID]['protocol'].send()    # Transmit, if needed
+            buses[self.busID]['protocol'].txKick()    # Transmit, if needed
 
 
     def updateDeviceConfig(self, portType: int, portOpt: int, cal: int, dcmd: dict, dcmdConf: str, options: dict, haOptions: dict, value: int = None):
         """Port configuration change requested by the user (via telnet, for example) or by a new device read from DomBus network"""
-        log(DB.LOG_DEBUG, f"updateDeviceConfig(portType={portType}, portOpt={portOpt}, cal={cal}, dcmd={dcmd}, dcmdConf={dcmdConf}, options={options}, haOptions={haOptions}, value={value}")
+        log(DB.LOG_DEBUG, "updateDeviceConfig(portType=%s, portOpt=%s, cal=%s, dcmd=%s, dcmdConf=%s, options=%s, haOptions=%s, value=%s", portType, portOpt, cal, dcmd, dcmdConf, options, haOptions, value)
         self.lastTopicConfig = self.topicConfig     # save previous config topic, used to remove the old entity
         self.lastTopic2Config = None
+        self.configCache = None     # configuration changed: build the discovery payloads again
         if self.topic2Config is not None:
             self.lastTopic2Config = self.topic2Config
         proto = buses[self.busID]['protocol']
@@ -619,11 +710,12 @@ class DomBusDevice():
         diff = 0
         if portType is not None and self.portType != portType:
             self.portType = portType
+            Devices.reindex(self)
             diff |= 1
         if portOpt is not None and self.portOpt != portOpt:
             self.portOpt = portOpt
             diff |= 2
-        log(DB.LOG_DEBUG, f"self.portType={self.portType:x}, self.portOpt={self.portOpt:x}")
+        log(DB.LOG_DEBUG, "self.portType=%x, self.portOpt=%x", self.portType, self.portOpt)
         if dcmd:    # and self.dcmd != dcmd:
             self.dcmd = dcmd.copy()
             self.dcmdConf = dcmdConf    # "DCMD(Pulse)=1ff37.1:Toggle,DCMD(Pulse1)=10001.2:On:1m"
@@ -642,16 +734,16 @@ class DomBusDevice():
         # update DomBus module configuration
         log(DB.LOG_INFO, f'Update configuration for DomBus module {self.devIDname}:\r\n  {self.portConf}')
         proto.txQueueAdd(self.frameAddr, DB.CMD_CONFIG, 7, 0, self.port, [((self.portType>>24)&0xff), ((self.portType>>16)&0xff), ((self.portType>>8)&0xff), (self.portType&0xff), (self.portOpt >> 8), (self.portOpt&0xff)], DB.TX_RETRY,1)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         # DCMD ?
         dcmdnum=0
         for i in range(0, min(len(dcmd), 8)):
             d = dcmd[i]
-            log(DB.LOG_DEBUG, f"DCMD: transmit #{i} ?")
+            log(DB.LOG_DEBUG, "DCMD: transmit #%d ?", i)
             #note: port|=0, 0x20, 0x40, 0x60 (4 DCMD for each port)
             if (d[0]!=0 and d[0]<DB.DCMD_IN_EVENTS["MAX"]):
                 dcmdnum += 1
-                log(DB.LOG_DEBUG, f"Yes, txQueueAdd()")
+                log(DB.LOG_DEBUG, "Yes, txQueueAdd()")
                 proto.txQueueAdd(self.frameAddr, DB.CMD_DCMD_CONFIG, 12, 0, self.port|(i<<5), [ 
                     d[0],
                     d[1]>>8, d[1]&0xff,
@@ -661,7 +753,7 @@ class DomBusDevice():
                 ], DB.TX_RETRY, 1)
         if (dcmdnum == 0): #DCMD not defined => transmits an empty DCMD_CONFIG 
             proto.txQueueAdd(self.frameAddr, DB.CMD_DCMD_CONFIG, 2, 0, self.port, [ DB.DCMD_IN_EVENTS["NONE"] ], DB.TX_RETRY, 1)
-        proto.send()    # Transmit!
+        proto.txKick()    # Transmit!
 
         if 'ADDR' in options:
             options['ADDR'] = int(float(options['ADDR']))
@@ -669,7 +761,7 @@ class DomBusDevice():
                 log(DB.LOG_INFO, f"Send command to change modbus device address to {options['ADDR']}")
                 # proto.txQueueAdd(self.frameAddr, DB.CMD_CONFIG, 4, 0, self.port, [DB.SUBCMD_SET, (newModbusAddr>>8), (newModbusAddr&0xff)], DB.TX_RETRY, 1)    #EVSE: until 2023-04-24 port must be replaced with port+5 to permit changing modbus address 
                 proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET, options['ADDR'])
-                proto.send()    # Transmit
+                proto.txKick()    # Transmit
                 del self.options['ADDR']
 
         # Check INIT and CAL options
@@ -692,7 +784,7 @@ class DomBusDevice():
             else:
                 if v>=-32768 and v<32768:
                     if v < 0: v += 65536    # Convert in binary format, 16bit
-                    log(DB.LOG_DEBUG, f"CAL: send CAL = {v} to the device")
+                    log(DB.LOG_DEBUG, "CAL: send CAL = %d to the device", v)
                     cal = v
                 else:
                     log(DB.LOG_WARN, "CAL value must be in the range -3276÷3276")
@@ -700,7 +792,7 @@ class DomBusDevice():
 
         if cal is not None and cal>=0 and cal < 65536: # Transmit calibration or INIT parameter
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_CALIBRATE, cal)   
-            proto.send()    # Transmit
+            proto.txKick()    # Transmit
         
         parName = 'PAR1'; 
         if parName in self.options and self.options[parName] < 65536:
@@ -718,42 +810,42 @@ class DomBusDevice():
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET4, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR5'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET5, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR6'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET6, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR7'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET7, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR8'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET8, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR9'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET9, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR10'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET10, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
         parName = 'PAR11'; 
         if parName in self.options and self.options[parName] < 65536:
             parValue = self.options[parName]
             proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET112, parValue)
-        proto.send()    # Transmit
+        proto.txKick()    # Transmit
 
         if 'EV Mode' in self.portName:
             parName = 'EVMAXCURRENT'; 
@@ -768,7 +860,7 @@ class DomBusDevice():
             parName = 'EVSTOPTIME'; 
             if parName in self.options and self.options[parName] >= 5 and self.options[parName] <= 600:
                 proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET4, options[parName])
-            proto.send()
+            proto.txKick()
             parName = 'EVAUTOSTART'; 
             if parName in self.options and self.options[parName] >= 0 and self.options[parName] <= 2:
                 proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET5, options[parName])
@@ -799,7 +891,7 @@ class DomBusDevice():
                 if v<0: 
                     v += 65535  # Convert to int16
                 proto.txQueueAddConfig16(self.frameAddr, self.port, DB.SUBCMD_SET13, v)
-            proto.send()
+            proto.txKick()
      
 
         if 'HWADDR' in options:
@@ -811,27 +903,28 @@ class DomBusDevice():
                 if (newHwAddr > 0 and newHwAddr < 0xffff and newHwAddr != self.devAddr):
                     log(DB.LOG_INFO, f"Change module address from {self.devAddr:04x} to {newHwAddr:04x}")
                     proto.txQueueAdd(self.frameAddr, DB.CMD_CONFIG, 4, 0, 0, [(newHwAddr >> 8), (newHwAddr&0xff), (0-(newHwAddr >> 8)-(newHwAddr&0xff)-0xa5)], DB.TX_RETRY,1)
-                    proto.send()    # Transmit
+                    proto.txKick()    # Transmit
                     # Change address to every devices
                     devIDbase = (self.busID<<32) | (newHwAddr<<16)    #0xBBNNNN0000 New devID base
-                    for dev in list(Devices.keys()):
-                        if (dev & 0xffffff0000) == (self.devID & 0xffffff0000):  # current device, with old hwaddr
-                            # Create a new object for this device
-                            devID = devIDbase | (dev & 0xffff)
-                            d = DomBusDevice(devID, Devices[dev].portType, Devices[dev].portOpt, Devices[dev].portName, Devices[dev].options, Devices[dev].ha, Devices[dev].dcmd) # Create device object with same configuration as before
-                            Devices[devID] = d
-                            d.value = Devices[dev].value
-                            d.valueHA = Devices[dev].valueHA
-                            d.counterValue = Devices[dev].counterValue
-                            # TODO: send MQTT configuration for the new device?
-                            # send MQTT to remove old device
-                            log(DB.LOG_DEBUG,f'Removing old entity for device={Devices[dev].devIDname}...')
-                            manager.mqttPublish(Devices[dev].lastTopicConfig, "")
-                            if Devices[dev].lastTopic2Config != "":
-                                # portType changed => remove previous entity by sending config topic with empty payload
-                                log(DB.LOG_DEBUG,f'Removing old associated entity for {Devices[dev].devIDname}...')
-                                manager.mqttPublish(Devices[dev].lastTopic2Config, "")
-                                del Devices[dev]
+                    for dev, old in list(Devices.moduleDevices(self.frameAddr).items()):   # devices of the current module, with old hwaddr
+                        # Create a new object for this device
+                        devID = devIDbase | old.port
+                        d = DomBusDevice(devID, old.portType, old.portOpt, old.portName, old.options, old.ha, old.dcmd) # Create device object with same configuration as before
+                        d.value = old.value
+                        d.valueHA = old.valueHA
+                        d.counterValue = old.counterValue
+                        Devices[devID] = d
+                        # TODO: send MQTT configuration for the new device?
+                        # send MQTT to remove old device
+                        log(DB.LOG_DEBUG,f'Removing old entity for device={old.devIDname}...')
+                        manager.mqttPublish(old.topicConfig, "", retain=True)
+                        if old.topic2Config:
+                            # remove the associated entity by sending config topic with empty payload
+                            log(DB.LOG_DEBUG,f'Removing old associated entity for {old.devIDname}...')
+                            manager.mqttPublish(old.topic2Config, "", retain=True)
+                        del Devices[dev]
+                    if mqtt.get('deviceDiscovery', 0):
+                        manager.mqttPublish(manager.moduleConfigTopic(self.frameAddr), "", retain=True)
                     if self.frameAddr in Modules:
                         del Modules[self.frameAddr]
             del options['HWADDR']
@@ -858,9 +951,128 @@ class DomBusDevice():
         if value:
             self.updateFromBus(DB.UPDATE_VALUE, value)
 
+######################################## TxQueue class ###############################################    
+class TxEntry:
+    """Command waiting in the TX queue of a module"""
+    __slots__ = ('key', 'cmd', 'cmdLen', 'cmdAck', 'port', 'args', 'retries', 'priority', 'txTime', 'txCount')
+
+    def __init__(self, key, cmd: int, cmdLen: int, cmdAck: int, port: int, args: list, retries: int, priority: int):
+        self.key = key          # key in TxQueue.entries
+        self.cmd = cmd
+        self.cmdLen = cmdLen    # length of data after command (port+args[])
+        self.cmdAck = cmdAck
+        self.port = port
+        self.args = args
+        self.retries = retries  # remaining transmissions
+        self.priority = priority    # DB.TXPRIO_*
+        self.txTime = 0         # time (ms since Epoch) of the last transmission
+        self.txCount = 0        # number of transmissions with the current args
+
+class TxQueue:
+    """TX queue of a module: commands indexed by (cmd|cmdAck, port, subcmd), in insertion order"""
+    __slots__ = ('entries',)
+
+    def __init__(self):
+        self.entries = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def add(self, cmd: int, cmdLen: int, cmdAck: int, port: int, args: list, retries: int, priority: int):
+        """Add a command, or update it if the same command is already in queue"""
+        #if CMD_CONFIG with SUBCMD, also the SUBCMD must be the same
+        key = (cmd | cmdAck, port, args[0] if cmd == DB.CMD_CONFIG and cmdLen == 4 and args else None)
+        txq = self.entries.get(key)
+        if txq is None:
+            self.entries[key] = TxEntry(key, cmd, cmdLen, cmdAck, port, args, retries, priority)
+        else:
+            #command already in txQueue: update values
+            txq.cmdLen = cmdLen
+            txq.args = args
+            txq.txCount = 0     # ACK to previous transmissions must not be used to measure RTT
+            if txq.retries < retries:
+                txq.retries = retries
+            if txq.priority > priority:
+                txq.priority = priority
+
+    def ack(self, cmd: int, port: int, arg1: int):
+        """ACK received from the module: remove the matching command, if already transmitted, and return it"""
+        for key in ((cmd, port, arg1), (cmd, port, None)) if cmd == DB.CMD_CONFIG else ((cmd, port, None),):
+            txq = self.entries.get(key)
+            if txq is not None and (len(txq.args)==0 or txq.args[0]==arg1) and txq.retries!=DB.TX_RETRY:
+                del self.entries[key]
+                return txq
+        return None
+
+    def remove(self, txq: TxEntry):
+        del self.entries[txq.key]
+
+    def clear(self):
+        self.entries.clear()
+
+    def unsent(self) -> bool:
+        """Return True if some commands have never been transmitted"""
+        return any(txq.txCount == 0 for txq in self.entries.values())
+
+    def priority(self) -> int:
+        """Return the highest priority (lowest DB.TXPRIO_* value) of commands in queue"""
+        return min(txq.priority for txq in self.entries.values())
+
+class RttEstimator:
+    """Round trip time (command => ACK) of a module, as EWMA with variance (like TCP, RFC 6298), used to compute the retry timeout"""
+    __slots__ = ('srtt', 'rttvar', 'rto', 'samples', 'last')
+
+    def __init__(self):
+        self.srtt = 0.0     # smoothed RTT, in ms
+        self.rttvar = 0.0   # RTT variation, in ms
+        self.rto = DB.TX_RTO_INIT   # retry timeout, in ms
+        self.samples = 0
+        self.last = 0       # last RTT, in ms
+
+    def update(self, rtt: int):
+        """Add a RTT sample (ms) and compute the new retry timeout"""
+        if self.samples == 0:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.samples += 1
+        self.last = rtt
+        self.rto = min(max(self.srtt + max(1, 4 * self.rttvar), DB.TX_RTO_MIN), DB.TX_RTO_MAX)
+
+class RouteStats:
+    """Counters of a DCMD route from a bus to a module attached to another bus: hits and latency (DCMD received => DCMD transmitted)"""
+    __slots__ = ('hits', 'pending', 'last', 'avg', 'max')
+
+    def __init__(self):
+        self.hits = 0       # DCMD commands routed
+        self.pending = 0.0  # loop time of the first routed DCMD not transmitted yet
+        self.last = 0.0     # last latency, in ms
+        self.avg = 0.0      # average latency (EWMA), in ms
+        self.max = 0.0      # max latency, in ms
+
+    def routed(self, now: float):
+        """A DCMD command has been queued on the destination bus"""
+        self.hits += 1
+        if not self.pending:
+            self.pending = now
+
+    def transmitted(self, now: float):
+        """Queued DCMD commands have been transmitted on the destination bus"""
+        if self.pending:
+            latency = (now - self.pending) * 1000
+            self.avg = latency if self.avg == 0 else self.avg + (latency - self.avg) / 8
+            self.last = latency
+            self.max = max(self.max, latency)
+            self.pending = 0.0
+
 ######################################## DomBusProtocol class ###############################################    
 class DomBusProtocol(asyncio.Protocol):
-    def __init__(self, busID, on_data_received_callback):
+    def __init__(self, busID, on_data_received_callback, baudrate=115200):
         self.busID = busID
         self.devAddr = 0    #0xff31
         self.frameAddr = 0  #0x01ff31       bus|devAddr      used in Modules{}
@@ -868,22 +1080,63 @@ class DomBusProtocol(asyncio.Protocol):
         self.devIDname = "" #b01_hff31_p0001
         self.on_data_received_callback = on_data_received_callback
         self.transport = None
-        self.buffer = b""   
-        self.frame = b""
-        self.txbuffer = b""
+        self.rxBuffer = bytearray(DB.RX_BUFFER_SIZE)   # preallocated RX buffer: bytes from rxStart to rxEnd are waiting to be parsed
+        self.rxView = memoryview(self.rxBuffer)
+        self.rxStart = 0    # read cursor
+        self.rxEnd = 0      # write cursor
+        self.txFrame = codec.FrameBuilder()  # preallocated buffer used to build TX frames
         self.txQueue = dict()
-        self.checksumValue = 0
+        self.txHeap = []        # heap of (txTime, priority, seq, frameAddr): txTime=0 => transmit now
+        self.txScheduled = dict()   # txScheduled[frameAddr] = (txTime, priority, seq) of the valid txHeap entry: other entries are stale
+        self.txSeq = 0          # sequence number, to keep FIFO order for entries with same txTime and priority
+        self.statusHeap = [(m[DB.LASTSTATUS], frameAddr) for frameAddr, m in Modules.items() if (frameAddr >> 16) == busID] # heap of (LASTSTATUS, frameAddr) for modules in this bus
+        heapq.heapify(self.statusHeap)
+        self.statusModules = set(frameAddr for _, frameAddr in self.statusHeap)  # modules in this bus, used to spread the periodic status over PERIODIC_STATUS_INTERVAL
+        self.statusLastTime = 0.0   # loop time when the last periodic status has been queued
+        self.statusHandle = None    # timer that calls txPeriodicStatus() when the next periodic status is due
+        self.statusTime = 0.0       # loop time of statusHandle
+        self.loop = asyncio.get_event_loop()
+        self.txPending = False  # True if _txFlush() has been scheduled by txKick()
+        self.retryHandle = None # timer that calls send() at retryTime
         self.retryTime = 0 # time since epoch, in ms, when a frame have to be TXed again
+        self.rtt = dict()       # rtt[frameAddr] = RttEstimator for modules in this bus
+        self.routeStats = dict()    # routeStats[(srcBus, dst)] = RouteStats for DCMD commands routed from bus srcBus to module dst in this bus
+        self.rxAcks = []        # (cmd, port, arg) ACKs to commands in the received frame, transmitted by txAcks() at the end of the frame
+        self.byteTime = 10 / baudrate   # seconds to transmit 1 byte (start + 8 bits + stop)
+        self.lineBusyUntil = 0.0    # loop time when my TX ends on the half-duplex RS485 line
+        self.replyUntil = dict()    # replyUntil[frameAddr] = loop time until the module is expected to answer the last frame: no frames to it in the meantime
+        self.lineHandle = None      # timer that calls send() when a module that must answer becomes free
+        self.txBytes = 0            # bytes transmitted, to compute the bus utilization
+        self.rxBytes = 0            # bytes received, to compute the bus utilization
+        self.statsTime = self.loop.time()   # time when txBytes and rxBytes counters started
+        self.rxHandlers = { # functions that manage commands received from modules, by (cmd, ack)
+            (DB.CMD_CONFIG, DB.CMD_ACK):    self._rxConfigAck,
+            (DB.CMD_SET, DB.CMD_ACK):       self._rxSetAck,
+            (DB.CMD_CONFIG, 0):             self._rxConfig,
+            (DB.CMD_GET, 0):                self._rxGet,
+            (DB.CMD_SET, 0):                self._rxSet,
+            (DB.CMD_DCMD, 0):               self._rxDcmd,
+        }
 
     def connection_made(self, transport):
         """Called when the connection is made."""
         self.transport = transport
         log(DB.LOG_INFO, f"Connection established on bus {self.busID}.")
+        self.txPeriodicStatus()     # program the periodic output status refresh of modules already known
 
     def connection_lost(self, exc):
         """Called when the connection is lost or closed."""
         log(DB.LOG_ERR, f"Connection lost on bus {self.busID}: {exc}")
         buses[self.busID]['protocol'] = None
+        if self.retryHandle:
+            self.retryHandle.cancel()
+            self.retryHandle = None
+        if self.lineHandle:
+            self.lineHandle.cancel()
+            self.lineHandle = None
+        if self.statusHandle:
+            self.statusHandle.cancel()
+            self.statusHandle = None
         
 
     def setID(self, port):
@@ -898,10 +1151,35 @@ class DomBusProtocol(asyncio.Protocol):
     def data_received(self, data):
         """Called when data is received from the serial port."""
         # log(DB.LOG_DEBUG, f"data_received(): received {len(data)} bytes")
-        self.buffer += data
-        self._process_buffer() # Frame check and create self.frame
+        if captureWriter:
+            captureWriter.write(self.busID, dbcap.DIR_RX, data)
+        self.rxBytes += len(data)
+        data = memoryview(data)
+        while len(data) > 0:
+            n = self._rxAppend(data)
+            data = data[n:]
+            self._process_buffer() # Frame check and pass frames to on_frame_received_callback()
         # log(DB.LOG_DEBUG, f"data_received: exit")
 
+    def _rxAppend(self, data):
+        """Copy data into the RX buffer, moving unparsed bytes at the beginning of the buffer if needed. Return the number of bytes copied"""
+        if self.rxStart == self.rxEnd:
+            # buffer empty: restart from the beginning
+            self.rxStart = self.rxEnd = 0
+        elif DB.RX_BUFFER_SIZE - self.rxEnd < len(data) and self.rxStart > 0:
+            # not enough space at the end of the buffer: move the pending bytes (less than a frame) to the beginning
+            pending = self.rxEnd - self.rxStart
+            self.rxView[:pending] = self.rxView[self.rxStart:self.rxEnd]
+            self.rxStart = 0
+            self.rxEnd = pending
+        if self.rxEnd == DB.RX_BUFFER_SIZE:
+            # buffer full of bytes that cannot be parsed: discard them
+            self.rxStart = self.rxEnd = 0
+        n = min(len(data), DB.RX_BUFFER_SIZE - self.rxEnd)
+        self.rxView[self.rxEnd:self.rxEnd+n] = data[:n]
+        self.rxEnd += n
+        return n
+
     def dumpRaw(self, frame: bytearray, frameLen: int, logLevel: int):
         """Display raw frame"""
         msg = ""
@@ -912,122 +1190,71 @@ class DomBusProtocol(asyncio.Protocol):
     def dump(self, frame, frameLen, direction, bus, frameError):
         """Dump frame: frameLen = total frame length"""
         logLevel = DB.LOG_DUMPRX if direction == 'RX' else DB.LOG_DUMPTX    # current type of frame: TX or RX?
-        if (debugLevel & DB.LOG_DUMPDCMD) or (debugLevel & logLevel):
-            _, dst, src = struct.unpack('>BHH', frame[:5])
+        if logEnabled(DB.LOG_DUMPDCMD) or logEnabled(logLevel):
+            _, dst, src, _ = codec.HEADER.unpack_from(frame)
             msg = f"{direction} B{bus} {src:04x} -> {dst:04x}"
-            i = DB.FRAME_HEADER
-            while i < frameLen-1:
-                if i+3 > frameLen:
-                    msg += " ERROR: cmd length does not fit in frame length"
+            for c in codec.iterCmds(frame, frameLen):
+                if c is None:
+                    msg += " ERROR: cmd length > frame length"
                     break
-                else:    
-                    cmd, port, arg = struct.unpack(">BBB", frame[i:i+3])
-                    cmdAck = DB.CMD_ACK if (cmd & DB.CMD_ACK) else 0
-                    cmdLen = (cmd & DB.CMD_LEN_MASK) * 2
-                    cmd &= DB.CMD_MASK
-                    msg += " "
-                    if cmdAck != 0:
-                        msg += "A-"
-                    if cmd == DB.CMD_CONFIG:
-                        msg += 'CFG '
-                        if cmdAck != 0 and port == 0xfe:
-                            # Module version and type
-                            msg += f'{port:02x} '
-                            for j in range (2, cmdLen+1):
-                                if frame[i+j] == 0:
-                                    break
-                                else:
-                                    msg += chr(frame[i+j])
-                            msg += ';'
-                            i += cmdLen + 1
-                            continue
-                        if cmdAck != 0 and (port & 0xf0) == 0xf0:
-                            # whole port configuration => cmdLen without any sense
-                            msg += f"{port:02x} {arg:x}"
-                            i += 3
-                            while i < frameLen-1:
-                                portType, portOpt = struct.unpack('>IH', frame[i:i+6])
-                                msg += f" {portType:x} {portOpt:x} "
-                                i += 6
-                                while i < frameLen-1 and frame[i] != 0:
-                                    msg += chr(frame[i])
-                                    i += 1
-                                msg += ';'
-                                i += 1
-                            log(DB.LOG_DUMPRX, msg)
-                            return
-
-                    elif cmd == DB.CMD_SET:
-                        msg += 'SET '
-                    elif cmd == DB.CMD_GET:
-                        msg += 'GET '
-                    elif cmd == DB.CMD_DCMD_CONFIG:
-                        msg += 'DCMDCFG '
-                        logLevel = DB.LOG_DUMPDCMD
-                    elif cmd==DB.CMD_DCMD:
-                        msg += 'DCMD '
-                        logLevel = DB.LOG_DUMPDCMD
-                    
-                    msg += f"P{port:02x} {arg:02x}"
-                    i += 1
-                    if i+cmdLen >= frameLen:
-                        msg += " ERROR: cmd length > frame length"
-                        break
-                    else:
-                        for j in range(2, cmdLen):
-                            msg += f" {frame[i + j]:02x}"
-                        i += cmdLen
-                    msg += ';'
+                msg += " "
+                if c.ack != 0:
+                    msg += "A-"
+                if c.cmd == DB.CMD_CONFIG:
+                    msg += 'CFG '
+                    if c.ack != 0 and c.port == 0xfe:
+                        # Module version and type
+                        msg += f'{c.port:02x} ' + bytes(c.args).split(b'\0', 1)[0].decode('latin-1') + ';'
+                        continue
+                    if c.ack != 0 and (c.port & 0xf0) == 0xf0:
+                        # whole port configuration
+                        msg += f"{c.port:02x} {c.args[0]:x}"
+                        i = 1
+                        while i + 6 <= len(c.args):
+                            portType, portOpt = struct.unpack_from('>IH', c.args, i)
+                            name = bytes(c.args[i+6:i+22]).split(b'\0', 1)[0]
+                            msg += f" {portType:x} {portOpt:x} {name.decode('latin-1')};"
+                            i += 7 + len(name)
+                        continue
+                elif c.cmd == DB.CMD_SET:
+                    msg += 'SET '
+                elif c.cmd == DB.CMD_GET:
+                    msg += 'GET '
+                elif c.cmd == DB.CMD_DCMD_CONFIG:
+                    msg += 'DCMDCFG '
+                    logLevel = DB.LOG_DUMPDCMD
+                elif c.cmd == DB.CMD_DCMD:
+                    msg += 'DCMD '
+                    logLevel = DB.LOG_DUMPDCMD
+                msg += f"P{c.port:02x} " + " ".join(f"{a:02x}" for a in c.args) + ";"
             if frameError == DB.FRAME_INVALID_CHECKSUM:
                 msg += ' INVALID CHECKSUM'
                 self.dumpRaw(frame, frameLen, logLevel)
             log(logLevel, msg)
 
-    def _checksum(self, buffer, frameLen):
-        """Compute checksum value for a frame"""
-        self.checksumValue=0
-        for i in range(0, frameLen-1):
-            self.checksumValue += buffer[i]
-        self.checksumValue &= 0xff
-
     def _process_buffer(self):
-        """Process the buffer to extract complete frames."""
-        while len(self.buffer) >= DB.FRAME_LEN_MIN:  # Minimum frame size (preamble + addresses + frameLen)
-            # Look for the preamble
-            if self.buffer[0] != DB.PREAMBLE:
-                # Remove the first byte, as it's not the start of a valid frame
-                self.buffer = self.buffer[1:]
-                continue
-
-            # Parse frame header (preamble, destination, source, frameLen)
-            if len(self.buffer) < DB.FRAME_LEN_MIN:
-                return  # Not enough data for the header
-
-            _, dst, src, frameLen = struct.unpack(">BHHB", self.buffer[:6])
-
-            # Ensure the full frame is available
-            frameLen += DB.FRAME_HEADER + 1  # total length = Header + payload + checksum
-            if len(self.buffer) < frameLen:
+        """Process the RX buffer to extract complete frames."""
+        while True:
+            self.rxStart, frameLen, dst, src = codec.nextFrame(self.rxBuffer, self.rxStart, self.rxEnd)
+            if frameLen == 0:
                 return  # Wait for more data
 
-            # Extract the frame
-            frame = self.buffer[:frameLen]
+            # Extract the frame, without copying it
+            frame = self.rxView[self.rxStart:self.rxStart+frameLen]
 
             # Verify checksum
-            self._checksum(frame, frameLen)
-            if self.checksumValue != int(frame[-1]):
-                # Checksum error => remove first byte and seek again the preamble
-                self.dump(self.buffer, frameLen, 'RX', self.busID, DB.FRAME_INVALID_CHECKSUM)
-                self.buffer = self.buffer[1:]
+            if codec.checksum(frame, frameLen) != frame[-1]:
+                # Checksum error => skip the preamble and seek again the next one
+                self.dump(frame, frameLen, 'RX', self.busID, DB.FRAME_INVALID_CHECKSUM)
+                self.rxStart += 1
                 continue
 
-            # Pass the frame to the callback
+            self.rxStart += frameLen  # Remove the frame from the buffer
+            self.replyUntil.pop((self.busID << 16) | src, None)   # the module has answered: frames to it can be transmitted
+            # Pass the frame to the callback: frame is a view of rxBuffer, valid only inside the callback
             self.on_frame_received_callback(
                 self.busID, dst, src, frameLen, frame
             )
-            self.send()
-            
-            self.buffer = self.buffer[frameLen:]  # Remove the frame from the buffer
 
     def on_frame_received_callback(self, busID, dst, src, frameLen, frame):
         self.busID = busID
@@ -1037,371 +1264,375 @@ class DomBusProtocol(asyncio.Protocol):
         if src == 0xffff:
             # broadcast
             log(DB.LOG_DEBUG, "Received a broadcast frame")
-        elif src == 0:
-            # broadcast
-            # TODO: remove comment log(DB.LOG_DEBUG, "Received a frame from another controller")
-            src = 0 # dummy instruction
 
         frameIdx = DB.FRAME_HEADER
         while frameIdx+3 < frameLen:
-            portIdx = frameIdx + 1
-            cmd, port, arg = struct.unpack(">BBB", frame[frameIdx:frameIdx+3])
-            cmdAck = DB.CMD_ACK if (cmd & DB.CMD_ACK) else 0
-            cmdLen = (cmd & DB.CMD_LEN_MASK) * 2
-            cmd &= DB.CMD_MASK
-            if cmd == DB.CMD_CONFIG and port != 0xfe and (port & 0xf0) == 0xf0:
-                cmdLen = 4 # cmdLen does not make sense in case of full port configuration
-            if frameLen < frameIdx + cmdLen + 1:
+            c = codec.decodeCmd(frame, frameIdx, frameLen)
+            if c is None:
                 # invalid cmdLen: 
-                log(DB.LOG_DEBUG, f"Invalid cmdLen={cmdLen}: ignore frame")
-                return
-            if cmdLen>=3:
-                arg2 = frame[portIdx+2]
-                if cmdLen >= 4:
-                    arg3 = frame[portIdx+3]
-                    if cmdLen >= 5:
-                        arg4 = frame[portIdx+4]
-                        if cmdLen >= 6:
-                            arg5 = frame[portIdx+5]
-                            if cmdLen >= 7:
-                                arg6 = frame[portIdx+6]
-                                if cmdLen >= 8:
-                                    arg7 = frame[portIdx+7]
-                                    if cmdLen >= 9:
-                                        arg8 = frame[portIdx+8]
-                                        if cmdLen >= 10:
-                                            arg9 = frame[portIdx+9]
-                                            if cmdLen >= 11:
-                                                arg10 = frame[portIdx+10]
-                                                if cmdLen >= 12:
-                                                    arg11 = frame[portIdx+11]
+                log(DB.LOG_DEBUG, "Invalid cmdLen=%d: ignore frame", (frame[frameIdx] & DB.CMD_LEN_MASK) * 2)
+                break
             if dst == 0:                                                    
                 # frame addressed to me: parse frame
-                self.setID(port)    # set self.devID and self.devIDname
+                self.setID(c.port)    # set self.devID and self.devIDname
                 self.moduleUpdate(1) # update modules dictionary to keep trace of running modules
                 # check if device exists
-                if cmdAck == 0 and self.devID not in Devices:
+                if c.ack == 0 and self.devID not in Devices:
                     # send frame to ask configuration
                     self.txQueueAskConfig(self.frameAddr)
+                elif c.ack != 0:
+                    # module already recognized, ACK received
+                    if self.devID in Devices:
+                        Devices[self.devID].updateFromBus(0)    # Only update lastUpdate
+                    self.txQueueRemove(self.frameAddr, c.cmd, c.port, c.args[0])  # Remove frame from TX queue
+                    handler = self.rxHandlers.get((c.cmd, c.ack))
+                    if handler:
+                        handler(c)
+                    # ACK was managed.
+                    # if more frames from frameAddr => program send()
+                    if self.frameAddr in self.txQueue and len(self.txQueue[self.frameAddr])>0:
+                        self.txKick()
+                elif src != 0xffff:
+                    #cmdAck==0 => decode command from slave module
+                    handler = self.rxHandlers.get((c.cmd, c.ack))
+                    if handler:
+                        handler(c)
+            elif c.cmd == DB.CMD_DCMD:
+                # frame not addressed to me
+                self._rxDcmdRoute(c, dst, src)
+            frameIdx += c.cmdLen + 1
+        if self.rxAcks:
+            self.txAcks()   # ACK immediately, within the module reply window
+        self.txKick()       # then transmit commands in queue, if any
+
+    def _rxConfigAck(self, c):
+        """Received ACK to a CMD_CONFIG: module version, or port configuration"""
+        if c.port == 0xfe:  # Version
+            if c.cmdLen >= 8:
+                strVersion = bytes(c.args[0:4]).decode()
+                strModule = bytes(c.args[4:c.cmdLen-2]).decode()
+                log(DB.LOG_INFO, f"Module {strModule} Rev.{strVersion} Bus={self.busID:02x} Addr={self.devAddr:04x}")
+                module = Modules[self.frameAddr]
+                if module[DB.LASTTYPE] != strModule or module[DB.LASTFW] != strVersion:
+                    # module name and version are in the discovery payload of each device
+                    for d in Devices.moduleDevices(self.frameAddr).values():
+                        d.configCache = None
+                module[DB.LASTTYPE] = strModule # Module type, example "DomBus31"
+                module[DB.LASTFW] = strVersion  # Module firmware version, example "02j1"
+                self.forceTxStatus()    # force transmit output status
+        elif (c.port & 0xf0) == 0xf0:   #0xff or 0xf0, 0xf1, 0xf2, ...0xfd
+            # c.args contains the rest of the frame: arg (DB.PORTTYPE_VERSION, to extend functionality in the future) followed by the ports configuration
+            args = c.args
+            if args[0] == 2:    # protocol = 2
+                if c.port == 0xff:    
+                    port = 1    # port was 0xff => start configuring port 1
+                    i = 1
                 else:
-                    # module already recognized
-                    if cmdAck != 0:
-                        # ACK received
-                        if self.devID in Devices:
-                            Devices[self.devID].updateFromBus(0)    # Only update lastUpdate
-                        self.txQueueRemove(self.frameAddr, cmd, port, arg)  # Remove frame from TX queue
-                        if cmd == DB.CMD_CONFIG:
-                            if port == 0xfe:  # Version
-                                if cmdLen >= 8:
-                                    strVersion = frame[portIdx+1:portIdx+5].decode()
-                                    strModule = frame[portIdx+5:portIdx+cmdLen-1].decode()
-                                    log(DB.LOG_INFO, f"Module {strModule} Rev.{strVersion} Bus={self.busID:02x} Addr={self.devAddr:04x}")
-                                    Modules[self.frameAddr][DB.LASTTYPE] = strModule # Module type, example "DomBus31"
-                                    Modules[self.frameAddr][DB.LASTFW] = strVersion  # Module firmware version, example "02j1"
-                                    self.forceTxStatus()    # force transmit output status
-                            elif (port & 0xf0) == 0xf0:   #0xff or 0xf0, 0xf1, 0xf2, ...0xfd
-                                #arg contains the DB.PORTTYPE_VERSION (to extend functionality in the future)
-                                frameIdx = portIdx + 2
-                                if arg == 2:    # protocol = 2
-                                    if port == 0xff:    
-                                        port = 1    # port was 0xff => start configuring port 1
-                                    else:
-                                        port = arg2   # arg2 set the starting port number (needed to configure dombus devices with several ports)
-                                        frameIdx += 1 # start from arg3
-
-                                    while frameIdx < frameLen-1: #scan all ports defined in the frame
-                                        self.setID(port)    # set self.devID and self.devIDname
-                                        portType, portOpt = struct.unpack(">IH", frame[frameIdx:frameIdx+6])
-                                        frameIdx += 6
-
-                                        portName = ""
-                                        for i in range(0,16): #get the name associated to the current port
-                                            ch = frame[frameIdx]
-                                            frameIdx += 1
-                                            if ch == 0:
-                                                break
-                                            else:
-                                                portName += chr(ch)
-
-                                        #check if this port device has been disabled
-                                        if (self.frameAddr not in portsDisabled) or (port not in portsDisabled[self.frameAddr]):
-                                            # this device has not been disabled
-                                            if self.devID not in Devices:
-                                                ha = dict()
-                                                options = dict()
-
-                                                ############################## New device, read from Bus => set default parameters ########################
-                                                if portType != DB.PORTTYPE_CUSTOM or portOpt >= 2:
-                                                    # do not enable CUSTOM device with DB.PORTOPT not specified (ignore it!)
-                                                    if portType == DB.PORTTYPE_CUSTOM:
-                                                        if portOpt == DB.PORTOPT_SELECT:
-                                                            ha['p'] = 'select'  # platform
-                                                            if "S.On" in portName:
-                                                                ha['options'] = ['Off', 'On']
-                                                            elif "S.State" in portName:
-                                                                ha['options'] = ['Off', 'On', 'HiCurr', 'LoVolt', 'HiDiss', 'HiDissLoVolt']
-                                                        elif portOpt==DB.PORTOPT_DIMMER:
-                                                            if 'EV Current' in portName:
-                                                                ha = {'p': 'number', 'min': 0, 'max': 36, 'step': 1, 'unit_of_measurement': 'A'}
-                                                            else:
-                                                                ha = {'p': 'number', 'min': 0, 'max':100, 'step':1, 'unit_of_measurement': '%'}
-                                                        elif portOpt==DB.PORTOPT_LATCHING_RELAY:
-                                                            ha['p'] = 'switch'
-                                                        elif portOpt==DB.PORTOPT_ADDRESS:
-                                                            ha['p'] = 'text'
-                                                        elif portOpt==DB.PORTOPT_IMPORT_ENERGY or portOpt==DB.PORTOPT_EXPORT_ENERGY:
-                                                            ha['p'] = 'sensor'
-                                                            ha['device_class'] = 'power'
-                                                            ha['state_class'] = 'measurement'
-                                                            ha['unit_of_measurement'] = 'W'
-                                                            ha['suggested_display_precision'] = 0
-                                                            if "Solar" in portName or "Exp" in portName or portOpt==DB.PORTOPT_EXPORT_ENERGY:
-                                                                ha['icon'] = 'mdi:solar-power'
-                                                        elif portOpt==DB.PORTOPT_VOLTAGE:
-                                                            ha['p'] = 'sensor'
-                                                            ha['device_class'] = 'voltage'
-                                                            ha['unit_of_measurement'] = 'V'
-                                                            ha['suggested_display_precision'] = 0
-                                                        elif portOpt==DB.PORTOPT_CURRENT:
-                                                            ha['p'] = 'sensor'
-                                                            ha['device_class'] = 'current'
-                                                            ha['unit_of_measurement'] = 'A'
-                                                        elif portOpt==DB.PORTOPT_POWER_FACTOR:
-                                                            options['A'] = 0.1
-                                                            ha['p'] = 'sensor'
-                                                            ha['device_class'] = 'power_factor'
-                                                            ha['unit_of_measurement'] = '%'
-                                                            ha['suggested_display_precision'] = 1
-                                                        elif portOpt==DB.PORTOPT_FREQUENCY:
-                                                            options['A'] = 0.01
-                                                            ha['p'] = 'sensor'
-                                                            ha['device_class'] = 'frequency'
-                                                            ha['unit_of_measurement'] = 'Hz'
-                                                            ha['suggested_display_precision'] = 2
-                                                        elif portOpt==DB.PORTOPT_TOUCH:
-                                                            ha['p'] = 'binary_sensor'
-                                                            ha['device_class'] = 'motion'
-                                                        if "EV State" in portName:
-                                                            ha['p'] = 'select'  # platform
-                                                            ha['options'] = ['Off', 'Dis', 'Con', 'Ch', 'Vent', 'AEV', 'APO', 'AW']
-                                                        elif "EV Mode" in portName:   #Off, Solar, 50%, 75%, 100%, Managed
-                                                            ha['p'] = 'select'  # platform
-                                                            ha['options'] = ['Off', 'Solar', '25%', '50%', '75%', '100%', 'Man']
-                                                            options['EVMAXCURRENT'] = 16
-                                                            options['EVMAXPOWER'] = 6000
-                                                            options['EVSTARTPOWER'] = 1200
-                                                            options['EVSTOPTIME'] = 90
-                                                            options['EVAUTOSTART'] = 1
-                                                            options['EVMAXPOWERTIME'] = 0
-                                                            options['EVMAXPOWER2'] = 0
-                                                            options['EVMAXPOWER2TIME'] = 0
-                                                            options['EVWAITTIME'] = 6
-                                                            options['EVMETERTYPE'] = 0
-                                                            options['EVMINVOLTAGE'] = 207
-                                                            options['EVMINCURRENT'] = 6
-                                                            options['EVSOLARGRIDPOWER'] = 0
-                                                            # Create virtual device EVMAXCURRENT, devID 0x104
-
-                                                            manager.parseConfiguration(self.devID+0x100, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x100:03x} EV MaxCurrent", {}, {'p': 'number', 'min': 0, 'max':36, 'step':1, 'unit_of_measurement': 'A'}, [], "", options['EVMAXCURRENT'])
-                                                            manager.parseConfiguration(self.devID+0x200, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x200:03x} EVMAXPOWER", {}, {'p': 'number', 'min': 1000, 'max':25000, 'step':100, 'unit_of_measurement': 'W'}, [], "", options['EVMAXPOWER'])
-                                                            manager.parseConfiguration(self.devID+0x300, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x300:03x} EVSTARTPOWER", {}, {'p': 'number', 'min': 800, 'max':25000, 'step':100, 'unit_of_measurement': 'W'}, [], "", options['EVSTARTPOWER'])
-                                                            manager.parseConfiguration(self.devID+0x400, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x400:03x} EVSTOPTIME", {}, {'p': 'number', 'min': 5, 'max':600, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVSTOPTIME'])
-                                                            manager.parseConfiguration(self.devID+0x500, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x500:03x} EVAUTOSTART", {}, {'p': 'number', 'min': 0, 'max':2, 'step':1, 'unit_of_measurement': ' '}, [], "", options['EVAUTOSTART'])
-                                                            manager.parseConfiguration(self.devID+0x600, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x600:03x} EVMAXPOWER2", {}, {'p': 'number', 'min': 0, 'max':25000, 'step':100, 'unit_of_measurement': 'W'}, [], "", options['EVMAXPOWER2'])
-                                                            manager.parseConfiguration(self.devID+0x700, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x700:03x} EVMAXPOWERTIME", {}, {'p': 'number', 'min': 0, 'max':43200, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVMAXPOWERTIME'])
-                                                            manager.parseConfiguration(self.devID+0x800, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x800:03x} EVMAXPOWER2TIME", {}, {'p': 'number', 'min': 0, 'max':43200, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVMAXPOWER2TIME'])
-                                                            manager.parseConfiguration(self.devID+0x900, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x900:03x} EVWAITTIME", {}, {'p': 'number', 'min': 3, 'max':60, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVWAITTIME'])
-                                                            manager.parseConfiguration(self.devID+0xa00, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0xa00:03x} EVMETERTYPE", {}, {'p': 'number', 'min': 0, 'max':3, 'step':1, 'unit_of_measurement': ' '}, [], "", options['EVMETERTYPE'])
-                                                            manager.parseConfiguration(self.devID+0x10A-4, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x106:03x} EV MinVoltage", {}, {'p': 'number', 'min': 180, 'max':450, 'step':1, 'unit_of_measurement': 'V'}, [], "", options['EVMINVOLTAGE'])
-                                                            manager.parseConfiguration(self.devID+0xb00, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0xb00:03x} EVMINCURRENT", {}, {'p': 'number', 'min': 3, 'max':16, 'step':1, 'unit_of_measurement': 'A'}, [], "", options['EVMINCURRENT'])
-                                                            manager.parseConfiguration(self.devID+0xc00, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0xc00:03x} EVSOLARGRIDPOWER", {}, {'p': 'number', 'min': -30000, 'max':30000, 'step':10, 'unit_of_measurement': 'W'}, [], "", options['EVSOLARGRIDPOWER'])
-                                                    elif portType == DB.PORTTYPE_IN_COUNTER:
-                                                        # counter or kWh ?
-                                                        # ha['device_class'] = 'energy'
-                                                        # ha['state_class'] = 'total_increasing'
-                                                        # ha['unit_of_measurement'] = 'kWh'
-                                                        options['DIVIDER'] = 2000   # Default: 1kW = 2000 pulses => 1 pulse = 0.0005Wh
-                                                    elif portType == DB.PORTTYPE_IN_ANALOG:
-                                                        # Analog input
-                                                        if port == 7 and (self.devAddr == 0xff51 or Modules[self.frameAddr][DB.LASTTYPE] == 'DomBusTH'):
-                                                            options['A'] = 0.000612695
-                                                            ha['suggested_display_precision'] = 2
-                                                                  
-                                                    manager.parseConfiguration(self.devID, portType, portOpt, f"P{port:02x} {portName}", options, ha)
-                                                    # log(DB.LOG_DEBUG, f"DomBusDevice({self.devID:08x}, {portType:x}, {portOpt:x}, P{port:02x} {portName}, {portConf}, {Options}, {ha})")
-                                                    # Devices[self.devID] = DomBusDevice(self.devID, portType, portOpt, f"P{port:02x} {portName}", portConf, Options, ha)
-                                                    # Devices[self.devID].updateFromBus(DB.UPDATE_VALUE | DB.UPDATE_CONFIG, 0)
-                                                    options.clear()
-                                                    ha.clear()
-
-                                        port+=1;
-                        elif cmd==DB.CMD_SET:
-                            # received a ACK to a SET command: check status
-                            if self.devID in Devices:
-                                # I sent a SET command, and received the ACK
-                                d = Devices[self.devID]
-                                if (d.portType & (DB.PORTTYPE_OUT_DIGITAL | DB.PORTTYPE_OUT_RELAY_LP | DB.PORTTYPE_OUT_DIMMER | DB.PORTTYPE_OUT_FLASH | DB.PORTTYPE_OUT_ANALOG)) or (d.portType == DB.PORTTYPE_CUSTOM and (d.portOpt==DB.PORTOPT_SELECT or d.portOpt == DB.PORTOPT_DIMMER)):
-                                    # Update device state taking ACK value (1 byte)
-                                    # UPDATE_ACK is also used to confirm a "set" command from HA:  HA sends a set command, and get back a state that confirm the new status
-                                    d.value = arg
-                                    d.value2valueHA()   # update valueHA 
-                                    # log(DB.LOG_DEBUG, f"Received SET+ACK: value={d.value} valueHA={d.valueHA}")
-                                    d.updateFromBus(DB.UPDATE_ACK, 0)
-                                # TODO: update value by using ACK also for other port types?
-                        # ACK was managed.
-                        # if more frames from frameAddr => program send()
-                        if self.frameAddr in self.txQueue and len(self.txQueue[self.frameAddr])>0:
-                            self.send()
+                    port = args[1]   # arg2 set the starting port number (needed to configure dombus devices with several ports)
+                    i = 2 # start from arg3
+
+                while i + 6 <= len(args): #scan all ports defined in the frame
+                    self.setID(port)    # set self.devID and self.devIDname
+                    portType, portOpt = struct.unpack_from(">IH", args, i)
+                    i += 6
+
+                    end = min(i + 16, len(args))   # get the name associated to the current port
+                    nameEnd = bytes(args[i:end]).find(0)
+                    if nameEnd < 0:
+                        nameEnd = end - i
+                    portName = bytes(args[i:i+nameEnd]).decode('latin-1')
+                    i += min(nameEnd + 1, end - i)
+
+                    #check if this port device has been disabled
+                    if (self.frameAddr not in portsDisabled) or (port not in portsDisabled[self.frameAddr]):
+                        # this device has not been disabled
+                        if self.devID not in Devices:
+                            self._newDeviceFromBus(port, portType, portOpt, portName)
+                    port += 1
+
+    def _newDeviceFromBus(self, port, portType, portOpt, portName):
+        """New port configuration received from the bus: set default parameters and create the device"""
+        ha = dict()
+        options = dict()
+
+        ############################## New device, read from Bus => set default parameters ########################
+        if portType != DB.PORTTYPE_CUSTOM or portOpt >= 2:
+            # do not enable CUSTOM device with DB.PORTOPT not specified (ignore it!)
+            if portType == DB.PORTTYPE_CUSTOM:
+                if portOpt == DB.PORTOPT_SELECT:
+                    ha['p'] = 'select'  # platform
+                    if "S.On" in portName:
+                        ha['options'] = ['Off', 'On']
+                    elif "S.State" in portName:
+                        ha['options'] = ['Off', 'On', 'HiCurr', 'LoVolt', 'HiDiss', 'HiDissLoVolt']
+                elif portOpt==DB.PORTOPT_DIMMER:
+                    if 'EV Current' in portName:
+                        ha = {'p': 'number', 'min': 0, 'max': 36, 'step': 1, 'unit_of_measurement': 'A'}
                     else:
-                        #cmdAck==0 => decode command from slave module
-                        if src != 0xffff and dst == 0:
-                            #Receive command from a slave module
-                            if cmd == DB.CMD_CONFIG:
-                                if (port&0xf0) == 0xe0: #send text to the log file: port incremented at each transmission
-                                    log(DB.LOG_INFO,f"Msg #{port&15} from {self.devIDname}: {frame[portIdx+1:portIdx+cmdLen].decode()}")
-                                    self.forceTxStatus() # force transmit output status
-                                    self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [arg], 1, 1)
-                            elif cmd == DB.CMD_GET:
-                                if port==0: #port==0 => request from module to get status of all output!  NOT USED by any module, actually
-                                    self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [arg], 1, 1)   #tx ack
-                                    self.forceTxStatus() # force transmit output status
-                                else: # port specified: return status for that port
-                                    if self.devID in Devices:
-                                        try:
-                                            value = int(Devices[self.devID].value) & 0xff    # TODO: manage counter, temperature, and other values 16-32bits
-                                        except Exception:
-                                            value = 0
-                                        self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [ value ], 1, 1)
-                            elif cmd == DB.CMD_SET:
-                                #digital or analog input changed?
-                                if self.devID not in Devices:
-                                    if self.frameAddr not in portsDisabled or port not in portsDisabled[self.frameAddr]:
-                                        #got a frame from a unknown device, that is not disabled => ask for configuration
-                                        #Log(LOG_DEBUG,"Device="+devID+" portsDisabled["+str(deviceAddr)+"]="+portsDisabled[deviceAddr]+" => Ask config")
-                                        txQueueAskConfig(self.frameAddr)
-                                    else:
-                                        # ports is disabled => send ACK anyway, to prevent useless retries
-                                        #Log(LOG_DEBUG,"Send ACK even if port "+str(port)+" is disabled")
-                                        self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [arg], 1, 1)
-                                else:
-                                    #got a frame from a well known device
-                                    d = Devices[self.devID]
-                                    counterValue = None   # used to pass a second parameter to updateFromBus() within a counter value or energy
-                                    if cmdLen == 2: # cmd, port, arg1
-                                        value = arg # 8bit value that have to be set
-                                        if d.portType == DB.PORTTYPE_SENSOR_ALARM:  # state: 0=closed, 1=open, 2=masked, 3=tampered, 4=shorted
-                                            counterValue = value    # 0 = closed, 1 = open, 2 = masked, 3 = tampered, 4 = shorted
-
-                                    elif cmdLen == 3 or cmdLen == 4:
-                                        value = arg*256 + arg2    # 16 bit value
-                                        if d.ha['p'] == 'sensor' and 'device_class' in d.ha:
-                                            if d.ha['device_class'] == 'temperature' and value != 0:
-                                                if 'FUNCTION' in d.options:
-                                                    Ro=10000.0  # 20230703: float (was int)
-                                                    To=25.0
-                                                    temp=0.0  #default temperature # 20230703: float (was int)
-                                                    if (d.options['FUNCTION']=='3950'):
-                                                        #value=0..65535
-                                                        beta=3950
-                                                        if value == 65535: value=65534  #Avoid division by zero
-                                                        r = value * Ro / (65535 - value)
-                                                        temp = math.log(r / Ro) / beta      # log(R/Ro) / beta
-                                                        temp += 1.0 / (To + 273.15)
-                                                        temp = (1.0 / temp) - 273.15
-                                                else:
-                                                    temp = value / 10.0 - 273.1
-                                                temp = round(temp, 2)
-                                                """
-                                                # compute the averaged temperature and save it in d.Options[]
-                                                if abs(d.lastValue - temp)<3:
-                                                    # compute the average value
-                                                    avg = (d.lastValue*7 + temp) / 8
-                                                else:
-                                                    avg = (d.lastValue*2 + temp) / 3
-                                                value = round(avg, 2)
-                                                """
-                                                value = round(d.avg.update(temp), 2)
-                                                log(DB.LOG_DEBUG, f"Avg={d.lastValue} Temp={temp} NewValue={value}")
-                                            elif d.ha['device_class'] == 'power':
-                                                # EV GRID, transmitting only power (not energy)
-                                                # check if value is negative
-                                                if (value&0x8000):
-                                                    value=value-65536   # negative power
-                                    elif cmdLen == 5 or cmdLen == 6:
-                                        value = arg*256 + arg2
-                                        value2 = arg3*256 + arg4
-                                        if d.portType == DB.PORTTYPE_IN_COUNTER:
-                                            counterValue = value2   # pass value and value2 to updateFromBus() that will compute the current power
-
-                                    
-                                    elif cmdLen == 7 or cmdLen == 8:
-                                        # transmitted power (int16) + energy (uint32)
-                                        value = arg*256 + arg2
-                                        value2 = (arg3<<24) + (arg4<<16) + (arg5<<8) + arg6
-                                        #kWh?
-                                        if d.portType == DB.PORTTYPE_CUSTOM and (d.portOpt == DB.PORTOPT_IMPORT_ENERGY or d.portOpt == DB.PORTOPT_EXPORT_ENERGY): #kWh
-                                            #value=Watt, signed
-                                            #value2=N*10Wh
-                                            if (value&0x8000):
-                                                value=value-65536   # negative power
-                                            if (value2 & 0x80000000):
-                                                value2 = value2 - 0x100000000   # negative energy
-                                            counterValue = value2 / 100     # value2 was in 10Wh unit => convert to kWh
-                                    # update device and send ack
-                                    self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [ arg ], 1, 1)
-                                    d.updateFromBus(DB.UPDATE_VALUE, value, counterValue) # Energy in Wh -> kWh
-                            elif cmd == DB.CMD_DCMD and arg<DB.DCMD_OUT_CMDS['MAX']: # DCMD command addressed to me? deactivate/activate/toggle a scene or group
-                                log(DB.LOG_INFO,f"Request to activate or deactivate scene/group with idx={port}")
-                                switchcmd=''    # TODO: manage scenes by DCMD
-                                if arg1==1:
-                                    switchcmd='Off'
-                                elif arg1==2:
-                                    switchcmd='On'
-                                elif arg1==3:
-                                    switchcmd='Toggle'
-                                """ TODO: activate scene on the controller
-                                # Domoticz
-                                if switchcmd!='':
-                                    PARAMS = {'type':'command', 'param':'switchscene', 'idx':str(port), 'switchcmd':switchcmd}
-                                    r=requests.get(url = JSONURL, params = PARAMS)
-                                    # data = r.json()
-                                """
-                                self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [arg], 1, 1)
+                        ha = {'p': 'number', 'min': 0, 'max':100, 'step':1, 'unit_of_measurement': '%'}
+                elif portOpt==DB.PORTOPT_LATCHING_RELAY:
+                    ha['p'] = 'switch'
+                elif portOpt==DB.PORTOPT_ADDRESS:
+                    ha['p'] = 'text'
+                elif portOpt==DB.PORTOPT_IMPORT_ENERGY or portOpt==DB.PORTOPT_EXPORT_ENERGY:
+                    ha['p'] = 'sensor'
+                    ha['device_class'] = 'power'
+                    ha['state_class'] = 'measurement'
+                    ha['unit_of_measurement'] = 'W'
+                    ha['suggested_display_precision'] = 0
+                    if "Solar" in portName or "Exp" in portName or portOpt==DB.PORTOPT_EXPORT_ENERGY:
+                        ha['icon'] = 'mdi:solar-power'
+                elif portOpt==DB.PORTOPT_VOLTAGE:
+                    ha['p'] = 'sensor'
+                    ha['device_class'] = 'voltage'
+                    ha['unit_of_measurement'] = 'V'
+                    ha['suggested_display_precision'] = 0
+                elif portOpt==DB.PORTOPT_CURRENT:
+                    ha['p'] = 'sensor'
+                    ha['device_class'] = 'current'
+                    ha['unit_of_measurement'] = 'A'
+                elif portOpt==DB.PORTOPT_POWER_FACTOR:
+                    options['A'] = 0.1
+                    ha['p'] = 'sensor'
+                    ha['device_class'] = 'power_factor'
+                    ha['unit_of_measurement'] = '%'
+                    ha['suggested_display_precision'] = 1
+                elif portOpt==DB.PORTOPT_FREQUENCY:
+                    options['A'] = 0.01
+                    ha['p'] = 'sensor'
+                    ha['device_class'] = 'frequency'
+                    ha['unit_of_measurement'] = 'Hz'
+                    ha['suggested_display_precision'] = 2
+                elif portOpt==DB.PORTOPT_TOUCH:
+                    ha['p'] = 'binary_sensor'
+                    ha['device_class'] = 'motion'
+                if "EV State" in portName:
+                    ha['p'] = 'select'  # platform
+                    ha['options'] = ['Off', 'Dis', 'Con', 'Ch', 'Vent', 'AEV', 'APO', 'AW']
+                elif "EV Mode" in portName:   #Off, Solar, 50%, 75%, 100%, Managed
+                    ha['p'] = 'select'  # platform
+                    ha['options'] = ['Off', 'Solar', '25%', '50%', '75%', '100%', 'Man']
+                    options['EVMAXCURRENT'] = 16
+                    options['EVMAXPOWER'] = 6000
+                    options['EVSTARTPOWER'] = 1200
+                    options['EVSTOPTIME'] = 90
+                    options['EVAUTOSTART'] = 1
+                    options['EVMAXPOWERTIME'] = 0
+                    options['EVMAXPOWER2'] = 0
+                    options['EVMAXPOWER2TIME'] = 0
+                    options['EVWAITTIME'] = 6
+                    options['EVMETERTYPE'] = 0
+                    options['EVMINVOLTAGE'] = 207
+                    options['EVMINCURRENT'] = 6
+                    options['EVSOLARGRIDPOWER'] = 0
+                    # Create virtual device EVMAXCURRENT, devID 0x104
+
+                    manager.parseConfiguration(self.devID+0x100, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x100:03x} EV MaxCurrent", {}, {'p': 'number', 'min': 0, 'max':36, 'step':1, 'unit_of_measurement': 'A'}, [], "", options['EVMAXCURRENT'])
+                    manager.parseConfiguration(self.devID+0x200, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x200:03x} EVMAXPOWER", {}, {'p': 'number', 'min': 1000, 'max':25000, 'step':100, 'unit_of_measurement': 'W'}, [], "", options['EVMAXPOWER'])
+                    manager.parseConfiguration(self.devID+0x300, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x300:03x} EVSTARTPOWER", {}, {'p': 'number', 'min': 800, 'max':25000, 'step':100, 'unit_of_measurement': 'W'}, [], "", options['EVSTARTPOWER'])
+                    manager.parseConfiguration(self.devID+0x400, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x400:03x} EVSTOPTIME", {}, {'p': 'number', 'min': 5, 'max':600, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVSTOPTIME'])
+                    manager.parseConfiguration(self.devID+0x500, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x500:03x} EVAUTOSTART", {}, {'p': 'number', 'min': 0, 'max':2, 'step':1, 'unit_of_measurement': ' '}, [], "", options['EVAUTOSTART'])
+                    manager.parseConfiguration(self.devID+0x600, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x600:03x} EVMAXPOWER2", {}, {'p': 'number', 'min': 0, 'max':25000, 'step':100, 'unit_of_measurement': 'W'}, [], "", options['EVMAXPOWER2'])
+                    manager.parseConfiguration(self.devID+0x700, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x700:03x} EVMAXPOWERTIME", {}, {'p': 'number', 'min': 0, 'max':43200, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVMAXPOWERTIME'])
+                    manager.parseConfiguration(self.devID+0x800, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x800:03x} EVMAXPOWER2TIME", {}, {'p': 'number', 'min': 0, 'max':43200, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVMAXPOWER2TIME'])
+                    manager.parseConfiguration(self.devID+0x900, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x900:03x} EVWAITTIME", {}, {'p': 'number', 'min': 3, 'max':60, 'step':1, 'unit_of_measurement': 's'}, [], "", options['EVWAITTIME'])
+                    manager.parseConfiguration(self.devID+0xa00, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0xa00:03x} EVMETERTYPE", {}, {'p': 'number', 'min': 0, 'max':3, 'step':1, 'unit_of_measurement': ' '}, [], "", options['EVMETERTYPE'])
+                    manager.parseConfiguration(self.devID+0x10A-4, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0x106:03x} EV MinVoltage", {}, {'p': 'number', 'min': 180, 'max':450, 'step':1, 'unit_of_measurement': 'V'}, [], "", options['EVMINVOLTAGE'])
+                    manager.parseConfiguration(self.devID+0xb00, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0xb00:03x} EVMINCURRENT", {}, {'p': 'number', 'min': 3, 'max':16, 'step':1, 'unit_of_measurement': 'A'}, [], "", options['EVMINCURRENT'])
+                    manager.parseConfiguration(self.devID+0xc00, DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, f"P{port+0xc00:03x} EVSOLARGRIDPOWER", {}, {'p': 'number', 'min': -30000, 'max':30000, 'step':10, 'unit_of_measurement': 'W'}, [], "", options['EVSOLARGRIDPOWER'])
+            elif portType == DB.PORTTYPE_IN_COUNTER:
+                # counter or kWh ?
+                # ha['device_class'] = 'energy'
+                # ha['state_class'] = 'total_increasing'
+                # ha['unit_of_measurement'] = 'kWh'
+                options['DIVIDER'] = 2000   # Default: 1kW = 2000 pulses => 1 pulse = 0.0005Wh
+            elif portType == DB.PORTTYPE_IN_ANALOG:
+                # Analog input
+                if port == 7 and (self.devAddr == 0xff51 or Modules[self.frameAddr][DB.LASTTYPE] == 'DomBusTH'):
+                    options['A'] = 0.000612695
+                    ha['suggested_display_precision'] = 2
+                          
+            manager.parseConfiguration(self.devID, portType, portOpt, f"P{port:02x} {portName}", options, ha)
+            # log(DB.LOG_DEBUG, f"DomBusDevice({self.devID:08x}, {portType:x}, {portOpt:x}, P{port:02x} {portName}, {portConf}, {Options}, {ha})")
+            # Devices[self.devID] = DomBusDevice(self.devID, portType, portOpt, f"P{port:02x} {portName}", portConf, Options, ha)
+            # Devices[self.devID].updateFromBus(DB.UPDATE_VALUE | DB.UPDATE_CONFIG, 0)
+            options.clear()
+            ha.clear()
+
+    def _rxSetAck(self, c):
+        """Received a ACK to a SET command: check status"""
+        if self.devID in Devices:
+            # I sent a SET command, and received the ACK
+            d = Devices[self.devID]
+            if (d.portType & (DB.PORTTYPE_OUT_DIGITAL | DB.PORTTYPE_OUT_RELAY_LP | DB.PORTTYPE_OUT_DIMMER | DB.PORTTYPE_OUT_FLASH | DB.PORTTYPE_OUT_ANALOG)) or (d.portType == DB.PORTTYPE_CUSTOM and (d.portOpt==DB.PORTOPT_SELECT or d.portOpt == DB.PORTOPT_DIMMER)):
+                # Update device state taking ACK value (1 byte)
+                # UPDATE_ACK is also used to confirm a "set" command from HA:  HA sends a set command, and get back a state that confirm the new status
+                if d.portType == DB.PORTTYPE_OUT_ANALOG:
+                    # 16 bit value (0-10.0V step 0.1V): arg1 is only the high byte => keep the value set by updateToBus(), unless the ACK contains both bytes
+                    if c.cmdLen >= 3:
+                        d.value = c.args[0]*256 + c.args[1]
+                else:
+                    d.value = c.args[0]
+                d.value2valueHA()   # update valueHA 
+                # log(DB.LOG_DEBUG, f"Received SET+ACK: value={d.value} valueHA={d.valueHA}")
+                d.updateFromBus(DB.UPDATE_ACK, 0)
+            # TODO: update value by using ACK also for other port types?
+
+    def _rxConfig(self, c):
+        """Received CMD_CONFIG from a slave module"""
+        if (c.port&0xf0) == 0xe0: #send text to the log file: port incremented at each transmission
+            log(DB.LOG_INFO,f"Msg #{c.port&15} from {self.devIDname}: {bytes(c.args).decode()}")
+            self.forceTxStatus() # force transmit output status
+            self.txAck(c.cmd, c.port, c.args[0])
+
+    def _rxGet(self, c):
+        """Received CMD_GET from a slave module"""
+        if c.port==0: #port==0 => request from module to get status of all output!  NOT USED by any module, actually
+            self.txAck(c.cmd, c.port, c.args[0])   #tx ack
+            self.forceTxStatus() # force transmit output status
+        else: # port specified: return status for that port
+            if self.devID in Devices:
+                try:
+                    value = int(Devices[self.devID].value) & 0xff    # TODO: manage counter, temperature, and other values 16-32bits
+                except Exception:
+                    value = 0
+                self.txAck(c.cmd, c.port, value)
+
+    def _rxSet(self, c):
+        """Received CMD_SET from a slave module: digital or analog input changed?"""
+        port = c.port
+        args = c.args
+        arg = args[0]
+        if self.devID not in Devices:
+            if self.frameAddr not in portsDisabled or port not in portsDisabled[self.frameAddr]:
+                #got a frame from a unknown device, that is not disabled => ask for configuration
+                self.txQueueAskConfig(self.frameAddr)
             else:
-                # frame not addressed to me
-                if cmd == DB.CMD_DCMD and src != 0 and src != 0xffff and dst != 0 and arg<DB.DCMD_OUT_CMDS['MAX']: #DCMD command addressed to another device
-                    log(DB.LOG_INFO,f"DCMD command from {src:04x} to {dst:04x}: port={port:02x} cmd={DB.DCMD_OUT_CMDS_Names[arg]} cmdLen={cmdLen}")
-                    if len(buses)>1 and ((self.busID << 16) + dst) not in Modules:
-                        # in case that more than 1 bus are attached and DCMD destination is not in the current bus, route frame to another bus
-                        for bus in buses:
-                            frameAddr = ((bus << 16) + dst)
-                            if bus != self.busID and frameAddr in Modules:
-                                # Frame must be transmitted to another bus => use the right class for txQueueAdd
-                                buses[bus]['protocol'].txQueueAdd(frameAddr + (self.busID << 40) + (src << 24), cmd, cmdLen, cmdAck, port, [arg] if cmdAck else [arg, arg2, arg3], 1, 1)   # frameAddr=(bus|src|busID|dst)
-                                buses[bus]['protocol'].send()   # start sending frame on the other bus
-                                
-                        
-            frameIdx = frameIdx + cmdLen + 1
-        self.send()
-
-                
-    def moduleUpdate(self, what: int = 0):
+                # ports is disabled => send ACK anyway, to prevent useless retries
+                self.txAck(c.cmd, port, arg)
+            return
+
+        #got a frame from a well known device
+        d = Devices[self.devID]
+        counterValue = None   # used to pass a second parameter to updateFromBus() within a counter value or energy
+        cmdLen = c.cmdLen
+        if cmdLen == 2: # cmd, port, arg1
+            value = arg # 8bit value that have to be set
+            if d.portType == DB.PORTTYPE_SENSOR_ALARM:  # state: 0=closed, 1=open, 2=masked, 3=tampered, 4=shorted
+                counterValue = value    # 0 = closed, 1 = open, 2 = masked, 3 = tampered, 4 = shorted
+
+        elif cmdLen == 3 or cmdLen == 4:
+            value = arg*256 + args[1]    # 16 bit value
+            if d.ha['p'] == 'sensor' and 'device_class' in d.ha:
+                if d.ha['device_class'] == 'temperature' and value != 0:
+                    if 'FUNCTION' in d.options:
+                        Ro=10000.0  # 20230703: float (was int)
+                        To=25.0
+                        temp=0.0  #default temperature # 20230703: float (was int)
+                        if (d.options['FUNCTION']=='3950'):
+                            #value=0..65535
+                            beta=3950
+                            if value == 65535: value=65534  #Avoid division by zero
+                            r = value * Ro / (65535 - value)
+                            temp = math.log(r / Ro) / beta      # log(R/Ro) / beta
+                            temp += 1.0 / (To + 273.15)
+                            temp = (1.0 / temp) - 273.15
+                    else:
+                        temp = value / 10.0 - 273.1
+                    temp = round(temp, 2)
+                    value = round(d.avg.update(temp), 2)
+                    log(DB.LOG_DEBUG, "Avg=%s Temp=%s NewValue=%s", d.lastValue, temp, value)
+                elif d.ha['device_class'] == 'power':
+                    # EV GRID, transmitting only power (not energy)
+                    # check if value is negative
+                    if (value&0x8000):
+                        value=value-65536   # negative power
+        elif cmdLen == 5 or cmdLen == 6:
+            value, value2 = struct.unpack_from(">HH", args)
+            if d.portType == DB.PORTTYPE_IN_COUNTER:
+                counterValue = value2   # pass value and value2 to updateFromBus() that will compute the current power
+
+        elif cmdLen == 7 or cmdLen == 8:
+            # transmitted power (int16) + energy (uint32)
+            value, value2 = struct.unpack_from(">HI", args)
+            #kWh?
+            if d.portType == DB.PORTTYPE_CUSTOM and (d.portOpt == DB.PORTOPT_IMPORT_ENERGY or d.portOpt == DB.PORTOPT_EXPORT_ENERGY): #kWh
+                #value=Watt, signed
+                #value2=N*10Wh
+                if (value&0x8000):
+                    value=value-65536   # negative power
+                if (value2 & 0x80000000):
+                    value2 = value2 - 0x100000000   # negative energy
+                counterValue = value2 / 100     # value2 was in 10Wh unit => convert to kWh
+        else:
+            value = arg
+        # update device and send ack
+        self.txAck(c.cmd, port, arg)
+        d.updateFromBus(DB.UPDATE_VALUE, value, counterValue) # Energy in Wh -> kWh
+
+    def _rxDcmd(self, c):
+        """DCMD command addressed to me? deactivate/activate/toggle a scene or group"""
+        arg = c.args[0]
+        if arg<DB.DCMD_OUT_CMDS['MAX']:
+            log(DB.LOG_INFO,f"Request to activate or deactivate scene/group with idx={c.port}")
+            switchcmd=''    # TODO: manage scenes by DCMD
+            if arg==1:
+                switchcmd='Off'
+            elif arg==2:
+                switchcmd='On'
+            elif arg==3:
+                switchcmd='Toggle'
+            """ TODO: activate scene on the controller
+            # Domoticz
+            if switchcmd!='':
+                PARAMS = {'type':'command', 'param':'switchscene', 'idx':str(port), 'switchcmd':switchcmd}
+                r=requests.get(url = JSONURL, params = PARAMS)
+                # data = r.json()
+            """
+            self.txAck(c.cmd, c.port, arg)
+
+    def _rxDcmdRoute(self, c, dst, src):
+        """DCMD command not addressed to me: route it to another bus, if destination module is attached there"""
+        arg = c.args[0]
+        if src != 0 and src != 0xffff and arg<DB.DCMD_OUT_CMDS['MAX']: #DCMD command addressed to another device
+            log(DB.LOG_INFO,f"DCMD command from {src:04x} to {dst:04x}: port={c.port:02x} cmd={DB.DCMD_OUT_CMDS_Names[arg]} cmdLen={c.cmdLen}")
+            dstBuses = Modules.addrBuses(dst)   # routing table: buses where the destination module is attached
+            if dstBuses and self.busID not in dstBuses:
+                # DCMD destination is not in the current bus: route frame to another bus
+                for bus in dstBuses:
+                    protocol = buses[bus].get('protocol') if bus in buses else None
+                    if protocol:
+                        # Frame must be transmitted to another bus => use the right class for txQueueAdd
+                        frameAddr = ((bus << 16) + dst)
+                        protocol.txQueueAdd(frameAddr + (self.busID << 40) + (src << 24), c.cmd, c.cmdLen, c.ack, c.port, list(c.args), 1, 1)   # frameAddr=(bus|src|busID|dst)
+                        stats = protocol.routeStats.get((self.busID, dst))
+                        if stats is None:
+                            stats = protocol.routeStats[(self.busID, dst)] = RouteStats()
+                        stats.routed(self.loop.time())
+                        protocol.txKick()   # start sending frame on the other bus
+
+    def moduleUpdate(self, what: int = 0, frameAddr: int = None):
         """
-            Update Modules[self.devID], used to store which Modules have been RXed
+            Update Modules[frameAddr] (default: self.frameAddr, the module that sent the last RX frame), used to store which Modules have been RXed
             moduleUpdate(1) when a packet is RXed
-            moduleUpdate(2) when a packet is being TXed
+            moduleUpdate(2, frameAddr) when a packet is being TXed
         """
         global saveDataTimeout
 
-        if self.frameAddr not in Modules:
-            Modules[self.frameAddr] = [0, 0, int(time.time())+3-DB.PERIODIC_STATUS_INTERVAL, 0, '', '']
+        if frameAddr is None:
+            frameAddr = self.frameAddr
+        if frameAddr not in Modules:
+            Modules[frameAddr] = [0, 0, int(time.time())+3-DB.PERIODIC_STATUS_INTERVAL, 0, '', '']
+            heapq.heappush(self.statusHeap, (Modules[frameAddr][DB.LASTSTATUS], frameAddr))
+            self.statusModules.add(frameAddr)
+            self.txPeriodicStatus()
             setSaveDataTimeout()
             
         if what & 1: # RX packet
-            Modules[self.frameAddr][DB.LASTRX] = time.time()
+            Modules[frameAddr][DB.LASTRX] = time.time()
 
         if what & 2:  # TX packet
-            Modules[self.frameAddr][DB.LASTTX] = int(time.time()*1000)
+            Modules[frameAddr][DB.LASTTX] = int(time.time()*1000)
 
         if saveDataTimeout != 0 and datetime.datetime.now() > saveDataTimeout:
             # Must save Modules and Devices structures on filesystem
@@ -1410,41 +1641,29 @@ class DomBusProtocol(asyncio.Protocol):
 
     def txQueueAddConfig16(self, frameAddr, port, subcmd, value):
         """Send a CMD_CONFIG with a SUBCMD and 16bit value"""
-        log(DB.LOG_DEBUG,f"Calling txQueueAdd({self.frameAddr:06x}, {DB.CMD_CONFIG}, 4, 0, {port}, [{subcmd}, {((value>>8)&0xff)}, {(value&0xff)}], DB.TX_RETRY, 1)")
+        log(DB.LOG_DEBUG, "Calling txQueueAdd(%06x, %d, 4, 0, %d, [%d, %d, %d], DB.TX_RETRY, 1)", frameAddr, DB.CMD_CONFIG, port, subcmd, (value>>8)&0xff, value&0xff)
         self.txQueueAdd(frameAddr, DB.CMD_CONFIG, 4, 0, port, [subcmd, ((value>>8)&0xff), (value&0xff)], DB.TX_RETRY, 1)
 
-    def txQueueAdd(self, frameAddr, cmd, cmdLen, cmdAck, port, args, retries, now):
+    def txQueueAdd(self, frameAddr, cmd, cmdLen, cmdAck, port, args, retries, now, priority = None):
         # add a command in the tx queue for the specified module (frameAddr)
         # frameAddr may be srcbus|src|dstbus|dst  (48bit) in case that a DCMD command must be transmitted from one bus to another one
         # if that command already exists, update it
         # cmdLen=length of data after command (port+args[])
-        sec=int(time.time())
-        ms=int(time.time()*1000)
-        self.moduleUpdate(2) # Update Modules[frameAddr]
-        if len(self.txQueue)==0 or frameAddr not in self.txQueue:
+        # priority=DB.TXPRIO_*: if None, it's computed from cmdAck and cmd
+        if priority is None:
+            priority = DB.TXPRIO_ACK if cmdAck else (DB.TXPRIO_CONFIG if cmd in (DB.CMD_CONFIG, DB.CMD_DCMD_CONFIG) else DB.TXPRIO_CMD)
+        self.moduleUpdate(2, frameAddr & 0xffffff) # Update Modules[frameAddr]: not the module of the last RX frame
+        queue = self.txQueue.get(frameAddr)
+        if queue is None:
             #create self.txQueue[frameAddr]
-            self.txQueue[frameAddr]=[[cmd, cmdLen, cmdAck, port, args, retries]]
+            queue = self.txQueue[frameAddr] = TxQueue()
             # log(DB.LOG_DEBUG, f"txQueueAdd(): frameAddr does not exist! frameAddr={frameAddr:06x} cmd={cmd:02x} ack={cmdAck} len={cmdLen} port={port:02x}")
             Modules[frameAddr&0xffffff][DB.LASTRETRY] = 0 # Init retry value for this module (no frames were in the queue)
-        else:
-            found=0
-            for f in self.txQueue[frameAddr]:
-                #f=[cmd,cmdlen,cmdAck,port,args[]]
-                if (f[DB.TXQ_CMD]==cmd and f[DB.TXQ_CMDLEN]==cmdLen and f[DB.TXQ_PORT]==port and (cmd!=DB.CMD_CONFIG or len(args)==0 or args[0]==f[DB.TXQ_ARGS][0])): #if CMD_CONFIG, also check that SUBCMD is the same
-                    #command already in txQueue: update values
-                    # log(DB.LOG_DEBUG, f"txQueueAdd(): frame already exist: frameAddr={frameAddr:06x} cmd={cmd:02x} ack={cmdAck} len={cmdLen} port={port:02x}")
-                    f[DB.TXQ_CMDACK]=cmdAck
-                    f[DB.TXQ_ARGS]=args
-                    if (f[DB.TXQ_RETRIES]<retries):
-                        f[DB.TXQ_RETRIES]=retries
-                    found=1
-                    break
-            if (found==0):
-                self.txQueue[frameAddr].append([cmd,cmdLen,cmdAck,port,args,retries])
-                # log(DB.LOG_DEBUG, f"txQueueAdd(): add frame to the queue: frameAddr={frameAddr:06x} cmd={cmd:02x} ack={cmdAck} len={cmdLen} port={port:02x}")
-            #txQueueRetry: don't modify it... transmit when retry time expires (maybe now or soon)
+        queue.add(cmd, cmdLen, cmdAck, port, args, retries, priority)    # if command already in queue, update values
+        #txQueueRetry: don't modify it... transmit when retry time expires (maybe now or soon)
         if now:
             Modules[frameAddr&0xffffff][DB.LASTTX] = 0 # Transmit now
+        self.txSchedule(frameAddr)
 
     def txQueueAskConfig(self, frameAddr):
         self.txQueueAdd(frameAddr, DB.CMD_CONFIG, 1, 0, 0xff, [], DB.TX_RETRY, 1)    #port=0xff to ask full configuration 
@@ -1452,124 +1671,271 @@ class DomBusProtocol(asyncio.Protocol):
     def txQueueRemove(self, frameAddr,cmd,port,arg1):
         # if self.txQueue[frameAddr] esists, remove cmd and port from it.
         # if cmd==255 and port==255 => remove all frames for module frameAddr
-        removeItems=[]
-        if len(self.txQueue)!=0 and frameAddr in self.txQueue:
-            for f in self.txQueue[frameAddr][:]:
-                #Log(LOG_DEBUG,"f="+str(f))
-                #f=[cmd,cmdlen,cmdAck,port,args[],retries]
-                if ((cmd&port)==255) or (f[DB.TXQ_CMD]==cmd and f[DB.TXQ_PORT]==port and (len(f[DB.TXQ_ARGS])==0 or f[DB.TXQ_ARGS][0]==arg1)) and f[DB.TXQ_RETRIES]!=DB.TX_RETRY:
-                    # log(DB.LOG_DEBUG, f"txQueueRemove(): remove frame from the queue: frameAddr={frameAddr:06x} cmd={cmd:02x} port={port:02x} arg1={arg1:02x}")
-                    self.txQueue[frameAddr].remove(f)
+        queue = self.txQueue.get(frameAddr)
+        if queue is not None:
+            if (cmd&port)==255:
+                queue.clear()
+            else:
+                txq = queue.ack(cmd, port, arg1)
+                if txq is not None:
+                    if txq.txCount == 1:
+                        # Karn's rule: RTT is measured only for commands transmitted once (ACK to a retransmission is ambiguous)
+                        if frameAddr not in self.rtt:
+                            self.rtt[frameAddr] = RttEstimator()
+                        self.rtt[frameAddr].update(int(time.time()*1000) - txq.txTime)
+                    if (frameAddr & 0xffffff) in Modules:
+                        Modules[frameAddr & 0xffffff][DB.LASTRETRY] = 0    # module is answering: reset backoff
+                        if queue.unsent():
+                            # commands that did not fit in the previous frame: transmit them now, without waiting for the retry time
+                            Modules[frameAddr & 0xffffff][DB.LASTTX] = 0
+            self.txSchedule(frameAddr)
+
+    def txBusy(self, frameAddr, port):
+        """
+            Return True if a command to port (device port, also 0x100-0xfff for CONFIG16 parameters) is waiting in txQueue for the ACK
+            Periodic status entries (TXPRIO_STATUS) are ignored: a new command replaces them in txQueueAdd()
+        """
+        queue = self.txQueue.get(frameAddr)
+        if queue is None:
+            return False
+        if port < 0x80:
+            txq = queue.entries.get((DB.CMD_SET, port, None))
+        else:
+            txq = queue.entries.get((DB.CMD_CONFIG, port & 0x7f, port >> 8))
+        return txq is not None and txq.priority < DB.TXPRIO_STATUS
+
+    def txAck(self, cmd, port, arg):
+        """ACK a command received from the module: ACKs are transmitted at the end of the received frame, without using txQueue"""
+        self.rxAcks.append((cmd, port, arg))
+
+    def txAcks(self):
+        """Transmit a frame with the ACKs to commands in the received frame"""
+        txFrame = self.txFrame
+        txFrame.begin(self.devAddr, 0)
+        for cmd, port, arg in self.rxAcks:
+            if not txFrame.add(cmd, DB.CMD_ACK, 2, port, (arg,)):
+                # frame is full: this ACK will be transmitted by send()
+                self.txQueueAdd(self.frameAddr, cmd, 2, DB.CMD_ACK, port, [arg], 1, 1)
+        self.rxAcks.clear()
+        if txFrame.empty():
+            return
+        frame = txFrame.finish()
+        self.txWrite(frame)
+        self.dump(frame, len(frame), "TX", self.busID, DB.FRAME_OK)
+
+    def txWrite(self, frame, replyFrom: int = None):
+        """Write frame to the bus, and compute when the line will be free. replyFrom = frameAddr of the module that must answer, if any"""
+        self.transport.write(bytes(frame))  # copy: the transport may keep a reference to the data while the frame buffer is reused
+        if captureWriter:
+            captureWriter.write(self.busID, dbcap.DIR_TX, frame)
+        self.txBytes += len(frame)
+        self.lineBusyUntil = max(self.loop.time(), self.lineBusyUntil) + len(frame) * self.byteTime
+        if replyFrom is not None:
+            self.replyUntil[replyFrom & 0xffffff] = self.lineBusyUntil + DB.BUS_REPLY_TIME / 1000
+
+    def lineWait(self, when: float):
+        """Call send() at loop time when (a module that must answer becomes free)"""
+        if self.lineHandle is not None and self.lineHandle.when() > when:
+            self.lineHandle.cancel()
+            self.lineHandle = None
+        if self.lineHandle is None:
+            self.lineHandle = self.loop.call_at(when, self._lineFree)
+
+    def _lineFree(self):
+        self.lineHandle = None
+        self.send()
+
+    def busUtilization(self):
+        """Return (TX, RX) percentage of time the bus has been used since the connection"""
+        elapsed = self.loop.time() - self.statsTime
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return self.txBytes * self.byteTime * 100 / elapsed, self.rxBytes * self.byteTime * 100 / elapsed
+
+    def txTime(self, frameAddr, module):
+        """Return the time (ms since Epoch) when the next frame can be transmitted to module, 0 = now"""
+        if module[DB.LASTTX] == 0:
+            return 0
+        rtt = self.rtt.get(frameAddr & 0xffffff)
+        rto = int(rtt.rto) if rtt else DB.TX_RTO_INIT
+        # exponential backoff: LASTRETRY is the number of frames transmitted since the last ACK
+        return module[DB.LASTTX] + min(rto << max(min(module[DB.LASTRETRY], DB.TX_RETRY) - 1, 0), DB.TX_RETRY_TIME_MAX)
+
+    def txSchedule(self, frameAddr):
+        """Push frameAddr in txHeap with its next TX time and priority, or remove it from txQueue if nothing has to be transmitted"""
+        queue = self.txQueue.get(frameAddr)
+        module = Modules.get(frameAddr & 0xffffff)
+        if not queue or module is None:
+            # idle module: remove it from txQueue and txHeap (the heap entry become stale)
+            self.txQueue.pop(frameAddr, None)
+            self.txScheduled.pop(frameAddr, None)
+            return
+        txTime = self.txTime(frameAddr, module)
+        priority = queue.priority()
+        scheduled = self.txScheduled.get(frameAddr)
+        if scheduled and scheduled[0] == txTime and scheduled[1] == priority:
+            return  # already in txHeap
+        self.txSeq += 1
+        self.txScheduled[frameAddr] = (txTime, priority, self.txSeq)
+        heapq.heappush(self.txHeap, (txTime, priority, self.txSeq, frameAddr))
 
 
     def forceTxStatus(self):
         """force transmit output status"""
         if self.frameAddr in Modules:
             Modules[self.frameAddr][DB.LASTSTATUS] = 0    #force transmit output status
+            heapq.heappush(self.statusHeap, (0, self.frameAddr))
+            self.statusModules.add(self.frameAddr)
+            self.txPeriodicStatus()
 
     def txOutputsStatus(self, frameAddr):
-        # transmit the status of outputs for the device frameAddr
-        for dev in Devices:
-            # dev = 0xBBff51PP where BB=bus number and PP=port number;   frameAddr=0xBBff51
-            if (dev >> 8) == frameAddr:
-                d=Devices[dev]
-                # check that this is an output
-                if d.portType & (DB.PORTTYPE_OUT_DIGITAL | DB.PORTTYPE_OUT_RELAY_LP | DB.PORTTYPE_OUT_DIMMER | DB.PORTTYPE_OUT_FLASH | DB.PORTTYPE_OUT_BUZZER | DB.PORTTYPE_OUT_ANALOG):
-                    # output! get the port and output state
-                    log(DB.LOG_INFO, f"Send periodic status: device={d.devIDname} value={d.value}")
-                    #TODO: enable! self.txQueueAdd(frameAddr, DB.CMD_SET, 2, 0, d.port, [d.value], DB.TX_RETRY, 1)
+        """Queue the status of outputs for the module frameAddr, with low priority. Return the number of queued commands"""
+        n = 0
+        for d in Devices.moduleDevices(frameAddr).values():
+            # check that this is an output
+            if d.port < 0x80 and d.portType & (DB.PORTTYPE_OUT_DIGITAL | DB.PORTTYPE_OUT_RELAY_LP | DB.PORTTYPE_OUT_DIMMER | DB.PORTTYPE_OUT_FLASH | DB.PORTTYPE_OUT_BUZZER | DB.PORTTYPE_OUT_ANALOG):
+                if self.txBusy(frameAddr, d.port):
+                    continue    # a command for this port is already in queue: do not overwrite it with the old value
+                # output! get the port and output state
+                try:
+                    value = int(d.value)
+                except (TypeError, ValueError):
+                    log(DB.LOG_WARN, "Periodic status: invalid value %r for device %s", d.value, d.devIDname)
+                    continue
+                log(DB.LOG_DEBUG, "Send periodic status: device=%s value=%s", d.devIDname, value)
+                if d.portType == DB.PORTTYPE_OUT_ANALOG:
+                    self.txQueueAdd(frameAddr, DB.CMD_SET, 4, 0, d.port, [(value>>8)&0xff, value&0xff, 0], 1, 0, DB.TXPRIO_STATUS)
+                else:
+                    self.txQueueAdd(frameAddr, DB.CMD_SET, 2, 0, d.port, [value&0xff], 1, 0, DB.TXPRIO_STATUS)
+                n += 1
+        return n
+
+    def txPeriodicStatus(self):
+        """
+            Queue the outputs status of modules whose last refresh is older than PERIODIC_STATUS_INTERVAL
+            Refreshes are spread over PERIODIC_STATUS_INTERVAL, with max PERIODIC_STATUS_RATE frames/s on this bus
+            Modules that have not been received for MODULE_ALIVE_TIME are skipped
+        """
+        # statusHeap[0] is the module of this bus that I sent the output status earlier (entries not matching Modules[][LASTSTATUS] are stale)
+        statusHeap = self.statusHeap
+        now = self.loop.time()
+        sec = int(time.time())
+        # time between two refreshes: forced refreshes (LASTSTATUS=0) are limited only by PERIODIC_STATUS_RATE
+        minGap = 1 / DB.PERIODIC_STATUS_RATE
+        gap = max(minGap, DB.PERIODIC_STATUS_INTERVAL / max(len(self.statusModules), 1))
+        nextTime = 0.0
+        while statusHeap:
+            olderTime, olderFrameAddr = statusHeap[0]
+            module = Modules.get(olderFrameAddr)
+            if module is None or module[DB.LASTSTATUS] != olderTime:
+                heapq.heappop(statusHeap)   # stale entry
+                if module is None:
+                    self.statusModules.discard(olderFrameAddr)
+                continue
+            dueTime = now + olderTime + DB.PERIODIC_STATUS_INTERVAL - sec   # loop time when the refresh is due
+            nextTime = max(dueTime, self.statusLastTime + (gap if olderTime else minGap))
+            if nextTime > now:
+                break
+            module[DB.LASTSTATUS] = sec
+            heapq.heapreplace(statusHeap, (sec, olderFrameAddr))
+            nextTime = 0.0
+            if sec - module[DB.LASTRX] > DB.MODULE_ALIVE_TIME:
+                continue    # module not alive: check again at the next interval
+            if self.txOutputsStatus(olderFrameAddr):
+                self.statusLastTime = now
+                self.txKick()
+        if statusHeap and nextTime == 0.0:
+            # compute the time of the next refresh
+            olderTime = statusHeap[0][0]
+            nextTime = max(now + olderTime + DB.PERIODIC_STATUS_INTERVAL - sec, self.statusLastTime + (gap if olderTime else minGap))
+        if nextTime != self.statusTime:
+            # program the timer for the next refresh
+            if self.statusHandle:
+                self.statusHandle.cancel()
+                self.statusHandle = None
+            self.statusTime = nextTime
+            if nextTime:
+                self.statusHandle = self.loop.call_at(nextTime, self._statusExpired)
+
+    def _statusExpired(self):
+        self.statusHandle = None
+        self.statusTime = 0.0
+        self.txPeriodicStatus()
 
     def send(self):
-        """Read txQueue[] and create frames, one for each address, and start transmitting"""
-        # txQueue[frameAddr]=[[cmd, cmdLen, cmdAck, port, [arg1, arg2, arg3, ...], retries]]
+        """Transmit up to TX_FRAMES_MAX frames to each module whose TX time has expired, in order of TX time and priority, then program the next transmission"""
+        # txQueue[frameAddr]=TxQueue of TxEntry(cmd, cmdLen, cmdAck, port, [arg1, arg2, arg3, ...], retries, priority)
         # frameAddr normally is 010004  (module addr 4, busID 1)
         # but may be something like 021201010004 (packet from address 1201 of bus 2 to 0004 of bus 1    
+        # txHeap contains the next TX time for each frameAddr in txQueue (modules with nothing to transmit are not in txHeap)
+        # Modules that must still answer the previous frame (replyUntil) are skipped: frames to the other modules are transmitted in the meantime
 
-        timeNextTx = 0  # next transmission time (since Epoch), in ms            
-        tx = 0
-        sec = int(time.time())
         ms = int(time.time() * 1000)
-
-        for frameAddr in self.txQueue:
-            if len(self.txQueue[frameAddr])>0:
-                module = Modules[frameAddr & 0xffffff]
-                # timeSinceLastTx = ms-module[DB.LASTTX]        #number of milliseconds since last TXed frame
-                # timeLastTx = module[DB.LASTTX]
-                module[DB.LASTRETRY]                         #number of retry (0,1,2,3...): used to compute the retry period
-                if module[DB.LASTRETRY] > DB.TX_RETRY:
-                    module[DB.LASTRETRY] = DB.TX_RETRY
-                timeNextRetry = module[DB.LASTTX] + (DB.TX_RETRY_TIME << (module[DB.LASTRETRY]+1)) # time for the next transmission, for this module
-                if timeNextRetry <= ms:
-                    # Must transmit now
-                    tx=1
-                    self.txbuffer = bytearray()
-                    self.txbuffer.append(DB.PREAMBLE)
-                    self.txbuffer.append((frameAddr >> 8) & 0xff)       #dstAddr
-                    self.txbuffer.append(frameAddr & 0xff)
-                    self.txbuffer.append((frameAddr >> 32) & 0xff)      #master address or src address (DCMD)
-                    self.txbuffer.append((frameAddr >> 24) & 0xff)
-                    self.txbuffer.append(0)                  #length
-                    txbufferIndex=DB.FRAME_HEADER
-                    # transmit ACK first: build a new queue with all ACK and commands for the selected module frameAddr
-                    txQueueNow = []
-                    # Transmit ACK first, then commands
-                    for txq in self.txQueue[frameAddr][:]:    #iterate a copy of self.txQueue[frameAddr]
-                        (cmd, cmdLen, cmdAck, port, args, retry) = txq
-                        if cmdAck != 0:
-                            # ACK transmitted first
-                            txQueueNow.append(txq)
-                    for txq in self.txQueue[frameAddr][:]:    #iterate a copy of txQueue[frameAddr]
-                        (cmd, cmdLen, cmdAck, port, args, retry) = txq
-                        if cmdAck==0: 
-                            # Command to be transmitted
-                            txQueueNow.append(txq)
-
-                    for txq in txQueueNow:    #iterate txQueueNow
-                        #[cmd,cmdLen,cmdAck,port,[*args]]
-                        (cmd, cmdLen, cmdAck, port, args, retry) = txq
-                        if (txbufferIndex+cmdLen+2>=DB.FRAME_LEN_MAX):
-                            #frame must be truncate (TX fifo is full)
-                            # if other frame exists, send() must be invoked at the receiving of the ACK
-                            break
-                        self.txbuffer.append((cmd | cmdAck | int((cmdLen+1) / 2)))   #cmdLen field is the number of cmd payload/2, so if after cmd there are 3 or 4 bytes, cmdLen field must be 2 (corresponding to 4 bytes)
-                        txbufferIndex += 1
-                        self.txbuffer.append(port & 0xff)
-                        txbufferIndex += 1
-                        for i in range(0, cmdLen-1):
-                            self.txbuffer.append((args[i]&0xff))
-                            txbufferIndex+=1
-
-                        if (cmdLen&1):  #cmdLen is odd => add a dummy byte to get even cmdLen
-                            self.txbuffer.append(0)
-                            txbufferIndex+=1
-
-                        # if this cmd is an ACK, or values[0]==1, remove command from the queue
-                        if (cmdAck != 0 or retry<=1):
-                            self.txQueue[frameAddr].remove(txq)
-                        else:
-                            txq[DB.TXQ_RETRIES] = retry-1   #command, no ack: decrement retry
-                            # set time for the next retransmission
-                            if timeNextTx == 0 or timeNextTx < (ms + DB.TX_RETRY_TIME << (module[DB.LASTRETRY]+1)):
-                                timeNextTx = ms + (DB.TX_RETRY_TIME << (module[DB.LASTRETRY]+1))
-
-                    self.txbuffer[DB.FRAME_LEN] = txbufferIndex - DB.FRAME_HEADER
+        now = self.loop.time()
+        waiting = []    # modules skipped because they are processing the previous frame
+
+        txHeap = self.txHeap
+        while txHeap and txHeap[0][0] <= ms:
+            txTime, priority, seq, frameAddr = heapq.heappop(txHeap)
+            if self.txScheduled.get(frameAddr) != (txTime, priority, seq):
+                continue    # stale entry: frameAddr was rescheduled or removed
+            del self.txScheduled[frameAddr]
+            module = Modules.get(frameAddr & 0xffffff)
+            if module is None or self.txTime(frameAddr, module) > ms:
+                # module removed, or LASTTX updated by a frame transmitted with a different frameAddr (DCMD) to the same module
+                self.txSchedule(frameAddr)
+                continue
+            if self.replyUntil.get(frameAddr & 0xffffff, 0) > now:
+                waiting.append(frameAddr)
+                continue
+            # Must transmit now
+            # Transmit ACK first, then commands, config and periodic status (sort is stable: FIFO order for same priority)
+            queue = self.txQueue[frameAddr]
+            pending = sorted(queue, key=lambda txq: txq.priority)
+            txFrame = self.txFrame
+            frames = 0
+            while pending and frames < DB.TX_FRAMES_MAX:
+                txFrame.begin(frameAddr & 0xffff, (frameAddr >> 24) & 0xffff)   # dstAddr, master address or src address (DCMD)
+                reply = False   # True if the module will answer
+                unsent = []
+                # first fit: commands are added by priority, skipping commands that do not fit in the remaining space of the frame
+                for txq in pending:
+                    if not txFrame.add(txq.cmd, txq.cmdAck, txq.cmdLen, txq.port, txq.args):
+                        unsent.append(txq)  # command does not fit in this frame (module RX buffer is short): next frame
+                        continue
+                    if txq.cmdAck == 0:
+                        reply = True
+
+                    # if this cmd is an ACK, or values[0]==1, remove command from the queue
+                    if (txq.cmdAck != 0 or txq.retries<=1):
+                        queue.remove(txq)
+                    else:
+                        txq.retries -= 1   #command, no ack: decrement retry
+                        txq.txTime = ms
+                        txq.txCount += 1
+                if txFrame.empty():
+                    # commands longer than a frame: they can never be transmitted
+                    for txq in unsent:
+                        log(DB.LOG_ERR, "Command %02x port %x to module %06x does not fit in a frame: removed", txq.cmd, txq.port, frameAddr)
+                        queue.remove(txq)
+                    break
+                pending = unsent
+                frames += 1
+                frame = txFrame.finish()
+                self.txWrite(frame, frameAddr if reply else None)
+                if frameAddr > 0xffffff:
+                    # DCMD routed from another bus
+                    stats = self.routeStats.get((frameAddr >> 40, frameAddr & 0xffff))
+                    if stats:
+                        stats.transmitted(self.loop.time())
+                self.dump(frame, len(frame), "TX", (frameAddr >> 16) & 0xff, DB.FRAME_OK)
+
+            if frames:
+                if module[DB.LASTRETRY] < DB.TX_RETRY:
                     module[DB.LASTRETRY] += 1    #increment RETRY to multiply the retry period * 2
-                    if (module[DB.LASTRETRY] >= DB.TX_RETRY):
-                        module[DB.LASTRETRY] = 4;
-                    txbufferIndex += 1  # add 1 to txbufferIndex to include checksum in the frame length
-                    self._checksum(self.txbuffer, txbufferIndex)
-                    self.txbuffer.append(self.checksumValue)
-
-                    # TODO SerialConn.Send(frameAddr, self.txbuffer)    # frameAddr contains the busID, self.txbuffer the frame ready to be transmitted
-                    self.transport.write(self.txbuffer[:txbufferIndex])
-                    self.dump(self.txbuffer, txbufferIndex, "TX", (frameAddr >> 16) & 0xff, DB.FRAME_OK)
-                    Modules[frameAddr&0xffffff][DB.LASTTX] = ms
-                else:
-                    # if timeNextRetry > ms: must wait!
-                    if timeNextTx==0 or timeNextRetry < timeNextTx:
-                        timeNextTx = timeNextRetry
+                module[DB.LASTTX] = ms
+            self.txSchedule(frameAddr)  # next retry, if commands are still in queue
 
-                        
         """
             TODO: remove modules that are not received since a long time ???
             else: #No frame to be TXed for this frameAddr
@@ -1591,44 +1957,100 @@ class DomBusProtocol(asyncio.Protocol):
         """
 
 
-        if tx == 0: #nothing has been transmitted: send outputs status for device with older lastStatus
+        for frameAddr in waiting:
+            self.txSchedule(frameAddr)
+        # remove stale entries to get the next TX time
+        while txHeap and self.txScheduled.get(txHeap[0][3]) != txHeap[0][:3]:
+            heapq.heappop(txHeap)
+        timeNextTx = txHeap[0][0] if txHeap else 0
+        if waiting:
+            # transmit as soon as the first waiting module answers, or its reply time expires
+            self.lineWait(min(self.replyUntil[frameAddr & 0xffffff] for frameAddr in waiting))
+        elif txHeap and timeNextTx <= ms:
+            self.txKick()   # frames queued by txOutputsStatus() while sending
+        elif timeNextTx != self.retryTime:
+            # another frame must be transmitted at this time (in ms): timeNextTx => move the retry timer
+            if self.retryHandle:
+                self.retryHandle.cancel()
+                self.retryHandle = None
+            self.retryTime = timeNextTx
+            if timeNextTx:
+                self.retryHandle = self.loop.call_later((timeNextTx - ms) / 1000, self._retryExpired)
+
+    def txKick(self):
+        """Request a transmission: send() is called once at the next loop iteration, even if txKick() is called several times"""
+        if not self.txPending:
+            self.txPending = True
+            self.loop.call_soon(self._txFlush)
+
+    def _txFlush(self):
+        self.txPending = False
+        self.send()
 
-            # Check if any DCMD frame from a dombus module to another one...
-                    
-            olderFrameAddr=0
-            olderTime=sec
-            # find the device that I sent the output status earlier
-            for frameAddr,module in Modules.items():
-                if module[DB.LASTSTATUS]<olderTime:
-                    #this is the older device I sent status, till now
-                    olderTime = module[DB.LASTSTATUS]
-                    olderFrameAddr = frameAddr
-            # transmit only the output status of the older device, if last time I transmitted the status was at least PERIODIC_STATUS_INTERVAL seconds ago
-            if (sec-olderTime > DB.PERIODIC_STATUS_INTERVAL):
-                Modules[olderFrameAddr][DB.LASTSTATUS]=sec+(olderFrameAddr&0x000f)   #set current time + extra seconds to avoid all devices been refresh together
-                self.txOutputsStatus(olderFrameAddr)
-
-        if timeNextTx != 0 and timeNextTx > ms:
-            # another frame must be transmitted at this time (in ms): timeNextTx
-            if self.retryTime == 0 or self.retryTime < ms:
-                # create a task that wait for the retry time and then execute send() again
-                self.retryTime = timeNextTx
-                asyncio.create_task(self._retrySend(timeNextTx - ms))
-                    
+    def _retryExpired(self):
+        """Retry timer expired: transmit frames waiting for retry"""
+        self.retryHandle = None
+        self.retryTime = 0
+        self.send()
 
-    async def _retrySend(self, waitTime):
-        """Wait for waitTime (in milliseconds), then execute send() again"""
-        if waitTime>0:
-            waitTime /= 1000    # Convert in seconds
-            await asyncio.sleep(waitTime)
-            self.retryTime = 0
-            self.send()
+class ReplayTransport(asyncio.Transport):
+    """Transport used when replaying a capture file: TX frames are counted and discarded"""
+    def __init__(self):
+        super().__init__()
+        self.txFrames = 0
+        self.txBytes = 0
+
+    def write(self, data):
+        self.txFrames += 1
+        self.txBytes += len(data)
+
+    def close(self):
+        pass
+
+class ReplayMqttClient:
+    """MQTT client used when replaying a capture file: messages go through the publish queue, then they are counted and discarded"""
+    def __init__(self):
+        self.published = 0
+        self.bytes = 0
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        self.published += 1
+        self.bytes += len(topic) + len(payload)
+
+class MqttStats:
+    """Counters of the MQTT publish queue: queue depth, batches and latency (mqttPublish() => message published)"""
+    __slots__ = ('published', 'batches', 'errors', 'depthMax', 'coalesced', 'dropped', 'last', 'avg', 'max')
+
+    def __init__(self):
+        self.published = 0  # messages published
+        self.batches = 0    # number of wakeups of the publish task
+        self.errors = 0     # publish errors (MQTT connection restarted)
+        self.depthMax = 0   # max number of messages in queue
+        self.coalesced = 0  # states replaced by a newer state of the same topic before being published
+        self.dropped = 0    # states dropped because the outbox was full (mqttOutboxSize)
+        self.last = 0.0     # last latency, in ms
+        self.avg = 0.0      # average latency (EWMA), in ms
+        self.max = 0.0      # max latency, in ms
+
+    def update(self, latency: float):
+        """Add the latency (ms) of a published message"""
+        self.avg = latency if self.published == 0 else self.avg + (latency - self.avg) / 16
+        self.published += 1
+        self.last = latency
+        self.max = max(self.max, latency)
 
 class DomBusManager:
     def __init__(self):
         self.loop = asyncio.get_event_loop()
         self.mqttConnected = False
-        self.mqttPublishQueue = Queue() # Queue for MQTT messages
+        self.mqttPublishQueue = deque() # Queue for ordered MQTT messages (entity configuration), in FIFO order: (topic, message, retain, loop time, qos, True)
+        self.mqttStates = OrderedDict()  # mqttStates[topic] = (topic, message, retain, loop time, qos, False): entity states, one for each topic
+        self.mqttPublishEvent = asyncio.Event()  # set when a message is added to mqttPublishQueue or mqttStates
+        self.mqttStats = MqttStats()
+        self.moduleConfigPending = set()    # modules whose device discovery must be published (mqtt['deviceDiscovery']=1)
+        self.resyncTask = None      # task that publishes all entities to Home Assistant, started by mqttResync()
+        self.mqttSetPending = dict()    # mqttSetPending[topic] = (devID, payload): last command received from MQTT, waiting for the device to be ready
+        self.mqttSetLast = dict()       # mqttSetLast[topic] = loop time of the last command sent to the bus
         self.selectedBus = 1        # default bus selected for command line interface (telnet)
         self.selectedModule = 0     # address of module selected by CLI (telnet)
         self.retryConnection = 10   # Seconds to wait before retrying to open serial connections
@@ -1643,6 +2065,12 @@ class DomBusManager:
             'showbus':  {
                 'cmd': self.cmd_showbus,
                 'help': 'Show the list of available buses\r\nSpecify a bus to show modules attached to that bus, e.g. "showbus 1"' }, 
+            'showroutes':   { 
+                'cmd': self.cmd_showroutes, 
+                'help': 'Show the routing table of DCMD commands among buses, with the number of routed commands and latency' },
+            'showmqtt':   { 
+                'cmd': self.cmd_showmqtt, 
+                'help': 'Show MQTT connection status, publish queue depth and publish latency' },
             'showmodule':   { 
                 'cmd': self.cmd_showmodule, 
                 'help': 'Show data about the specified module: e.g. "showmodule ffe3"' },
@@ -1662,7 +2090,7 @@ class DomBusManager:
         while True:            
             for bus in buses:
                 if 'protocol' not in buses[bus] or buses[bus]['protocol'] is None:
-                    await manager.add_bus(busID=bus, port=buses[bus]['serialPort'], baudrate=115200)
+                    await manager.add_bus(busID=bus, port=buses[bus]['serialPort'], baudrate=buses[bus].get('baudrate', 115200))
                     log(DB.LOG_INFO, f"check_buses(): start connection to serial port {buses[bus]['serialPort']}, bus {bus}")
 
             await asyncio.sleep(self.retryConnection)
@@ -1700,7 +2128,7 @@ class DomBusManager:
             log(DB.LOG_INFO, f"Connecting DomBus {busID} on port {port} {baudrate}bps ...")
             transport, protocol = await serial_asyncio.create_serial_connection(
                 self.loop,
-                lambda: DomBusProtocol(busID, on_data_received),
+                lambda: DomBusProtocol(busID, on_data_received, baudrate),
                 port,
                 baudrate=baudrate,
             )
@@ -1721,6 +2149,54 @@ class DomBusManager:
         else:
             log(DB.LOG_WARN, f"Bus ID {busID} does not exist.")
 
+    async def replay(self, path, speed: float = 1.0):
+        """Feed a capture file to bus protocols and MQTT handler, at the recorded speed multiplied by speed (speed=0 => max speed)"""
+        log(DB.LOG_INFO, f"Replaying capture file {path} at speed {speed if speed > 0 else 'max'}")
+        # MQTT messages are published to a client that discards them, so the publish queue is part of the replayed load
+        client = mqtt['client'] = ReplayMqttClient()
+        mqtt['enabled'] = 1
+        self.mqttConnected = True
+        publishTask = asyncio.create_task(self._mqttPublishFromQueue())
+        records = [0, 0, 0, 0]  # number of records for each direction
+        timeFirst = None
+        timeStart = time.perf_counter()
+        for timestamp, busID, direction, data in dbcap.readCapture(path):
+            if timeFirst is None:
+                timeFirst = timestamp
+            if speed > 0:
+                delay = (timestamp - timeFirst) / speed - (time.perf_counter() - timeStart)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif (records[dbcap.DIR_RX] & 0xff) == 0:
+                await asyncio.sleep(0)  # let timers and other tasks run
+            if direction == dbcap.DIR_RX:
+                if busID not in buses:
+                    buses[busID] = { 'serialPort': path }
+                if buses[busID].get('protocol') is None:
+                    protocol = DomBusProtocol(busID, None)
+                    protocol.connection_made(ReplayTransport())
+                    buses[busID]['protocol'] = protocol
+                buses[busID]['protocol'].data_received(data)
+            elif direction == dbcap.DIR_MQTTCMD:
+                self.mqttOnMessage(*dbcap.splitMqtt(data))
+            # TX frames and MQTT publishes are generated again by DomBusGateway
+            if direction < len(records):
+                records[direction] += 1
+        while self.mqttPublishQueue or self.mqttStates:
+            await asyncio.sleep(0.01)   # wait for the publish queue to be empty
+        self.mqttConnected = False
+        self.mqttPublishEvent.set()     # stop the publishing task
+        await publishTask
+        elapsed = time.perf_counter() - timeStart
+        rx = records[dbcap.DIR_RX] + records[dbcap.DIR_MQTTCMD]
+        log(DB.LOG_INFO, f"Replay completed in {elapsed:.3f}s: {records[dbcap.DIR_RX]} RX chunks, {records[dbcap.DIR_MQTTCMD]} MQTT commands ({rx/elapsed if elapsed else 0:.0f}/s), recorded {records[dbcap.DIR_TX]} TX frames and {records[dbcap.DIR_MQTTPUB]} MQTT publishes")
+        for busID in buses:
+            protocol = buses[busID].get('protocol')
+            if protocol and isinstance(protocol.transport, ReplayTransport):
+                log(DB.LOG_INFO, f"Bus {busID}: replay transmitted {protocol.transport.txFrames} frames, {protocol.transport.txBytes} bytes")
+        stats = self.mqttStats
+        log(DB.LOG_INFO, f"MQTT: replay published {client.published} messages, {client.bytes} bytes, in {stats.batches} batches ({stats.coalesced} states replaced, {stats.dropped} dropped), max queue depth {stats.depthMax}")
+
     def stop_all_buses(self):
         """Stop all buses."""
         for busID in list(buses.keys()):
@@ -1739,6 +2215,8 @@ class DomBusManager:
             self.loop.create_task(self._mqttPublishFromQueue())
             # Start the subscription task
             self.loop.create_task(self._mqttSubscribe())
+            # Send all entities to Home Assistant (configuration only if changed)
+            self.mqttResync()
 
         except Exception as e:
             log(DB.LOG_ERR, f"Failed to connect to MQTT broker: {e}")
@@ -1748,86 +2226,271 @@ class DomBusManager:
         self.mqttConnected = False
 
     async def _mqttSubscribe(self):
-        """Subscribe to all topics asynchronously."""
+        """Subscribe to command topics and Home Assistant status asynchronously."""
 
-        topics = f'{mqtt["topic"]}/#'
-        options = SubscribeOptions(noLocal=True)
+        topics = f'{mqtt["topic"]}/+/+/set'     # only commands: dombus/platform/devID/set
+        statusTopic = f'{mqtt["topicConfig"]}/status'  # Home Assistant birth and last will messages
+        # the client connects with MQTT v3.1.1, that has no noLocal subscribe option: messages published by the gateway
+        # are not received because it never publishes on command topics, and JSON payloads are tagged with "_sender"
         if mqttversion == 'old':
             async with mqtt['client'].messages() as messages:
-                await mqtt['client'].subscribe(topics, options=options)  # Subscribe to all topics
-                log(DB.LOG_INFO, f"Subscribed to topics {topics}")
+                await mqtt['client'].subscribe(topics)  # Subscribe to command topics
+                await mqtt['client'].subscribe(statusTopic)
+                log(DB.LOG_INFO, f"Subscribed to topics {topics} {statusTopic}")
 
                 async for message in messages:
-                    if str(message.topic)[-6:] != '/state' and '"_sender": "dbp"' not in message.payload.decode():  # ignore msg generated by me, and state messages (only commands should be received)
-                        log(DB.LOG_MQTTRX, f"Received on {message.topic}: {message.payload.decode()}")
-                        # check topic  /dombus/platform/devID/set
-                        # check topic  /dombus/platform/devID/state  Off
-                        f = str(message.topic).split('/')
-                        if len(f)>=4 and f[0] == mqtt['topic']:
-
-                            devID = devIDName2devID(f[2])
-                            if devID and devID in Devices:
-                                # Device exists
-                                d = Devices[devID]
-                                d.updateToBus(DB.UPDATE_VALUE, message.payload.decode())
-                            else:
-                                log(DB.LOG_MQTTRX, f"Unknown device {devID}")
-                        else:
-                            log(DB.LOG_MQTTRX, "Received topic not in valid format")
-#            else:
-#                log(DB.LOG_DEBUG, f"Received ignored msg from {message.topic}: {message.payload.decode()}")
-
+                    self.mqttOnMessage(str(message.topic), message.payload.decode())
         else:
             #aiomqtt, new version of asyncio_mqtt
-            await mqtt['client'].subscribe(topics, options=options)  # Subscribe to all topics
-            log(DB.LOG_INFO, f"Subscribed to topics {topics}")
+            await mqtt['client'].subscribe(topics)  # Subscribe to command topics
+            await mqtt['client'].subscribe(statusTopic)
+            log(DB.LOG_INFO, f"Subscribed to topics {topics} {statusTopic}")
 
             async for message in mqtt['client'].messages:
-                if str(message.topic)[-6:] != '/state' and '"_sender": "dbp"' not in message.payload.decode():  # ignore msg generated by me, and state messages (only commands should be received)
-                    log(DB.LOG_MQTTRX, f"Received on {message.topic}: {message.payload.decode()}")
-                    # check topic  /dombus/platform/devID/set
-                    # check topic  /dombus/platform/devID/state  Off
-                    f = str(message.topic).split('/')
-                    # log(DB.LOG_MQTTRX, f"len(f)={len(f)} f={f}")
-                    if len(f)>=4 and f[0] == mqtt['topic']:
-                        devID = devIDName2devID(f[2])
-                        if devID and devID in Devices:
-                            # Device exists
-                            d = Devices[devID]
-                            log(DB.LOG_MQTTRX, f"call updateToBus(DB.UPDATE_VALUE, {message.payload.decode()})")
-                            d.updateToBus(DB.UPDATE_VALUE, message.payload.decode())
-                        else:
-                            log(DB.LOG_MQTTRX, f"Unknown device {devID}")
-                    else:
-                        log(DB.LOG_MQTTRX, f"Received topic not in valid format: len(f)={len(f)} f[0]={f[0]}")
-            # else:
-            #     log(DB.LOG_DEBUG, f"Received ignored msg from {message.topic}: {message.payload.decode()}")
-   
+                self.mqttOnMessage(str(message.topic), message.payload.decode())
+
+    def mqttOnMessage(self, topic: str, payload: str):
+        """Manage a message received from the MQTT broker"""
+        # command topic dombus/platform/devID/set => look for the device with topic dombus/platform/devID (Devices.byTopic is updated by setTopics)
+        d = Devices.topicDevice(topic[:-4]) if topic.endswith('/set') else None
+        if d is not None and d.topic == topic[:-4]:
+            if '"_sender": "dbp"' in payload:
+                return  # loopback of a message published by me
+            log(DB.LOG_MQTTRX, "Received on %s: %s", topic, payload)
+            if captureWriter:
+                captureWriter.writeMqtt(dbcap.DIR_MQTTCMD, topic, payload)
+            self.mqttSet(topic, d, payload)
+        elif topic == f'{mqtt["topicConfig"]}/status':
+            log(DB.LOG_INFO, f"Home Assistant status: {payload}")
+            if payload == 'online':
+                self.mqttResync()   # Home Assistant restarted: send states again
+        else:
+            log(DB.LOG_MQTTRX, "Received on %s: %s => unknown device", topic, payload)
+
+    def mqttSetInterval(self, d):
+        """Return the min interval (seconds) between two commands to device d, from mqttSetInterval configuration"""
+        if 'device_class' in d.ha and d.ha['device_class'] in mqttSetInterval:
+            return mqttSetInterval[d.ha['device_class']]
+        return mqttSetInterval.get(d.ha['p'], mqttSetInterval.get('default', 0))
+
+    def mqttQosRetain(self, kind: str, d=None):
+        """Return (qos, retain) for a message of kind 'state', 'ack' or 'config' of device d, from mqttPolicy configuration"""
+        policy = mqttPolicy.get(kind, {})
+        if d is not None:
+            for key in (d.ha.get('device_class'), d.ha.get('p'), DB.PORTTYPES_NAME.get(d.portType)):
+                if key in policy:
+                    return policy[key]
+        return policy.get('default', (0, False) if kind == 'state' else (1, kind == 'config'))
+
+    def mqttSetBusy(self, d):
+        """Return True if the previous command to device d has not been ACKed by the module yet"""
+        protocol = buses[d.busID].get('protocol') if d.busID in buses else None
+        return protocol is not None and protocol.txBusy(d.frameAddr, d.port)
+
+    def mqttSet(self, topic: str, d, payload: str):
+        """Command received from MQTT: send it to the bus now, or keep only the last value until the device is ready (min interval elapsed and previous command ACKed)"""
+        if topic in self.mqttSetPending:
+            # last write wins
+            log(DB.LOG_MQTTRX, "Command to %s replaces the pending one", topic)
+            self.mqttSetPending[topic] = (d.devID, payload)
+            return
+        if self.loop.time() - self.mqttSetLast.get(topic, 0) >= self.mqttSetInterval(d) and not self.mqttSetBusy(d):
+            self.mqttSetLast[topic] = self.loop.time()
+            log(DB.LOG_MQTTRX, "call updateToBus(DB.UPDATE_VALUE, %s)", payload)
+            d.updateToBus(DB.UPDATE_VALUE, payload)
+        else:
+            self.mqttSetPending[topic] = (d.devID, payload)
+            self._mqttSetFlush(topic)
+
+    def _mqttSetFlush(self, topic: str):
+        """Send the pending command for topic if the device is ready, else check again later"""
+        devID, payload = self.mqttSetPending[topic]
+        d = Devices.get(devID)
+        if d is None:
+            del self.mqttSetPending[topic]   # device removed
+            return
+        wait = self.mqttSetLast.get(topic, 0) + self.mqttSetInterval(d) - self.loop.time()
+        if wait <= 0 and not self.mqttSetBusy(d):
+            del self.mqttSetPending[topic]
+            self.mqttSetLast[topic] = self.loop.time()
+            log(DB.LOG_MQTTRX, "call updateToBus(DB.UPDATE_VALUE, %s)", payload)
+            d.updateToBus(DB.UPDATE_VALUE, payload)
+        else:
+            self.loop.call_later(max(wait, DB.MQTT_SET_RETRY_TIME), self._mqttSetFlush, topic)
 
     async def _mqttPublishFromQueue(self):
-        """Process the publish queue asynchronously."""
+        """Process the publish queue asynchronously: at each wakeup, up to MQTT_PUBLISH_BATCH messages are published together (configuration first, then states)"""
+        queue = self.mqttPublishQueue
+        states = self.mqttStates
+        stats = self.mqttStats
         while self.mqttConnected:
-            topic, message, retain = await self.loop.run_in_executor(None, self.mqttPublishQueue.get)
-            # Publish the message
-            log(DB.LOG_MQTTTX, f"Publish to {topic}: {message}. Retain={retain}")
-            try:
-                await mqtt['client'].publish(topic, message, qos=1, retain=retain)
-            except Exception as e:
-                log(DB.LOG_ERR, f"MQTT error while publishing a message: {e}\nRestart MQTT")
-                # Reconnect to MQTT broker
+            if not queue and not states:
+                self.mqttPublishEvent.clear()
+                await self.mqttPublishEvent.wait()
+                continue
+            batch = [queue.popleft() for _ in range(min(len(queue), DB.MQTT_PUBLISH_BATCH))]
+            while states and len(batch) < DB.MQTT_PUBLISH_BATCH:
+                batch.append(states.popitem(last=False)[1])
+            stats.batches += 1
+            for topic, message, retain, _, qos, _ in batch:
+                log(DB.LOG_MQTTTX, "Publish to %s: %s. QoS=%d Retain=%s", topic, message, qos, retain)
+            # Publish the messages without waiting for the broker ACK of each one (messages are sent in order)
+            results = await asyncio.gather(*(mqtt['client'].publish(topic, message, qos=qos, retain=retain) for topic, message, retain, _, qos, _ in batch), return_exceptions=True)
+            now = self.loop.time()
+            failed = [item for item, result in zip(batch, results) if isinstance(result, Exception)]
+            for item, result in zip(batch, results):
+                if not isinstance(result, Exception):
+                    stats.update((now - item[3]) * 1000)
+            if failed:
+                stats.errors += 1
+                log(DB.LOG_ERR, f"MQTT error while publishing a message: {next(r for r in results if isinstance(r, Exception))}\nRestart MQTT")
+                # publish them again after reconnecting, unless a newer state has been queued in the meantime
+                for item in reversed(failed):
+                    if item[5]:
+                        queue.appendleft(item)
+                    elif item[0] not in states:
+                        states[item[0]] = item
+                        states.move_to_end(item[0], last=False)
+                # Reconnect to MQTT broker: add_mqtt() starts a new publishing task
                 await self.mqttDisconnect()
                 await self.add_mqtt()
-            else:
-                self.mqttPublishQueue.task_done()
+                return
 
-    def mqttPublish(self, topic: str, payload: any, retain: bool=False):
-        """Send message to a queue, to send it asyncronously"""
+    def mqttPublish(self, topic: str, payload: any, retain: bool=False, qos: int=1, ordered: bool=None):
+        """Send message to a queue, to send it asyncronously. Ordered messages (default: retained messages) are published first, in order,
+        while a state replaces the pending state of the same topic"""
         if isinstance(payload, (dict, list)):
             payload['_sender'] = 'dbp'  # add a tag to identify msg sent by me, to ignore loopback mqtt commands 
             message = json.dumps(payload)
         else:
             message = str(payload)
-        self.mqttPublishQueue.put((topic, message, retain))
+        if captureWriter:
+            captureWriter.writeMqtt(dbcap.DIR_MQTTPUB, topic, message)
+        if mqtt['enabled'] == 0:
+            return  # no MQTT client is reading the queue
+        stats = self.mqttStats
+        if ordered is None:
+            ordered = retain
+        if ordered:
+            # configuration: must be published in order
+            self.mqttPublishQueue.append((topic, message, retain, self.loop.time(), qos, True))
+        else:
+            # state: replace the pending state of the same topic, keeping its position in the queue
+            states = self.mqttStates
+            pending = states.get(topic)
+            if pending:
+                states[topic] = (topic, message, retain, pending[3], qos, False)
+                stats.coalesced += 1
+            else:
+                if len(states) >= mqttOutboxSize:
+                    states.popitem(last=False)  # outbox full: drop the oldest state
+                    stats.dropped += 1
+                states[topic] = (topic, message, retain, self.loop.time(), qos, False)
+        depth = len(self.mqttPublishQueue) + len(self.mqttStates)
+        if depth > stats.depthMax:
+            stats.depthMax = depth
+        self.mqttPublishEvent.set()
+
+    def mqttResync(self):
+        """Start sending all entities to Home Assistant, paced by mqttResyncRate: a resync already running is restarted"""
+        if self.resyncTask and not self.resyncTask.done():
+            self.resyncTask.cancel()
+        self.resyncTask = self.loop.create_task(self._mqttResync())
+
+    async def _mqttResync(self):
+        """Publish the state of all devices, and their configuration if changed, with max mqttResyncRate messages/s"""
+        start = self.loop.time()
+        n = 0   # published messages
+        devices = 0
+        discovery = mqtt.get('deviceDiscovery', 0)
+        frameAddr = None
+        for dev in sorted(Devices):
+            d = Devices.get(dev)
+            if d is None or (dev >> 16) not in Modules:
+                continue    # device or module removed in the meantime
+            configHash = d.configHash
+            d.updateFromBus(DB.UPDATE_CONFIG)
+            if discovery:
+                if d.frameAddr != frameAddr:
+                    # first device of the module: publish the discovery of the whole module now, to count its messages
+                    frameAddr = d.frameAddr
+                    self.moduleConfigPending.discard(frameAddr)
+                    n += self.mqttPublishModuleConfig(frameAddr)
+            elif d.configHash != configHash:
+                n += len(d.configCache)
+            n += d.publishState()
+            devices += 1
+            delay = start + n / mqttResyncRate - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        log(DB.LOG_INFO, f"Resync completed: {devices} devices, {n} messages in {self.loop.time() - start:.1f}s")
+
+    def moduleConfigTopic(self, frameAddr: int) -> str:
+        """Return the device discovery topic for the module frameAddr"""
+        return f"{mqtt['topicConfig']}/device/dombus_{frameAddr:06x}/config"
+
+    def mqttModuleConfig(self, frameAddr: int):
+        """Request to publish the device discovery of module frameAddr: requests from all devices of the module are published once, at the next loop iteration"""
+        if not self.moduleConfigPending:
+            self.loop.call_soon(self._mqttModuleConfigFlush)
+        self.moduleConfigPending.add(frameAddr)
+
+    def _mqttModuleConfigFlush(self):
+        pending = self.moduleConfigPending
+        self.moduleConfigPending = set()
+        for frameAddr in sorted(pending):
+            self.mqttPublishModuleConfig(frameAddr)
+
+    def mqttPublishModuleConfig(self, frameAddr: int):
+        """
+            Publish the Home Assistant device discovery of module frameAddr, with one component for each entity, if any entity changed
+            Components removed since the last publish are sent with the platform only, to remove them from Home Assistant
+            Entities published with one config topic for each entity are migrated to device discovery
+            Return the number of published messages
+        """
+        devices = Devices.moduleDevices(frameAddr)
+        payload = {}
+        cmps = {}
+        newCmps = {}    # newCmps[devID] = {component id: platform}
+        migrate = []    # old config topics of entities published without device discovery
+        changed = False
+        for devID in sorted(devices):
+            d = devices[devID]
+            if d.portType == DB.PORTTYPE_SENSOR_TEMP_HUM or d.portType == DB.PORTTYPE_OUT_LEDSTATUS:
+                continue
+            d.updateConfigCache()
+            if d.configCacheHash != d.configHash:
+                changed = True
+            dCmps = newCmps[devID] = {}
+            for topic, message in d.configCache:
+                c = json.loads(message)
+                if 'dev' in c:
+                    payload['dev'] = c.pop('dev')
+                payload['o'] = c.pop('o')
+                c.pop('_sender', None)
+                cmpId = c['unique_id'].removeprefix('dombus_')
+                cmps[cmpId] = c
+                dCmps[cmpId] = c['p']
+                if d.configHash and not d.configCmps:
+                    migrate.append(topic)
+            for cmpId, platform in d.configCmps.items():
+                if cmpId not in dCmps:
+                    cmps[cmpId] = {'p': platform}   # component removed
+                    changed = True
+        if not changed:
+            return 0
+        for topic in migrate:
+            self.mqttPublish(topic, '{"migrate_discovery": true}', retain=True)
+        payload['cmps'] = cmps
+        qos, retain = self.mqttQosRetain('config')
+        self.mqttPublish(self.moduleConfigTopic(frameAddr), payload, retain, qos, ordered=True)
+        for topic in migrate:
+            self.mqttPublish(topic, "", retain=True)    # remove the old config topic: the entity is kept by Home Assistant
+        for devID, dCmps in newCmps.items():
+            devices[devID].configHash = devices[devID].configCacheHash
+            devices[devID].configCmps = dCmps
+        setSaveDataTimeout()
+        return 1 + 2 * len(migrate)
 
     def isPrivateIP(self, ip_str):
         """Check if IP is in private ranges"""
@@ -1930,28 +2593,32 @@ class DomBusManager:
                 hs=re.sub('\r\n', '\r\n           ', self.commands[ cmd ][ 'help' ])
                 writer.write(f'{cmd:10} {hs}\r\n\r\n'.encode())
 
-    async def cmd_refresh(self, args, writer):
-        """Send whole list of devices to the domotic controller"""
-        # cmd_refresh() => send all devices
-        # cmd_refresh(["reset"]) => remove and create again all devices
-        # cmd_refres( args, writer ) => send or recreate all devices with output on telnet session
-        dlist = []
-        for dev in Devices: # sort by devID
-            bisect.insort(dlist, dev)
-        for dev in dlist:
+    def refreshDevices(self, force: bool = False, resetReq: str = None, writer = None):
+        """
+            Send configuration and value of all devices to the domotic controller
+            force=False => configuration is published only if changed since the last time it was published (also before restart)
+            resetReq="reset" => remove and create again all devices
+        """
+        for dev in sorted(Devices):
             d = Devices[dev]
             if (dev >> 16) in Modules:
-                resetReq = None
-                if args and args[0]:
-                    resetReq = args[0]  # refresh reset => send "reset" as 4th parameter to remove previous entity and create a new one
+                if force or resetReq:
+                    d.configHash = ''   # publish configuration even if not changed
                 if writer:
                     writer.write(f'Sending configuration refresh for device {d.devIDname} portType={d.portType:08x} platform={d.ha["p"]}...\r\n'.encode())
                 d.updateFromBus(DB.UPDATE_CONFIG, None, None, resetReq)
-                d.updateFromBus(DB.UPDATE_VALUE, d.value, d.counterValue)
+                d.publishState()
             else:
                 if writer:
                     writer.write(f'Skip sending configuration for device {d.devIDname}: module {(dev >> 16):06x} not alive or not received yet!\r\n'.encode())
-        del dlist            
+
+    async def cmd_refresh(self, args, writer):
+        """Send whole list of devices to the domotic controller"""
+        # cmd_refresh(["reset"]) => remove and create again all devices
+        resetReq = None
+        if args and args[0]:
+            resetReq = args[0]  # refresh reset => send "reset" as 4th parameter to remove previous entity and create a new one
+        self.refreshDevices(True, resetReq, writer)
 
     async def cmd_showbus(self, args, writer):
         """Show list of buses, or parameter of the selected bus"""
@@ -1971,8 +2638,37 @@ class DomBusManager:
             # Show list of buses
             writer.write(f'Available buses:\r\n'.encode())
             for b in buses:
-                writer.write(f'- {b:02x}: {buses[b]["serialPort"]:20} {"CONNECTED" if "protocol" in buses[b] else "DISCONNECTED"}\r\n'.encode())
-
+                protocol = buses[b].get('protocol')
+                if protocol:
+                    txUse, rxUse = protocol.busUtilization()
+                    writer.write(f'- {b:02x}: {buses[b]["serialPort"]:20} CONNECTED     TX {txUse:5.1f}% RX {rxUse:5.1f}%\r\n'.encode())
+                else:
+                    writer.write(f'- {b:02x}: {buses[b]["serialPort"]:20} DISCONNECTED\r\n'.encode())
+
+
+    async def cmd_showmqtt(self, args, writer):
+        """Show MQTT connection status and statistics of the publish queue"""
+        stats = self.mqttStats
+        writer.write(f'MQTT broker {mqtt["host"]}:{mqtt["port"]}: {"CONNECTED" if self.mqttConnected else "DISCONNECTED"}\r\n'.encode())
+        writer.write(f'Publish queue: {len(self.mqttPublishQueue)} configurations, {len(self.mqttStates)} states (max {mqttOutboxSize}), max depth {stats.depthMax}\r\n'.encode())
+        writer.write(f'States replaced by a newer state: {stats.coalesced}, dropped because the queue was full: {stats.dropped}\r\n'.encode())
+        writer.write(f'Published: {stats.published} messages in {stats.batches} batches ({stats.published/stats.batches if stats.batches else 0:.1f} messages/batch), errors={stats.errors}\r\n'.encode())
+        writer.write(f'Publish latency: last={stats.last:.1f}ms average={stats.avg:.1f}ms max={stats.max:.1f}ms\r\n'.encode())
+
+    async def cmd_showroutes(self, args, writer):
+        """Show routing table of DCMD commands among buses, and statistics for routes already used"""
+        writer.write(b'Modules attached to more than one bus:\r\n')
+        for devAddr in sorted(Modules.routes):
+            busIDs = Modules.routes[devAddr]
+            if len(busIDs) > 1:
+                writer.write(f'- Module {devAddr:04x}: buses {" ".join(f"{b:02x}" for b in sorted(busIDs))}\r\n'.encode())
+        writer.write(f'{len(Modules.routes)} module addresses in the routing table\r\n'.encode())
+        writer.write(b'Routed DCMD commands:\r\n')
+        for bus in buses:
+            protocol = buses[bus].get('protocol')
+            if protocol:
+                for (srcBus, dst), stats in sorted(protocol.routeStats.items()):
+                    writer.write(f'- Bus {srcBus:02x} => Bus {bus:02x} Module {dst:04x}: hits={stats.hits} latency last={stats.last:.1f}ms average={stats.avg:.1f}ms max={stats.max:.1f}ms\r\n'.encode())
 
     async def cmd_showmodule(self, args, writer):
         """Show list of modules for the selected bus, or parameters of the selected module"""
@@ -1988,6 +2684,12 @@ class DomBusManager:
             # List all devices with the same address of module
             self.selectedModule = module
             self.showDeviceList(writer)
+            protocol = buses[self.selectedBus].get('protocol') if self.selectedBus in buses else None
+            rtt = protocol.rtt.get(frameAddr) if protocol else None
+            if rtt:
+                writer.write(f"Round trip time: last={rtt.last}ms average={rtt.srtt:.1f}ms variation={rtt.rttvar:.1f}ms samples={rtt.samples} => retry timeout={rtt.rto:.0f}ms\r\n".encode())
+            else:
+                writer.write(f"Round trip time: not measured yet => retry timeout={DB.TX_RTO_INIT}ms\r\n".encode())
         else:
             self.showModuleList(writer)
 
@@ -2014,20 +2716,16 @@ class DomBusManager:
                         writer.write(f'Module with address {(frameAddr & 0xffff):x} does not exist in bus {(frameAddr >> 16):x}\r\n'.encode())
                     else:
                         # Module exists: delete all devices
-                        for d in list(Devices.keys()):
-                            if (d >> 16) == frameAddr:
-                                # Matches 
-                                writer.write(f'Removing port {(d & 0xffff):x} for device {(frameAddr&0xffff):x} on bus (frameAddr>>16)...\r\n'.encode())
-                                if mqtt['enabled'] != 0:
-                                    self.mqttPublish(Devices[d].topicConfig, "", retain=True) # Remove entity from HA
-                                    if Devices[d].topic2Config:
-                                        self.mqttPublish(Devices[d].topic2Config, "", retain=True) # Remove associated entity from HA
-                                del Devices[d]
+                        for d in list(Devices.moduleDevices(frameAddr)):
+                            writer.write(f'Removing port {(d & 0xffff):x} for device {(frameAddr&0xffff):x} on bus {(frameAddr>>16):x}...\r\n'.encode())
+                            if mqtt['enabled'] != 0:
+                                self.mqttPublish(Devices[d].topicConfig, "", retain=True) # Remove entity from HA
+                                if Devices[d].topic2Config:
+                                    self.mqttPublish(Devices[d].topic2Config, "", retain=True) # Remove associated entity from HA
+                            del Devices[d]
+                        if mqtt['enabled'] != 0 and mqtt.get('deviceDiscovery', 0):
+                            self.mqttPublish(self.moduleConfigTopic(frameAddr), "", retain=True)  # Remove module from HA
                         del Modules[frameAddr]
-                        # Debugging...
-                        writer.write(b'Current devices:\r\n')
-                        for d in list(Devices.keys()):
-                            writer.write(f'{d:x}\r\n'.encode())
                         setSaveDataTimeout()
 
 
@@ -2224,11 +2922,10 @@ class DomBusManager:
     def showDeviceList(self, writer):
         writer.write(f"Devices (ports) for the selected module {self.selectedModule:04x} on bus {self.selectedBus:02x}:\r\n".encode())
         writer.write(b"   Value - Port Name: Configuration\r\n")
-        devIDbase = (self.selectedBus << 32) + (self.selectedModule << 16)
-        for p in range(1, 512):
-            devID = devIDbase + p
-            if devID in Devices:
-                writer.write(f'{str(Devices[devID].valueHA):>8.8} - {Devices[devID].portName}: {Devices[devID].portConf}\r\n'.encode())
+        devices = Devices.moduleDevices((self.selectedBus << 16) + self.selectedModule)
+        for devID in sorted(devices):
+            d = devices[devID]
+            writer.write(f'{str(d.valueHA):>8.8} - {d.portName}: {d.portConf}\r\n'.encode())
 
     def removeModule(self, devID):
         """Remove the module with specified devID from DomBusGateway and from MQTT"""
@@ -2241,7 +2938,7 @@ class DomBusManager:
         haNew = {}
         cal = None
         d = None
-        log(DB.LOG_DEBUG, f"parseConfiguration(devID={devID:x}, portType={portType}, portOpt={portOpt}, portName={portName}, options={options})")
+        log(DB.LOG_DEBUG, "parseConfiguration(devID=%x, portType=%s, portOpt=%s, portName=%s, options=%s)", devID, portType, portOpt, portName, options)
 
         if devID in Devices:
             d = Devices[devID]
@@ -2336,6 +3033,11 @@ if __name__ == "__main__":
 
         signal.signal(signal.SIGTERM, sigtermHandler)
 
+        if args.replay:
+            # offline replay of a capture file: serial ports, MQTT broker and telnet are not used (MQTT messages are discarded by ReplayMqttClient)
+            await manager.replay(args.replay, args.replay_speed)
+            return
+
 #        for bus in buses:
 #            try: 
 #                await manager.add_bus(busID=bus, port=buses[bus]['serialPort'], baudrate=115200)
@@ -2352,7 +3054,6 @@ if __name__ == "__main__":
             # listen to TCP port waiting for connections and commands
             asyncio.create_task(manager.addTelnetServer())
         
-        await manager.cmd_refresh(None, None) # Send all devices to HA
         await asyncio.Event().wait()
 
     ############### main ################
@@ -2381,6 +3082,12 @@ if __name__ == "__main__":
             help='Password for the user accessing the MQTT broker')
     parser.add_argument('--telnet_pass', '-ts', type=str, default='',
             help='Password for telnet from remote connections')
+    parser.add_argument('--capture', '-cf', type=str, default='',
+            help='Record frames on DomBus buses and MQTT messages to the specified binary file, that can be used with --replay')
+    parser.add_argument('--replay', '-rf', type=str, default='',
+            help='Replay a file recorded by --capture, without opening serial ports and MQTT broker, then exit. Use --data_dir with a copy of data, as Modules and Devices are updated')
+    parser.add_argument('--replay_speed', '-rs', type=float, default=1.0,
+            help='Replay speed: 1=recorded speed, 10=10 times faster, 0=max speed')
 
     args = parser.parse_args()
     if args.data_dir and args.data_dir != '':       dataDir = args.data_dir
@@ -2407,6 +3114,9 @@ if __name__ == "__main__":
         mqtt['pass'] = args.mqtt_pass
     if args.telnet_pass and args.telnet_pass != '':
         telnet['password'] = args.telnet_pass
+    if args.capture and args.capture != '':
+        captureWriter = dbcap.CaptureWriter(args.capture)
+        atexit.register(captureWriter.close)
 
     # logging
     if logFile: 
@@ -2419,12 +3129,17 @@ if __name__ == "__main__":
     else:
         logHandler=logging.StreamHandler(sys.stdout)
 
+    # log records are written to logHandler by a separate thread, to avoid blocking the asyncio loop on slow disks (file write and rotation)
+    logHandler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+    logQueueHandler = LogQueueHandler(logQueueSize)
+    logListener = QueueListener(logQueueHandler.queue, logHandler)
     logging.basicConfig(
-        handlers=[logHandler],
+        handlers=[logQueueHandler],
         level=logging.INFO,
-        format="%(asctime)s - %(message)s"
+        format="%(message)s"
     )
-    """handlers=[logHandler],"""
+    logListener.start()
+    atexit.register(logListener.stop)   # write pending records at exit
 
     # check that data directory exists
     dataPath = Path(dataDir)
@@ -2438,13 +3153,13 @@ if __name__ == "__main__":
     if modulesPath.exists():
         with open(modulesPath, 'r', encoding='utf-8') as f:
             tempdict = json.load(f)
-            Modules = {int(k): v for k, v in tempdict.items()}
+            Modules = DomBusModules({int(k): v for k, v in tempdict.items()})
     else:
         log(DB.LOG_WARN, f"Modules data file {dataDir}/Modules.json does not exist")
     if devicesPath.exists():
         with open(devicesPath, 'r', encoding='utf-8') as f:
             tempdict = json.load(f)
-            Devices = {int(k): DomBusDevice.from_dict(v) for k, v in tempdict.items()}
+            Devices = DomBusRegistry({int(k): DomBusDevice.from_dict(v) for k, v in tempdict.items()})
     else:
         log(DB.LOG_WARN, f"Devices data file {dataDir}/Devices.json does not exist")
     del tempdict
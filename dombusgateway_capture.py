@@ -0,0 +1,66 @@
+#DomBus capture: binary recording of bus frames and MQTT messages, to replay real traffic offline
+#Used by DomBusGateway with the --capture and --replay options
+#
+# File format: MAGIC, then a sequence of records
+#   timestamp (double, seconds since Epoch), busID (byte), direction (byte), data length (unsigned short), data
+#   data = raw bytes from/to the serial bus for RX/TX records, topic + '\0' + payload for MQTT records (busID=0)
+
+import struct
+import time
+
+MAGIC = b"DBCAP1\n"
+RECORD = struct.Struct("<dBBH")     # timestamp, busID, direction, data length
+DATA_LEN_MAX = 0xffff
+
+DIR_RX = 0          # bytes received from the serial bus
+DIR_TX = 1          # frame transmitted to the serial bus
+DIR_MQTTPUB = 2     # message published to the MQTT broker
+DIR_MQTTCMD = 3     # command received from the MQTT broker
+DIRNAME = { DIR_RX: 'RX', DIR_TX: 'TX', DIR_MQTTPUB: 'MQTTPUB', DIR_MQTTCMD: 'MQTTCMD' }
+
+class CaptureWriter:
+    """Append RX/TX frames and MQTT messages to a capture file"""
+    def __init__(self, path, bufferSize: int = 65536):
+        self.file = open(path, 'wb', buffering=bufferSize)
+        self.file.write(MAGIC)
+        self.records = 0
+
+    def write(self, busID: int, direction: int, data, timestamp: float = None):
+        """Write a record: data is truncated to DATA_LEN_MAX bytes"""
+        if self.file is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        data = data[:DATA_LEN_MAX]
+        self.file.write(RECORD.pack(timestamp, busID, direction, len(data)))
+        self.file.write(data)
+        self.records += 1
+
+    def writeMqtt(self, direction: int, topic: str, payload: str, timestamp: float = None):
+        """Write a MQTT record (DIR_MQTTPUB or DIR_MQTTCMD)"""
+        self.write(0, direction, f"{topic}\0{payload}".encode(), timestamp)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def readCapture(path):
+    """Yield (timestamp, busID, direction, data) for each record in the capture file"""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a DomBusGateway capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return  # end of file (or truncated record)
+            timestamp, busID, direction, dataLen = RECORD.unpack(header)
+            data = f.read(dataLen)
+            if len(data) < dataLen:
+                return
+            yield timestamp, busID, direction, data
+
+def splitMqtt(data: bytes):
+    """Return (topic, payload) from the data of a MQTT record"""
+    topic, _, payload = data.decode(errors='replace').partition('\0')
+    return topic, payload
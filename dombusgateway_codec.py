@@ -0,0 +1,120 @@
+#DomBus codec for DomBus protocol rev.2: checksum, frame splitting, decoding and encoding
+#Used by DomBusGateway for both RX and TX frames
+#
+# Frame format is described in dombusgateway_const.py
+
+import struct
+from typing import NamedTuple
+
+import dombusgateway_const as DB
+
+HEADER = struct.Struct(">BHHB")     # preamble, dstAddr, srcAddr, length
+CMD_PORT = struct.Struct(">BB")     # cmd|ACK|len/2, port
+
+class FrameCmd(NamedTuple):
+    """Command decoded from a frame: args is a view of the command payload after port (arg1, arg2, ...)"""
+    cmd: int        # DB.CMD_CONFIG, DB.CMD_SET, ...
+    ack: int        # DB.CMD_ACK or 0
+    port: int
+    cmdLen: int     # length of data after command (port + args)
+    args: memoryview
+
+def checksum(frame, frameLen: int) -> int:
+    """Return the checksum of a frame with length frameLen (checksum included)"""
+    return sum(memoryview(frame)[:frameLen-1]) & 0xff
+
+def nextFrame(buffer, start: int, end: int):
+    """
+        Look for a frame in buffer[start:end]
+        Return (start, frameLen, dst, src) where start is the position of the preamble (or end if no preamble was found)
+        frameLen = 0 if the frame is not complete yet
+    """
+    if start < end and buffer[start] != DB.PREAMBLE:
+        # Skip all bytes before the next preamble, as they are not the start of a valid frame
+        start = buffer.find(DB.PREAMBLE, start + 1, end)
+        if start < 0:
+            return end, 0, 0, 0
+    if end - start < DB.FRAME_LEN_MIN:
+        return start, 0, 0, 0
+    _, dst, src, frameLen = HEADER.unpack_from(buffer, start)
+    frameLen += DB.FRAME_HEADER + 1  # total length = Header + payload + checksum
+    if end - start < frameLen:
+        return start, 0, dst, src   # Wait for more data
+    return start, frameLen, dst, src
+
+def decodeCmd(frame, frameIdx: int, frameLen: int):
+    """Decode the command starting at frame[frameIdx]. Return a FrameCmd, or None if the command has no arg1 or its length does not fit in the frame"""
+    cmd, port = CMD_PORT.unpack_from(frame, frameIdx)
+    ack = cmd & DB.CMD_ACK
+    cmdLen = (cmd & DB.CMD_LEN_MASK) * 2
+    cmd &= DB.CMD_MASK
+    if cmd == DB.CMD_CONFIG and ack and port != 0xfe and (port & 0xf0) == 0xf0:
+        # cmdLen does not make sense in case of full port configuration, that takes the rest of the frame before checksum
+        cmdLen = frameLen - frameIdx - 2
+    if cmdLen < 2 or frameLen < frameIdx + cmdLen + 1:
+        return None     # all commands have at least port and arg1
+    return FrameCmd(cmd, ack, port, cmdLen, memoryview(frame)[frameIdx+2:frameIdx+cmdLen+1])
+
+def iterCmds(frame, frameLen: int):
+    """Yield all commands in a frame as FrameCmd records. Yield None and stop in case of invalid command length"""
+    frameIdx = DB.FRAME_HEADER
+    while frameIdx+3 < frameLen:
+        c = decodeCmd(frame, frameIdx, frameLen)
+        yield c
+        if c is None:
+            return
+        frameIdx += c.cmdLen + 1
+
+
+class FrameBuilder:
+    """Build TX frames inside a preallocated buffer, that is reused for each frame"""
+    def __init__(self, frameLenMax: int = DB.FRAME_LEN_MAX):
+        self.frameLenMax = frameLenMax
+        self.buffer = bytearray(frameLenMax + 1)   # +1 for the padding byte of the last command
+        self.view = memoryview(self.buffer)
+        self.length = 0     # current frame length, without checksum
+
+    def begin(self, dst: int, src: int = 0):
+        """Start a new frame from src to dst"""
+        HEADER.pack_into(self.buffer, 0, DB.PREAMBLE, dst, src, 0)
+        self.length = DB.FRAME_HEADER
+
+    def add(self, cmd: int, cmdAck: int, cmdLen: int, port: int, args) -> bool:
+        """Append a command to the frame (cmdLen = length of port + args). Return False if the command does not fit in the frame"""
+        if len(args) < cmdLen - 1:
+            raise ValueError(f"Command {cmd:02x} port {port:02x}: cmdLen={cmdLen} but only {len(args)} args")
+        idx = self.length
+        if idx + cmdLen + 2 >= self.frameLenMax:
+            return False
+        #cmdLen field is the number of cmd payload/2, so if after cmd there are 3 or 4 bytes, cmdLen field must be 2 (corresponding to 4 bytes)
+        #longer commands (port configuration ACK) take the rest of the frame: cmdLen field is saturated to not overwrite ACK and cmd bits
+        buffer = self.buffer
+        CMD_PORT.pack_into(buffer, idx, cmd | cmdAck | min((cmdLen+1) >> 1, DB.CMD_LEN_MASK), port & 0xff)
+        idx += 2
+        for a in args[:cmdLen-1]:   # args are 1-3 bytes: storing them one by one is faster than building a struct format for each command
+            buffer[idx] = a & 0xff
+            idx += 1
+        if cmdLen & 1:  #cmdLen is odd => add a dummy byte to get even cmdLen
+            buffer[idx] = 0
+            idx += 1
+        self.length = idx
+        return True
+
+    def empty(self) -> bool:
+        """Return True if no commands have been added to the frame"""
+        return self.length <= DB.FRAME_HEADER
+
+    def finish(self) -> memoryview:
+        """Set length and checksum: return a view of the frame, valid until the next begin()"""
+        self.buffer[DB.FRAME_LEN] = self.length - DB.FRAME_HEADER
+        self.buffer[self.length] = sum(self.view[:self.length]) & 0xff
+        return self.view[:self.length+1]
+
+def encodeFrame(dst: int, src: int, cmds, frameLenMax: int = 255 + DB.FRAME_HEADER) -> bytes:
+    """Return a frame from src to dst containing cmds, a list of (cmd, cmdAck, cmdLen, port, args) tuples"""
+    builder = FrameBuilder(frameLenMax)
+    builder.begin(dst, src)
+    for cmd, cmdAck, cmdLen, port, args in cmds:
+        if not builder.add(cmd, cmdAck, cmdLen, port, args):
+            raise ValueError("Commands do not fit in one frame")
+    return bytes(builder.finish())
@@ -26,8 +26,10 @@ debugLevel = (DB.LOG_DEBUG | DB.LOG_DUMPRX | DB.LOG_DUMPTX | DB.LOG_DUMPDCMD | D
 
 logFile = "/var/log/dombusgateway/info.log"
 # logFile = None      # print log to stdout    
+logQueueSize = 10000  # max number of log messages waiting to be written: if the log file is too slow, further messages are dropped
 
 # Dombus buses (1 or more serial RS485 buses attached to DomBus modules
+# 'baudrate' can be specified for each bus (default 115200): it's used to open the serial port and to compute the bus occupancy
 buses = {
     1: { 'serialPort': '/dev/ttyUSB0', }, # first bus serving ground floor
 #    2: { 'serialPort': '/dev/ttyUSBdombus2', }, # second bus serving 2nd floor
@@ -68,7 +70,55 @@ mqtt = {
     'pass':         'secret',           # MQTT password
     'topic':        'dombus',           # MQTT topic for the domotic controller
     'topicConfig':  'homeassistant',    # MQTT topic for the domotic controller
-    'publishInterval':  300             # Republish entity values every 300 seconds, if they were not changed.
+    'publishInterval':  300,            # Republish entity values every 300 seconds, if they were not changed.
+    'deviceDiscovery':  0,              # 1 => Home Assistant device discovery: one config message for each DomBus module (homeassistant/device/dombus_BBAAAA/config)
+                                        # 0 => one config message for each entity. Entities are migrated when switching from 0 to 1: switching back needs "refresh reset"
+}
+
+# Min interval in seconds between two commands from the domotic controller to the same entity, by device_class or platform of the entity:
+# if more commands are received in the meantime (e.g. moving a slider), or the previous command has not been ACKed yet, only the last value is transmitted
+mqttSetInterval = {
+    'default':  0,
+    'number':   0.5,
+    'light':    0.2,
+}
+
+# Max number of entity states waiting to be published (e.g. when the broker is not reachable): a new state replaces the pending state
+# of the same entity, and when the limit is reached the oldest state is dropped. Configuration messages are never dropped
+mqttOutboxSize = 5000
+
+# Max number of messages per second published when all entities are sent again to Home Assistant (at startup and when Home Assistant
+# sends the "online" birth message on homeassistant/status): states are always sent, configuration only if changed
+mqttResyncRate = 50
+
+# MQTT QoS and retain flag (qos, retain) of published messages, for each kind of message:
+#   'state':  entity value (telemetry), 'ack': entity value confirming a command from the domotic controller, 'config': discovery configuration
+# The policy is looked up by device_class, platform (p) and portType name (e.g. 'IN_COUNTER') of the entity, then 'default' is used:
+# the first key found wins, e.g. a power meter (device_class 'power', platform 'sensor', portType 'IN_COUNTER') uses 'power',
+# a relay (device_class 'outlet', platform 'switch', portType 'OUT_DIGITAL') uses 'switch'.
+# Telemetry sent often (sensors, counters, analog inputs) uses QoS 0: a lost value is replaced by the next one.
+# On/off states sent only when changed use QoS 1, to not lose a transition.
+# Configuration must be retained, else Home Assistant loses the entities when restarted
+mqttPolicy = {
+    'state': {
+        'power':            (0, False),     # device_class
+        'energy':           (0, False),
+        'voltage':          (0, False),
+        'sensor':           (0, False),     # platform
+        'binary_sensor':    (1, False),
+        'switch':           (1, False),
+        'light':            (1, False),
+        'select':           (1, False),
+        'IN_COUNTER':       (0, False),     # portType name
+        'IN_ANALOG':        (0, False),
+        'default':          (0, False),
+    },
+    'ack': {
+        'default':  (1, False),
+    },
+    'config': {
+        'default':  (1, True),
+    },
 }
 
 telnet = {
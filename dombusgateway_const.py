@@ -8,6 +8,7 @@
 
 FRAME_LEN_MIN=10    #Min length of frame for protocol 2 (including CMD + PORT + 1BYTE DATA)
 FRAME_LEN_MAX=31    #max length for TX (devices cannot handle long frames)
+RX_BUFFER_SIZE=4096 #size of the preallocated RX buffer for each bus (must be much greater than the max RX frame length: header + 255 bytes payload + checksum)
 FRAME_LEN=5
 FRAME_HEADER=6
 PREAMBLE=0x3a           #Preamble for protocol 2
@@ -20,8 +21,20 @@ FRAME_INVALID_CHECKSUM = 1  # Invalid checksum
 
 TX_RETRY=10                     #max number of retries
 #TX_RETRY=1                     #max number of retries #DEBUG
-TX_RETRY_TIME=80                # ms: retry every TX_RETRY_TIME * 2^retry
+TX_RTO_INIT=160                 # ms: retry timeout before the round trip time of a module has been measured
+TX_RTO_MIN=20                   # ms: min retry timeout computed from the measured round trip time
+TX_RTO_MAX=1000                 # ms: max retry timeout computed from the measured round trip time
+TX_RETRY_TIME_MAX=2560          # ms: max retry time, with exponential backoff (retry after RTO * 2^retry)
+BUS_REPLY_TIME=15               # ms: max time a module takes to start answering a command: no frames are transmitted to that module until the reply or this timeout
+TX_FRAMES_MAX=3                 # max frames transmitted to a module at once (e.g. configuration), before waiting for its ACK
+MQTT_SET_RETRY_TIME=0.05        # seconds: check again a pending MQTT command after this time, if the previous command to the same device has not been ACKed yet
+MQTT_PUBLISH_BATCH=32           # max number of MQTT messages published together (without waiting for the broker ACK of the previous one)
+TXPRIO_ACK=0                    #TX priority: ACK to commands received from modules
+TXPRIO_CMD=1                    #TX priority: commands from the domotic controller or from other modules
+TXPRIO_CONFIG=2                 #TX priority: port and DCMD configuration
+TXPRIO_STATUS=3                 #TX priority: periodic output status
 PERIODIC_STATUS_INTERVAL=300    #seconds: refresh output status to device every 5 minutes
+PERIODIC_STATUS_RATE=2          #max frames/s used by the periodic output status refresh on each bus
 MODULE_ALIVE_TIME=900           #if no frame is received in this time, module is considered dead (and periodic output status will not be transmitted)
 
 LASTRX=0        # first field in modules[]
@@ -230,13 +243,6 @@ DCMD_OUT_CMDS={
 
 DCMD_OUT_CMDS_Names=["None", "Off", "On", "Toggle", "Dimmer", "Down", "Up"]
 
-TXQ_CMD=0
-TXQ_CMDLEN=1
-TXQ_CMDACK=2
-TXQ_PORT=3
-TXQ_ARGS=4
-TXQ_RETRIES=5
-
 LOG_NONE    =   0x00
 LOG_ERR     =   0x01
 LOG_WARN    =   0x03    # 2+1
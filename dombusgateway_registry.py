@@ -0,0 +1,140 @@
+#DomBus registry: dictionaries of devices (devID => DomBusDevice) and modules (frameAddr => module status) with secondary indexes
+#Used by DomBusGateway to get the devices of a module, of a bus, of a MQTT topic or with a portType,
+#and the buses where a module address is attached (DCMD routing), without scanning the whole installation
+#
+# devID = 0xBBAAAAPPPP    BB=busID, AAAA=module address, PPPP=port
+# frameAddr = devID >> 16 = 0xBBAAAA
+
+class DomBusRegistry(dict):
+    """Devices indexed by devID, with indexes by module (frameAddr), bus, MQTT topic and portType kept updated when a device is added, removed or reindexed"""
+    def __init__(self, devices: dict = None):
+        super().__init__()
+        self.byModule = {}      # frameAddr => {devID: device}
+        self.byBus = {}         # busID => set of devID
+        self.byTopic = {}       # MQTT topic (without /set or /state) => device
+        self.byPortType = {}    # portType => set of devID
+        self.indexed = {}       # devID => (topics, portType) currently in the indexes, used to remove the old keys
+        if devices:
+            for devID, d in devices.items():
+                self[devID] = d
+
+    def __setitem__(self, devID: int, d):
+        if devID in self:
+            self._unindex(devID)
+        super().__setitem__(devID, d)
+        self.byModule.setdefault(devID >> 16, {})[devID] = d
+        self.byBus.setdefault(devID >> 32, set()).add(devID)
+        self._indexAttrs(devID, d)
+
+    def __delitem__(self, devID: int):
+        self._unindex(devID)
+        frameAddr = devID >> 16
+        devices = self.byModule.get(frameAddr)
+        if devices is not None:
+            devices.pop(devID, None)
+            if not devices:
+                del self.byModule[frameAddr]
+        devices = self.byBus.get(devID >> 32)
+        if devices is not None:
+            devices.discard(devID)
+            if not devices:
+                del self.byBus[devID >> 32]
+        super().__delitem__(devID)
+
+    def pop(self, devID: int, *default):
+        if devID not in self:
+            return super().pop(devID, *default)
+        d = self[devID]
+        del self[devID]
+        return d
+
+    def clear(self):
+        super().clear()
+        self.byModule.clear()
+        self.byBus.clear()
+        self.byTopic.clear()
+        self.byPortType.clear()
+        self.indexed.clear()
+
+    def _indexAttrs(self, devID: int, d):
+        """Add topics and portType of device d to the indexes"""
+        topics = tuple(t for t in (getattr(d, 'topic', ''), getattr(d, 'topic2', '')) if t)
+        for t in topics:
+            self.byTopic[t] = d
+        self.byPortType.setdefault(d.portType, set()).add(devID)
+        self.indexed[devID] = (topics, d.portType)
+
+    def _unindex(self, devID: int):
+        """Remove topics and portType of devID from the indexes"""
+        topics, portType = self.indexed.pop(devID, ((), None))
+        d = super().get(devID)
+        for t in topics:
+            if self.byTopic.get(t) is d:
+                del self.byTopic[t]
+        devices = self.byPortType.get(portType)
+        if devices is not None:
+            devices.discard(devID)
+            if not devices:
+                del self.byPortType[portType]
+
+    def reindex(self, d):
+        """Update topic and portType indexes after d.topic, d.topic2 or d.portType have been changed"""
+        if super().get(d.devID) is d:
+            self._unindex(d.devID)
+            self._indexAttrs(d.devID, d)
+
+    def moduleDevices(self, frameAddr: int) -> dict:
+        """Return {devID: device} for the module frameAddr (do not modify it: use list() to remove devices while iterating)"""
+        return self.byModule.get(frameAddr, {})
+
+    def busDevices(self, busID: int) -> set:
+        """Return the set of devID on bus busID"""
+        return self.byBus.get(busID, set())
+
+    def topicDevice(self, topic: str):
+        """Return the device with the specified topic (without /set or /state), or None"""
+        return self.byTopic.get(topic)
+
+    def portTypeDevices(self, portType: int) -> set:
+        """Return the set of devID with the specified portType"""
+        return self.byPortType.get(portType, set())
+
+
+class DomBusModules(dict):
+    """Modules indexed by frameAddr, with the routing table (module address => buses where the module is attached) used to route DCMD commands among buses"""
+    def __init__(self, modules: dict = None):
+        super().__init__()
+        self.routes = {}        # devAddr => list of busID
+        if modules:
+            for frameAddr, m in modules.items():
+                self[frameAddr] = m
+
+    def __setitem__(self, frameAddr: int, m):
+        if frameAddr not in self:
+            self.routes.setdefault(frameAddr & 0xffff, []).append(frameAddr >> 16)
+        super().__setitem__(frameAddr, m)
+
+    def __delitem__(self, frameAddr: int):
+        super().__delitem__(frameAddr)
+        devAddr = frameAddr & 0xffff
+        busIDs = self.routes.get(devAddr)
+        if busIDs is not None:
+            if (frameAddr >> 16) in busIDs:
+                busIDs.remove(frameAddr >> 16)
+            if not busIDs:
+                del self.routes[devAddr]
+
+    def pop(self, frameAddr: int, *default):
+        if frameAddr not in self:
+            return super().pop(frameAddr, *default)
+        m = self[frameAddr]
+        del self[frameAddr]
+        return m
+
+    def clear(self):
+        super().clear()
+        self.routes.clear()
+
+    def addrBuses(self, devAddr: int) -> list:
+        """Return the list of buses where a module with address devAddr is attached"""
+        return self.routes.get(devAddr, [])
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#DomBus bus simulator: open a pseudo-terminal and act as N DomBus modules, to test DomBusGateway without hardware
+#
+# Usage example: 100 DomBus31, 50 DomBus12, 20 DomBusTH and 2 DomBusEVSE, each module sends a SET frame every 10s
+#   ./dombusgateway_simulator.py --modules 31:100,12:50,TH:20,EVSE:2 --rate 0.1 --latency 5 --loss 0.01 --checksum_errors 0.001
+# then start DomBusGateway with the printed pty path, for example:
+#   ./dombusgateway.py --bus1_port /dev/pts/5 --data_dir /tmp/dombussim
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import struct
+import sys
+import time
+import tty
+
+import dombusgateway_const as DB
+import dombusgateway_codec as codec
+
+CONFIG_PAYLOAD_MAX = 120    # max bytes of port configuration in a CONFIG ACK frame: other ports are sent in frames with port 0xf1, 0xf2, ...
+SET_RETRY_TIME = 0.1        # seconds before retransmitting a SET frame not ACKed by the gateway
+SET_RETRY = 5               # max number of retransmissions of a SET frame
+
+# Module types: name (max 8 chars, as sent in the version ACK), firmware version, list of ports (portType, portOpt, portName)
+MODULE_TYPES = {
+    '31':   ('DomBus31', '02j1', [(DB.PORTTYPE_OUT_DIGITAL, DB.PORTOPT_NONE, f"RL{i}") for i in range(1, 7)] +
+                                 [(DB.PORTTYPE_OUT_RELAY_LP, DB.PORTOPT_NONE, f"RL{i}") for i in range(7, 9)]),
+    '12':   ('DomBus12', '02d0', [(DB.PORTTYPE_IN_DIGITAL, DB.PORTOPT_NONE, f"IO{i}") for i in range(1, 8)] +
+                                 [(DB.PORTTYPE_OUT_DIGITAL, DB.PORTOPT_NONE, "OC8"), (DB.PORTTYPE_OUT_DIGITAL, DB.PORTOPT_NONE, "OC9")]),
+    'TH':   ('DomBusTH', '02g3', [(DB.PORTTYPE_OUT_DIGITAL, DB.PORTOPT_NONE, f"IO{i}") for i in range(1, 7)] +
+                                 [(DB.PORTTYPE_IN_ANALOG, DB.PORTOPT_NONE, "Light"), (DB.PORTTYPE_SENSOR_TEMP, DB.PORTOPT_NONE, "Temp"),
+                                  (DB.PORTTYPE_SENSOR_HUM, DB.PORTOPT_NONE, "Hum"), (DB.PORTTYPE_IN_COUNTER, DB.PORTOPT_NONE, "Counter")]),
+    'EVSE': ('DomBusEV', '02e0', [(DB.PORTTYPE_CUSTOM, DB.PORTOPT_IMPORT_ENERGY, "EV Power"), (DB.PORTTYPE_CUSTOM, DB.PORTOPT_IMPORT_ENERGY, "Grid Power"),
+                                  (DB.PORTTYPE_CUSTOM, DB.PORTOPT_SELECT, "EV State"), (DB.PORTTYPE_CUSTOM, DB.PORTOPT_SELECT, "EV Mode"),
+                                  (DB.PORTTYPE_CUSTOM, DB.PORTOPT_DIMMER, "EV Current"), (DB.PORTTYPE_CUSTOM, DB.PORTOPT_VOLTAGE, "EV Voltage"),
+                                  (DB.PORTTYPE_OUT_DIGITAL, DB.PORTOPT_NONE, "RL1"), (DB.PORTTYPE_OUT_DIGITAL, DB.PORTOPT_NONE, "RL2")]),
+}
+OUTPUTS = DB.PORTTYPE_OUT_DIGITAL | DB.PORTTYPE_OUT_RELAY_LP | DB.PORTTYPE_OUT_DIMMER | DB.PORTTYPE_OUT_FLASH | DB.PORTTYPE_OUT_ANALOG
+
+class SimModule:
+    """Simulated DomBus module"""
+    def __init__(self, sim, addr: int, moduleType: str):
+        self.sim = sim
+        self.addr = addr
+        self.name, self.version, self.ports = MODULE_TYPES[moduleType]
+        self.values = [0] * (len(self.ports) + 1)   # values[port]
+        self.pending = dict()   # SET frames waiting for ACK: pending[port] = [cmdLen, args, retries, timeTx]
+
+    def inputPorts(self):
+        """Return the list of ports that send SET frames to the gateway"""
+        return [port for port, (portType, _, _) in enumerate(self.ports, 1) if not (portType & OUTPUTS)]
+
+    def setCmd(self, port: int):
+        """Return (cmdLen, args) of a SET command with a new random value for port"""
+        portType, portOpt, _ = self.ports[port-1]
+        if portType == DB.PORTTYPE_IN_DIGITAL:
+            self.values[port] ^= 1
+            return 2, [self.values[port]]
+        if portType == DB.PORTTYPE_SENSOR_TEMP:
+            value = int((random.uniform(15, 30) + 273.1) * 10)
+        elif portType == DB.PORTTYPE_SENSOR_HUM:
+            value = random.randint(300, 700)
+        elif portType == DB.PORTTYPE_IN_COUNTER:
+            self.values[port] = (self.values[port] + random.randint(1, 20)) & 0xffff
+            return 5, [0, random.randint(0, 100), self.values[port] >> 8, self.values[port] & 0xff]
+        elif portType == DB.PORTTYPE_CUSTOM and portOpt in (DB.PORTOPT_IMPORT_ENERGY, DB.PORTOPT_EXPORT_ENERGY):
+            power = random.randint(-3000, 7000) & 0xffff
+            self.values[port] += random.randint(0, 10)
+            return 7, list(struct.pack(">HI", power, self.values[port] & 0xffffffff))
+        elif portType == DB.PORTTYPE_CUSTOM and portOpt == DB.PORTOPT_SELECT:
+            return 2, [random.randint(0, 5)]
+        else:
+            value = random.randint(0, 1023)
+        return 3, [value >> 8, value & 0xff]
+
+    def sendSet(self):
+        """Send a SET frame with a new value for a random input port"""
+        ports = self.inputPorts()
+        if not ports:
+            return
+        port = random.choice(ports)
+        cmdLen, args = self.setCmd(port)
+        self.pending[port] = [cmdLen, args, 0, time.monotonic()]    # a new value replaces the pending one
+        self.sim.stats['setSent'] += 1
+        self.sim.write(self.addr, [(DB.CMD_SET, 0, cmdLen, port, args)])
+
+    def retry(self, now: float):
+        """Retransmit SET frames not ACKed in time"""
+        cmds = []
+        for port, p in list(self.pending.items()):
+            cmdLen, args, retries, timeTx = p
+            if now - timeTx < SET_RETRY_TIME * (1 << retries):
+                continue
+            if retries >= SET_RETRY:
+                del self.pending[port]
+                self.sim.stats['setLost'] += 1
+                continue
+            p[2] += 1
+            p[3] = now
+            self.sim.stats['setRetries'] += 1
+            cmds.append((DB.CMD_SET, 0, cmdLen, port, args))
+        if cmds:
+            self.sim.write(self.addr, cmds)
+
+    def configFrames(self):
+        """Return the list of frames answering a CONFIG request for port 0xff: version, then ports configuration"""
+        frames = []
+        version = (self.version + self.name).encode() + b'\0'
+        cmds = [(DB.CMD_CONFIG, DB.CMD_ACK, len(version) + 1, 0xfe, list(version))]
+        configPort = 0xff
+        args = [2]  # protocol 2
+        for i, (portType, portOpt, portName) in enumerate(self.ports, 1):
+            entry = list(struct.pack(">IH", portType, portOpt)) + list(portName.encode()[:15]) + [0]
+            if len(args) + len(entry) > CONFIG_PAYLOAD_MAX:
+                cmds.append((DB.CMD_CONFIG, DB.CMD_ACK, len(args) + 1, configPort, args))
+                frames.append(codec.encodeFrame(0, self.addr, cmds))
+                configPort = 0xf0 + len(frames)
+                cmds = []
+                args = [2, i]   # protocol 2, first port in this frame
+            args += entry
+        cmds.append((DB.CMD_CONFIG, DB.CMD_ACK, len(args) + 1, configPort, args))
+        frames.append(codec.encodeFrame(0, self.addr, cmds))
+        return frames
+
+    def frameReceived(self, frame, frameLen: int):
+        """Manage a frame addressed to this module"""
+        acks = []
+        for c in codec.iterCmds(frame, frameLen):
+            if c is None:
+                self.sim.stats['rxInvalid'] += 1
+                return
+            arg = c.args[0] if len(c.args) else 0
+            if c.ack:
+                if c.cmd == DB.CMD_SET and c.port in self.pending and self.pending[c.port][1][0] == arg:
+                    del self.pending[c.port]
+                    self.sim.stats['setAcked'] += 1
+            elif c.cmd == DB.CMD_CONFIG and c.port == 0xff:
+                self.sim.stats['configRequests'] += 1
+                for f in self.configFrames():
+                    self.sim.writeFrame(f)
+            else:
+                if c.cmd == DB.CMD_SET and 0 < c.port < len(self.values):
+                    self.values[c.port] = arg
+                acks.append((c.cmd, DB.CMD_ACK, 2, c.port, [arg]))
+                self.sim.stats['cmdAcked'] += 1
+        if acks:
+            self.sim.write(self.addr, acks)
+
+class Simulator:
+    """Pseudo-terminal with the list of simulated modules"""
+    def __init__(self, modules, rate: float, latency: float, loss: float, checksumErrors: float):
+        self.modules = modules              # dict of SimModule by address
+        self.rate = rate                    # SET frames/s for each module
+        self.latency = latency              # seconds before a module answers
+        self.loss = loss                    # probability that a frame is lost (both directions)
+        self.checksumErrors = checksumErrors  # probability that a transmitted frame has a wrong checksum
+        self.rxBuffer = bytearray()
+        self.stats = dict.fromkeys(('rxFrames', 'rxLost', 'rxChecksum', 'rxInvalid', 'txFrames', 'txLost', 'txChecksum',
+                                    'setSent', 'setRetries', 'setAcked', 'setLost', 'cmdAcked', 'configRequests'), 0)
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        tty.setraw(self.master)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+
+    def write(self, addr: int, cmds):
+        """Send a frame from module addr to the gateway, containing cmds"""
+        self.writeFrame(codec.encodeFrame(0, addr, cmds, DB.FRAME_LEN_MAX))
+
+    def writeFrame(self, frame: bytes):
+        """Send frame after the configured latency, simulating loss and checksum errors"""
+        if random.random() < self.loss:
+            self.stats['txLost'] += 1
+            return
+        if random.random() < self.checksumErrors:
+            self.stats['txChecksum'] += 1
+            frame = frame[:-1] + bytes([(frame[-1] + 1) & 0xff])
+        self.stats['txFrames'] += 1
+        if self.latency > 0:
+            asyncio.get_running_loop().call_later(self.latency * random.uniform(0.5, 1.5), self._write, frame)
+        else:
+            self._write(frame)
+
+    def _write(self, frame: bytes):
+        try:
+            os.write(self.master, frame)
+        except BlockingIOError:
+            self.stats['txLost'] += 1   # the gateway does not read the pty
+
+    def _read(self):
+        """Read frames from the gateway and pass them to the addressed module"""
+        try:
+            self.rxBuffer += os.read(self.master, 4096)
+        except (BlockingIOError, OSError):
+            return
+        start = 0
+        end = len(self.rxBuffer)
+        while True:
+            start, frameLen, dst, src = codec.nextFrame(self.rxBuffer, start, end)
+            if frameLen == 0:
+                break
+            frame = self.rxBuffer[start:start+frameLen]
+            if codec.checksum(frame, frameLen) != frame[-1]:
+                self.stats['rxChecksum'] += 1
+                start += 1
+                continue
+            start += frameLen
+            self.stats['rxFrames'] += 1
+            if random.random() < self.loss:
+                self.stats['rxLost'] += 1
+            elif dst in self.modules:
+                self.modules[dst].frameReceived(frame, frameLen)
+        del self.rxBuffer[:start]
+
+    async def run(self, statsInterval: float):
+        """Read frames from the gateway, send SET frames and retries, log statistics"""
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.master, self._read)
+        modules = list(self.modules.values())
+        timeStats = time.monotonic()
+        period = 0.01   # scheduler period, in seconds
+        while True:
+            await asyncio.sleep(period)
+            now = time.monotonic()
+            for m in modules:
+                if random.random() < self.rate * period:
+                    m.sendSet()
+                if m.pending:
+                    m.retry(now)
+            if statsInterval > 0 and now - timeStats >= statsInterval:
+                timeStats = now
+                logging.info(" ".join(f"{k}={v}" for k, v in self.stats.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='DomBusSimulator', description='Simulate DomBus modules on a pseudo-terminal')
+    parser.add_argument('--modules', '-m', type=str, default='31:4,12:4,TH:2,EVSE:1',
+            help=f'Modules to simulate, as TYPE:NUMBER separated by comma. Types: {", ".join(MODULE_TYPES)}')
+    parser.add_argument('--base_addr', '-a', type=str, default='0100',
+            help='Address of the first module, in hex format (other modules get the next addresses)')
+    parser.add_argument('--rate', '-r', type=float, default=0.1,
+            help='SET frames per second transmitted by each module')
+    parser.add_argument('--latency', '-l', type=float, default=5,
+            help='Average delay in ms before a module answers')
+    parser.add_argument('--loss', '-x', type=float, default=0,
+            help='Probability (0-1) that a frame is lost')
+    parser.add_argument('--checksum_errors', '-c', type=float, default=0,
+            help='Probability (0-1) that a transmitted frame has a wrong checksum')
+    parser.add_argument('--stats', '-s', type=float, default=10,
+            help='Interval in seconds between statistics (0=disabled)')
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(asctime)s - %(message)s")
+
+    sim = Simulator(dict(), args.rate, args.latency / 1000, args.loss, args.checksum_errors)
+    addr = int(args.base_addr, 16)
+    for m in args.modules.split(','):
+        moduleType, _, n = m.partition(':')
+        if moduleType not in MODULE_TYPES:
+            parser.error(f"Unknown module type {moduleType}")
+        for i in range(int(n or 1)):
+            sim.modules[addr] = SimModule(sim, addr, moduleType)
+            addr += 1
+    logging.info(f"Simulating {len(sim.modules)} modules on {sim.path}")
+    try:
+        asyncio.run(sim.run(args.stats))
+    except KeyboardInterrupt:
+        logging.info(" ".join(f"{k}={v}" for k, v in sim.stats.items()))
@@ -0,0 +1,5 @@
+#Tests of DomBusGateway modules: run "python -m pytest" from the repository folder
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
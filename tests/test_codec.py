@@ -0,0 +1,228 @@
+#Round trip tests of dombusgateway_codec: encodeFrame/FrameBuilder => nextFrame => iterCmds
+import random
+
+import pytest
+
+import dombusgateway_codec as codec
+import dombusgateway_const as DB
+
+
+def parse(buffer: bytes):
+    """Return the list of (dst, src, [FrameCmd]) of all frames in buffer"""
+    frames = []
+    start, end = 0, len(buffer)
+    while start < end:
+        start, frameLen, dst, src = codec.nextFrame(buffer, start, end)
+        if frameLen == 0:
+            break
+        frame = buffer[start:start+frameLen]
+        assert codec.checksum(frame, frameLen) == frame[-1]
+        frames.append((dst, src, list(codec.iterCmds(frame, frameLen))))
+        start += frameLen
+    return frames
+
+
+@pytest.mark.parametrize("cmdLen, args", [
+    (2, [0x55]),                # port + arg1: even, no padding
+    (3, [0x12, 0x34]),          # port + 16bit value: odd => padding byte
+    (4, [0x01, 0x12, 0x34]),    # port + subcmd + 16bit value
+])
+def test_roundtrip_single_cmd(cmdLen, args):
+    frame = codec.encodeFrame(0xff31, 0, [(DB.CMD_SET, 0, cmdLen, 5, args)])
+    assert len(frame) == DB.FRAME_HEADER + 2 + (cmdLen - 1) + (cmdLen & 1) + 1
+    assert frame[DB.FRAME_LEN] == len(frame) - DB.FRAME_HEADER - 1
+    [(dst, src, [c])] = parse(frame)
+    assert (dst, src) == (0xff31, 0)
+    assert (c.cmd, c.ack, c.port) == (DB.CMD_SET, 0, 5)
+    assert c.cmdLen == cmdLen + (cmdLen & 1)
+    assert list(c.args[:len(args)]) == args
+    if cmdLen & 1:
+        assert c.args[len(args)] == 0   # padding byte
+
+
+def test_roundtrip_several_cmds():
+    cmds = [
+        (DB.CMD_SET, DB.CMD_ACK, 2, 1, [1]),
+        (DB.CMD_CONFIG, 0, 4, 3, [DB.SUBCMD_SET, 0x01, 0xf4]),
+        (DB.CMD_SET, 0, 3, 7, [0x03, 0xe8]),
+        (DB.CMD_GET, 0, 2, 9, [0]),
+    ]
+    frame = codec.encodeFrame(0x0004, 0xff31, cmds)
+    [(dst, src, decoded)] = parse(frame)
+    assert (dst, src) == (0x0004, 0xff31)
+    assert [(c.cmd, c.ack, c.port, list(c.args[:len(args)])) for c, (_, _, _, _, args) in zip(decoded, cmds)] == \
+        [(cmd, ack, port, args) for cmd, ack, _, port, args in cmds]
+
+
+def test_frame_builder_reuse():
+    builder = codec.FrameBuilder()
+    frames = []
+    for port in range(1, 4):
+        builder.begin(0xff31)
+        assert builder.empty()
+        assert builder.add(DB.CMD_SET, 0, 2, port, [port * 10])
+        frames.append(bytes(builder.finish()))
+    assert frames[1] == codec.encodeFrame(0xff31, 0, [(DB.CMD_SET, 0, 2, 2, [20])])
+    assert [cmds[0].args[0] for _, _, cmds in parse(b''.join(frames))] == [10, 20, 30]
+
+
+def test_frame_builder_full():
+    builder = codec.FrameBuilder()
+    builder.begin(0xff31)
+    n = 0
+    while builder.add(DB.CMD_SET, 0, 4, n, [0, 1, 2]):
+        n += 1
+    assert n > 0
+    frame = builder.finish()
+    assert len(frame) <= DB.FRAME_LEN_MAX
+    assert len(parse(bytes(frame))[0][2]) == n
+
+
+def test_full_config_ack_saturated_len():
+    # ACK to a full port configuration takes the rest of the frame: len field is saturated
+    args = [1] + [0x00, 0x00, 0x00, 0x02, 0x00, 0x00] + list(b'RL1\0') + [0x00, 0x00, 0x00, 0x10, 0x00, 0x00] + list(b'DIM\0')
+    frame = codec.encodeFrame(0, 0xff31, [(DB.CMD_CONFIG, DB.CMD_ACK, len(args) + 1, 0xff, args)])
+    assert frame[DB.FRAME_HEADER] & DB.CMD_LEN_MASK == DB.CMD_LEN_MASK
+    [(_, _, [c])] = parse(frame)
+    assert (c.cmd, c.ack, c.port) == (DB.CMD_CONFIG, DB.CMD_ACK, 0xff)
+    assert c.cmdLen == len(frame) - DB.FRAME_HEADER - 2
+    assert list(c.args[:len(args)]) == args
+
+
+def test_resync_over_garbage():
+    frame = codec.encodeFrame(0, 0xff31, [(DB.CMD_SET, 0, 2, 1, [1])])
+    buffer = b'\x00\x11\xff' + frame + b'\x22' + frame
+    frames = parse(buffer)
+    assert len(frames) == 2
+    start, frameLen, _, _ = codec.nextFrame(buffer, 0, len(buffer))
+    assert (start, frameLen) == (3, len(frame))
+
+
+def test_no_preamble():
+    assert codec.nextFrame(b'\x00\x11\x22\x33', 0, 4) == (4, 0, 0, 0)
+
+
+def test_split_frame():
+    frame = codec.encodeFrame(0, 0xff31, [(DB.CMD_SET, 0, 3, 1, [0x12, 0x34])])
+    for cut in range(1, len(frame)):
+        start, frameLen, _, _ = codec.nextFrame(frame, 0, cut)
+        assert (start, frameLen) == (0, 0)
+    assert codec.nextFrame(frame, 0, len(frame))[:2] == (0, len(frame))
+
+
+def test_invalid_cmd_len():
+    # command length does not fit in the frame
+    frame = bytearray(codec.encodeFrame(0, 0xff31, [(DB.CMD_SET, 0, 2, 1, [1])]))
+    frame[DB.FRAME_HEADER] |= DB.CMD_LEN_MASK
+    assert list(codec.iterCmds(frame, len(frame))) == [None]
+    # len field = 0: command without arg1
+    frame[DB.FRAME_HEADER] &= ~DB.CMD_LEN_MASK
+    assert codec.decodeCmd(frame, DB.FRAME_HEADER, len(frame)) is None
+
+
+def test_checksum():
+    frame = bytearray(codec.encodeFrame(0xff31, 0, [(DB.CMD_SET, 0, 2, 1, [0xff])]))
+    assert codec.checksum(frame, len(frame)) == sum(frame[:-1]) & 0xff == frame[-1]
+    frame[-2] ^= 0x01
+    assert codec.checksum(frame, len(frame)) != frame[-1]
+
+
+# Property tests: random commands, garbage and split points (seeded, to be reproducible)
+CMDS = (DB.CMD_CONFIG, DB.CMD_GET, DB.CMD_SET, DB.CMD_DCMD_CONFIG, DB.CMD_DCMD)
+
+def randomCmd(rng: random.Random):
+    """Return a random (cmd, cmdAck, cmdLen, port, args) command, with cmdLen that fits in the len field"""
+    cmd = rng.choice(CMDS)
+    ack = rng.choice((0, DB.CMD_ACK))
+    port = rng.randrange(0xf0 if cmd == DB.CMD_CONFIG and ack else 0x100)   # 0xf0-0xff: full configuration ACK, tested above
+    cmdLen = rng.randrange(2, DB.CMD_LEN_MASK * 2)
+    return cmd, ack, cmdLen, port, [rng.randrange(256) for _ in range(cmdLen - 1)]
+
+def randomFrame(rng: random.Random):
+    """Return (frame, dst, src, cmds) with 1-4 random commands"""
+    dst, src = rng.randrange(0x10000), rng.randrange(0x10000)
+    cmds = [randomCmd(rng) for _ in range(rng.randrange(1, 5))]
+    return codec.encodeFrame(dst, src, cmds), dst, src, cmds
+
+def garbage(rng: random.Random):
+    """Random bytes without preamble, that the RX side must skip"""
+    return bytes(rng.choice([b for b in range(256) if b != DB.PREAMBLE]) for _ in range(rng.randrange(8)))
+
+def checkCmds(decoded, cmds):
+    assert len(decoded) == len(cmds)
+    for c, (cmd, ack, cmdLen, port, args) in zip(decoded, cmds):
+        assert c is not None
+        assert (c.cmd, c.ack, c.port, c.cmdLen) == (cmd, ack, port, cmdLen + (cmdLen & 1))
+        assert list(c.args[:cmdLen-1]) == args
+        if cmdLen & 1:
+            assert c.args[cmdLen-1] == 0   # padding byte
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_property_roundtrip(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        frame, dst, src, cmds = randomFrame(rng)
+        assert frame[DB.FRAME_LEN] == len(frame) - DB.FRAME_HEADER - 1
+        [(rxDst, rxSrc, decoded)] = parse(frame)
+        assert (rxDst, rxSrc) == (dst, src)
+        checkCmds(decoded, cmds)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_property_frame_builder_matches_encode(seed):
+    rng = random.Random(seed)
+    builder = codec.FrameBuilder(255 + DB.FRAME_HEADER)
+    for _ in range(200):
+        frame, dst, src, cmds = randomFrame(rng)
+        builder.begin(dst, src)
+        for cmd in cmds:
+            assert builder.add(*cmd)
+        assert bytes(builder.finish()) == frame
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_property_stream_garbage_and_splits(seed):
+    # frames separated by garbage, received in chunks split at random points: the RX side must extract all frames
+    rng = random.Random(seed)
+    sent = [randomFrame(rng) for _ in range(50)]
+    stream = b''.join(garbage(rng) + frame for frame, _, _, _ in sent) + garbage(rng)
+    received = []
+    buffer = bytearray()
+    start = 0
+    pos = 0
+    while pos < len(stream):
+        n = rng.randrange(1, 40)
+        buffer += stream[pos:pos+n]
+        pos += n
+        while True:
+            start, frameLen, dst, src = codec.nextFrame(buffer, start, len(buffer))
+            if frameLen == 0:
+                break
+            frame = bytes(buffer[start:start+frameLen])
+            assert codec.checksum(frame, frameLen) == frame[-1]
+            received.append((frame, dst, src, list(codec.iterCmds(frame, frameLen))))
+            start += frameLen
+    assert [(frame, dst, src) for frame, dst, src, _ in received] == [(frame, dst, src) for frame, dst, src, _ in sent]
+    for (_, _, _, decoded), (_, _, _, cmds) in zip(received, sent):
+        checkCmds(decoded, cmds)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_property_corrupted_frame(seed):
+    # a frame with one changed byte always has a wrong checksum, and decoding it never raises an exception
+    rng = random.Random(seed)
+    for _ in range(200):
+        frame, _, _, _ = randomFrame(rng)
+        corrupted = bytearray(frame)
+        i = rng.randrange(DB.FRAME_HEADER, len(frame) - 1)
+        corrupted[i] ^= rng.randrange(1, 256)
+        assert codec.checksum(corrupted, len(corrupted)) != corrupted[-1]
+        list(codec.iterCmds(corrupted, len(corrupted)))
+
+
+def test_frame_builder_short_args():
+    builder = codec.FrameBuilder()
+    builder.begin(0xff31)
+    with pytest.raises(ValueError):
+        builder.add(DB.CMD_SET, 0, 4, 1, [0x12])